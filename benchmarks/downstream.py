@@ -0,0 +1,54 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Starts the fake downstream services in fakes/ for the benchmarks
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PRODUCTS_PORT = 5001
+SHOPCARTS_PORT = 5002
+
+
+@contextmanager
+def running(name, port, env=None):
+    """ Runs fakes/<name>.py until the end of the block """
+    fake = subprocess.Popen([sys.executable, os.path.join(ROOT, 'fakes', name + '.py')],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            env=dict(os.environ, **(env or {})))
+    try:
+        wait_for(port)
+        yield 'http://127.0.0.1:%s' % port
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+def wait_for(port, seconds=10):
+    """ Waits until something accepts connections on a local port """
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    sys.exit('Nothing is listening on port %s' % port)
@@ -0,0 +1,79 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+HTTP client benchmark
+
+Starts the fake Product and ShopCart services (fakes/) and makes the calls of
+add-to-cart, a product GET and a cart POST, with a new connection for every
+call like the module-level requests functions do, and then with the pooled
+keep-alive sessions of service.clients.
+
+Usage:
+  python benchmarks/http_clients.py [--calls 1000] [--threads 4]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from downstream import PRODUCTS_PORT, SHOPCARTS_PORT, running    # pylint: disable=wrong-import-position
+from service.clients import HTTPClient    # pylint: disable=wrong-import-position
+
+
+def run(get, post, urls, calls, threads):
+    """ Moves `calls` products to a cart and returns the seconds taken """
+    products_url, shopcarts_url = urls
+
+    def move(product_id):
+        get('%s/products/%s' % (products_url, product_id)).raise_for_status()
+        post('%s/shopcarts/1' % shopcarts_url, json={'product_id': product_id}).raise_for_status()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(move, range(calls)))
+    return time.perf_counter() - start
+
+
+def main():
+    """ Runs the benchmark and prints the results """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    products = HTTPClient(pool_size=args.threads)
+    shopcarts = HTTPClient(pool_size=args.threads)
+    with running('products', PRODUCTS_PORT) as products_url, \
+            running('shopcarts', SHOPCARTS_PORT) as shopcarts_url:
+        urls = (products_url, shopcarts_url)
+        results = [
+            ('requests', run(requests.get, requests.post, urls, args.calls, args.threads)),
+            ('sessions', run(products.get, shopcarts.post, urls, args.calls, args.threads)),
+        ]
+
+    requests_made = 2 * args.calls
+    print('%d add-to-cart calls on %d threads' % (args.calls, args.threads))
+    print('%-10s %10s %12s' % ('client', 'seconds', 'requests/s'))
+    for name, seconds in results:
+        print('%-10s %10.3f %12.0f' % (name, seconds, requests_made / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+HTTP load benchmark
+
+Starts the fake Product and ShopCart services (fakes/) and the Wishlist
+service, either in this process or under gunicorn with gunicorn_config.py,
+seeds it with wishlists and items through the API, then sends the requests of
+every route of service/service.py from `--concurrency` threads and reports
+the throughput and the 50th, 95th and 99th percentile latency of each.
+
+The results are written to a JSON file. --compare reads the results of an
+earlier run and reports the routes whose throughput or p99 latency got worse
+by more than --threshold percent, and exits with 1 if there are any.
+
+The service uses a new SQLite database unless DATABASE_URI is set. The logs
+of the service go to a file next to the results.
+
+Usage:
+  python benchmarks/load.py [--target inprocess|gunicorn] [--workers 2] [--threads 1]
+      [--concurrency 8] [--requests 200] [--wishlists 100] [--items 20]
+      [--only get,items] [--output load.json] [--compare baseline.json] [--threshold 10]
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from downstream import PRODUCTS_PORT, ROOT, SHOPCARTS_PORT, running, wait_for    # pylint: disable=wrong-import-position
+
+SERVICE_PORT = 5010
+
+# prepare(dataset, count) returns the target of each request and
+# send(session, url, target) sends one, expect are the statuses of success
+Scenario = namedtuple('Scenario', 'name expect prepare send')
+
+
+class Dataset():
+    """ The wishlists and items created through the API """
+
+    def __init__(self, url, seed=42):
+        self.url = url
+        self.session = requests.Session()
+        self.rand = random.Random(seed)
+        self.wishlists = []    # (id, customer_id)
+        self.items = {}    # wishlist id -> product ids
+        self.products = 0    # product ids given so far
+        self.seeded = []    # the wishlists the reads go to
+
+    def create_wishlists(self, count, items=0):
+        """ Creates wishlists with `items` items each, returns their ids """
+        ids = []
+        for start in range(0, count, 100):
+            batch = [{'name': 'wishlist %d' % (len(self.wishlists) + number),
+                      'customer_id': (len(self.wishlists) + number) % 50 + 1}
+                     for number in range(min(100, count - start))]
+            resp = self.session.post('%s/api/wishlists:batch' % self.url, json=batch)
+            resp.raise_for_status()
+            for wishlist in resp.json():
+                self.wishlists.append((wishlist['id'], wishlist['customer_id']))
+                ids.append(wishlist['id'])
+        for wishlist_id in ids:
+            self.create_items(wishlist_id, items)
+        return ids
+
+    def create_items(self, wishlist_id, count):
+        """ Adds `count` new items to a wishlist, returns their product ids """
+        product_ids = [self.products + number + 1 for number in range(count)]
+        self.products += count
+        if product_ids:
+            resp = self.session.post('%s/api/wishlists/%s/items:batch' % (self.url, wishlist_id),
+                                     json=[{'product_id': product_id,
+                                            'product_name': 'product %d' % product_id}
+                                           for product_id in product_ids])
+            resp.raise_for_status()
+        self.items.setdefault(wishlist_id, []).extend(product_ids)
+        return product_ids
+
+    def new_items(self, count, per_wishlist=10):
+        """ Creates `count` items spread over new wishlists, returns (wishlist id, product id) """
+        targets = []
+        for wishlist_id in self.create_wishlists(int(math.ceil(count / per_wishlist))):
+            targets.extend((wishlist_id, product_id) for product_id
+                           in self.create_items(wishlist_id, per_wishlist))
+        return targets[:count]
+
+    def wishlist(self):
+        """ Returns a random seeded wishlist id """
+        return self.rand.choice(self.seeded)[0]
+
+    def item(self):
+        """ Returns a random seeded (wishlist id, product id) """
+        wishlist_id = self.wishlist()
+        return wishlist_id, self.rand.choice(self.items[wishlist_id])
+
+    def seed(self, wishlists, items):
+        """ Creates the wishlists the reads go to """
+        self.create_wishlists(wishlists, items)
+        self.seeded = list(self.wishlists)
+
+
+def etag_of(session, url, wishlist_id):
+    """ Returns the ETag of a wishlist """
+    return session.get('%s/api/wishlists/%s' % (url, wishlist_id)).headers['ETag']
+
+
+def random_wishlists(dataset, count):
+    """ Targets random seeded wishlists """
+    return [dataset.wishlist() for _ in range(count)]
+
+
+def random_customers(dataset, count):
+    """ Targets the customers of random seeded wishlists """
+    return [dataset.rand.choice(dataset.seeded)[1] for _ in range(count)]
+
+
+def random_items(dataset, count):
+    """ Targets random seeded items """
+    return [dataset.item() for _ in range(count)]
+
+
+def nothing(_dataset, count):
+    """ Targets nothing in particular """
+    return [None] * count
+
+
+def counter(start):
+    """ Returns a function that targets new numbers from start on """
+    numbers = iter(range(start, sys.maxsize))
+    return lambda _dataset, count: [next(numbers) for _ in range(count)]
+
+
+def queue_jobs(dataset, count):
+    """ Queues cart jobs, returns their ids """
+    jobs = []
+    for wishlist_id, product_id in dataset.new_items(count):
+        resp = dataset.session.put('%s/api/wishlists/%s/items/%s/add-to-cart?async=true'
+                                   % (dataset.url, wishlist_id, product_id))
+        resp.raise_for_status()
+        jobs.append(resp.json()['id'])
+    return jobs
+
+
+def with_etags(dataset, count):
+    """ Targets random seeded wishlists with their ETags """
+    etags = {}
+    targets = []
+    for wishlist_id in random_wishlists(dataset, count):
+        if wishlist_id not in etags:
+            etags[wishlist_id] = etag_of(dataset.session, dataset.url, wishlist_id)
+        targets.append((wishlist_id, etags[wishlist_id]))
+    return targets
+
+
+def build_scenarios():
+    """ Returns the scenarios, one or more for each route of the service """
+    ok, created, no_content = (200,), (201,), (204,)
+    new_products = counter(10 ** 6)
+    return [
+        Scenario('home', ok, nothing, lambda s, u, _: s.get(u + '/')),
+        Scenario('list', ok, nothing, lambda s, u, _: s.get(u + '/api/wishlists?limit=50')),
+        Scenario('list-expand', ok, nothing,
+                 lambda s, u, _: s.get(u + '/api/wishlists?limit=50&expand=items')),
+        Scenario('list-customer', ok, random_customers,
+                 lambda s, u, c: s.get(u + '/api/wishlists?customer_id=%d' % c)),
+        Scenario('list-stream', ok, nothing,
+                 lambda s, u, _: s.get(u + '/api/wishlists?stream=true')),
+        Scenario('create', created, counter(0),
+                 lambda s, u, n: s.post(u + '/api/wishlists',
+                                        json={'name': 'new %d' % n, 'customer_id': 99})),
+        Scenario('create-batch', created, counter(0),
+                 lambda s, u, n: s.post(u + '/api/wishlists:batch',
+                                        json=[{'name': 'batch %d' % n, 'customer_id': 98}] * 10)),
+        Scenario('get', ok, random_wishlists,
+                 lambda s, u, w: s.get(u + '/api/wishlists/%s' % w)),
+        Scenario('get-expand', ok, random_wishlists,
+                 lambda s, u, w: s.get(u + '/api/wishlists/%s?expand=items' % w)),
+        Scenario('get-not-modified', (304,), with_etags,
+                 lambda s, u, t: s.get(u + '/api/wishlists/%s' % t[0],
+                                       headers={'If-None-Match': t[1]})),
+        Scenario('rename', ok, random_wishlists,
+                 lambda s, u, w: s.put(u + '/api/wishlists/%s' % w, json={'name': 'renamed'})),
+        Scenario('delete', no_content, lambda d, n: d.create_wishlists(n),
+                 lambda s, u, w: s.delete(u + '/api/wishlists/%s' % w)),
+        Scenario('items', ok, random_wishlists,
+                 lambda s, u, w: s.get(u + '/api/wishlists/%s/items' % w)),
+        Scenario('items-query', ok, random_items,
+                 lambda s, u, t: s.get(u + '/api/wishlists/%s/items?product_name=product %s'
+                                       % t)),
+        Scenario('items-stream', ok, random_wishlists,
+                 lambda s, u, w: s.get(u + '/api/wishlists/%s/items?stream=true' % w)),
+        Scenario('add-item', created, lambda d, n: list(zip(random_wishlists(d, n),
+                                                            new_products(d, n))),
+                 lambda s, u, t: s.post(u + '/api/wishlists/%s/items' % t[0],
+                                        json={'product_id': t[1], 'product_name': 'new'})),
+        Scenario('add-items-batch', ok, lambda d, n: list(zip(random_wishlists(d, n),
+                                                              new_products(d, n))),
+                 lambda s, u, t: s.post(u + '/api/wishlists/%s/items:batch' % t[0],
+                                        json=[{'product_id': t[1] * 10 ** 3 + number,
+                                               'product_name': 'new'} for number in range(10)])),
+        Scenario('item', ok, random_items,
+                 lambda s, u, t: s.get(u + '/api/wishlists/%s/items/%s' % t)),
+        Scenario('update-item', ok, random_items,
+                 lambda s, u, t: s.put(u + '/api/wishlists/%s/items/%s' % t,
+                                       json={'product_name': 'renamed'})),
+        Scenario('delete-item', no_content, lambda d, n: d.new_items(n),
+                 lambda s, u, t: s.delete(u + '/api/wishlists/%s/items/%s' % t)),
+        Scenario('add-to-cart', no_content, lambda d, n: d.new_items(n),
+                 lambda s, u, t: s.put(u + '/api/wishlists/%s/items/%s/add-to-cart' % t)),
+        Scenario('add-to-cart-async', (202,), lambda d, n: d.new_items(n),
+                 lambda s, u, t: s.put(u + '/api/wishlists/%s/items/%s/add-to-cart?async=true'
+                                       % t)),
+        Scenario('cart-job', ok, queue_jobs,
+                 lambda s, u, j: s.get(u + '/api/cart-jobs/%s' % j)),
+        Scenario('wishlist-add-to-cart', ok, lambda d, n: d.create_wishlists(n, 5),
+                 lambda s, u, w: s.put(u + '/api/wishlists/%s/add-to-cart' % w)),
+        Scenario('admin-pool', ok, nothing, lambda s, u, _: s.get(u + '/api/admin/pool')),
+        Scenario('admin-caches', ok, nothing, lambda s, u, _: s.get(u + '/api/admin/caches')),
+        Scenario('admin-breakers', ok, nothing,
+                 lambda s, u, _: s.get(u + '/api/admin/breakers')),
+        Scenario('admin-profiles', ok, nothing,
+                 lambda s, u, _: s.get(u + '/api/admin/profiles',
+                                       headers={'X-Profile-Token': os.environ['PROFILE_TOKEN']})),
+        Scenario('metrics', ok, nothing, lambda s, u, _: s.get(u + '/metrics')),
+        # DELETE /api/wishlists/reset would empty the dataset, it isn't benchmarked
+    ]
+
+
+def percentile(latencies, share):
+    """ Returns the nearest-rank percentile of sorted latencies """
+    if not latencies:
+        return None
+    return latencies[max(0, int(math.ceil(share * len(latencies))) - 1)]
+
+
+def run(scenario, url, targets, concurrency):
+    """ Sends a request to each target from `concurrency` threads, returns the results """
+    local = threading.local()
+    latencies = []
+    errors = []
+
+    def send(target):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            resp = scenario.send(local.session, url, target)
+            resp.content    # pylint: disable=pointless-statement
+        except requests.RequestException as error:
+            errors.append(str(error))
+            return
+        latency = time.perf_counter() - start
+        if resp.status_code in scenario.expect:
+            latencies.append(latency)
+        else:
+            errors.append('%s %s' % (resp.status_code, resp.text[:200]))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, targets))
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(targets),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'seconds': round(seconds, 4),
+        'throughput': round(len(latencies) / seconds, 2) if seconds else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+    }
+
+
+@contextmanager
+def service_in_process(log_file):
+    """ Serves the Wishlist service from a thread of this process """
+    # pylint: disable=import-outside-toplevel
+    import logging
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from service import app
+    from service.logs import create_handler
+
+    handlers = list(app.logger.handlers)
+    for handler in handlers:
+        app.logger.removeHandler(handler)
+    handler = create_handler(logging.INFO, log_file)
+    app.logger.addHandler(handler)
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    WSGIRequestHandler.disable_nagle_algorithm = True
+    server = make_server('127.0.0.1', SERVICE_PORT, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%s' % SERVICE_PORT
+    finally:
+        server.shutdown()
+        app.logger.removeHandler(handler)
+        for handler in handlers:
+            app.logger.addHandler(handler)
+
+
+@contextmanager
+def service_under_gunicorn(log_file, workers, threads):
+    """ Serves the Wishlist service with gunicorn, configured by gunicorn_config.py """
+    server = subprocess.Popen([sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+                               '--config', 'gunicorn_config.py',
+                               '--bind', '127.0.0.1:%s' % SERVICE_PORT, 'service:app'],
+                              cwd=ROOT, stdout=log_file, stderr=subprocess.STDOUT,
+                              env=dict(os.environ, WEB_CONCURRENCY=str(workers),
+                                       GUNICORN_THREADS=str(threads)))
+    try:
+        wait_for(SERVICE_PORT, seconds=30)
+        yield 'http://127.0.0.1:%s' % SERVICE_PORT
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def configure_service():
+    """ Points the service at a new SQLite database, unless DATABASE_URI is set, and the fakes """
+    if not os.getenv('DATABASE_URI'):
+        database_fd, database = tempfile.mkstemp(suffix='.db')
+        os.close(database_fd)
+        os.environ['DATABASE_URI'] = 'sqlite:///' + database
+    os.environ['PRODUCT_SERV_URL'] = 'http://127.0.0.1:%s' % PRODUCTS_PORT
+    os.environ['SHOPCART_SERV_URL'] = 'http://127.0.0.1:%s' % SHOPCARTS_PORT
+    # the profiles can only be listed with a token
+    os.environ.setdefault('PROFILE_TOKEN', 'benchmark')
+
+
+def compare(results, baseline, threshold):
+    """ Prints the changes from a baseline, returns the names of the regressed scenarios """
+    regressed = []
+    print('\n%-22s %12s %12s' % ('compared to baseline', 'throughput', 'p99'))
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before or not before.get('throughput') or not result.get('throughput'):
+            continue
+        throughput = (result['throughput'] / before['throughput'] - 1) * 100
+        p99 = (result['p99_ms'] / before['p99_ms'] - 1) * 100 if before['p99_ms'] else 0
+        worse = throughput < -threshold or p99 > threshold
+        if worse:
+            regressed.append(name)
+        print('%-22s %+11.1f%% %+11.1f%%%s' % (name, throughput, p99,
+                                                '  REGRESSED' if worse else ''))
+    return regressed
+
+
+def main():
+    """ Runs the benchmark and prints the results """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--target', choices=('inprocess', 'gunicorn'), default='inprocess')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=1, help='threads of each gunicorn worker')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='requests of each scenario')
+    parser.add_argument('--wishlists', type=int, default=100, help='wishlists to seed')
+    parser.add_argument('--items', type=int, default=20, help='items of each seeded wishlist')
+    parser.add_argument('--only', help='comma separated scenarios to run (default: all)')
+    parser.add_argument('--output', default='load.json', help='JSON file of the results')
+    parser.add_argument('--compare', help='JSON file of the results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='percent of change reported as a regression')
+    args = parser.parse_args()
+
+    scenarios = build_scenarios()
+    if args.only:
+        names = args.only.split(',')
+        unknown = set(names) - {scenario.name for scenario in scenarios}
+        if unknown:
+            parser.error('unknown scenarios: %s' % ', '.join(sorted(unknown)))
+        scenarios = [scenario for scenario in scenarios if scenario.name in names]
+
+    configure_service()
+    log_path = os.path.splitext(args.output)[0] + '.log'
+    results = {}
+    with open(log_path, 'w') as log_file, \
+            running('products', PRODUCTS_PORT), running('shopcarts', SHOPCARTS_PORT):
+        if args.target == 'gunicorn':
+            service = service_under_gunicorn(log_file, args.workers, args.threads)
+        else:
+            service = service_in_process(log_file)
+        with service as url:
+            dataset = Dataset(url)
+            dataset.seed(args.wishlists, args.items)
+            print('%s, %d wishlists of %d items, %d requests from %d threads for each'
+                  % (args.target, args.wishlists, args.items, args.requests, args.concurrency))
+            print('%-22s %8s %7s %10s %9s %9s %9s'
+                  % ('scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+            for scenario in scenarios:
+                targets = scenario.prepare(dataset, args.requests)
+                result = results[scenario.name] = run(scenario, url, targets, args.concurrency)
+                print('%-22s %8d %7d %10s %9s %9s %9s'
+                      % (scenario.name, result['requests'], result['errors'],
+                         result['throughput'], result['p50_ms'], result['p95_ms'],
+                         result['p99_ms']))
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'settings': {name: value for name, value in vars(args).items()
+                         if name not in ('output', 'compare', 'threshold')},
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'results': results,
+        }, output, indent=2, sort_keys=True)
+    print('\nresults written to %s, the logs of the service to %s' % (args.output, log_path))
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressed = compare(results, json.load(baseline)['results'], args.threshold)
+        if regressed:
+            sys.exit('regressed: %s' % ', '.join(regressed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Logging overhead benchmark
+
+Renames a wishlist through the Flask test client with a large request body,
+which the handler logs, and measures the latency of the requests with the
+logs turned off and then written as text or JSON, on the request thread or
+from the queue, and with only a sample of the bodies logged. --write-delay
+makes every write of a log line wait, like STDOUT does when the pipe to the
+log collector is full.
+
+Usage:
+  python benchmarks/logging_overhead.py [--requests 2000] [--body-items 200]
+      [--output FILE] [--write-delay 0.2]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+DATABASE_FD, DATABASE = tempfile.mkstemp(suffix='.db')
+os.close(DATABASE_FD)
+os.environ['DATABASE_URI'] = 'sqlite:///' + DATABASE
+
+from service import app, logs    # pylint: disable=wrong-import-position
+from service.models import Wishlist    # pylint: disable=wrong-import-position
+
+# name, format, queued, share of the bodies logged, characters of a body logged
+SETUPS = [
+    ('off', None, False, 1, 0),
+    ('text', 'text', False, 1, 0),
+    ('json', 'json', False, 1, 0),
+    ('text+queue', 'text', True, 1, 0),
+    ('json+queue', 'json', True, 1, 0),
+    ('sampled', 'json', True, 0.1, 200),
+]
+
+
+class SlowStream():
+    """ A stream whose writes wait `delay` seconds first """
+
+    def __init__(self, stream, delay):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, text):
+        """ Waits, then writes the text """
+        time.sleep(self.delay)
+        return self.stream.write(text)
+
+    def flush(self):
+        """ Flushes the stream """
+        self.stream.flush()
+
+
+def run(client, requests, body, stream, setup):
+    """ Sends the requests logging with a setup and returns their latencies in ms """
+    _, fmt, queued, sample_rate, max_length = setup
+    for handler in list(app.logger.handlers):
+        app.logger.removeHandler(handler)
+    handler = None
+    if fmt is None:
+        app.logger.setLevel(logging.WARNING)
+    else:
+        app.logger.setLevel(logging.INFO)
+        handler = logs.create_handler(logging.INFO, stream, fmt, queued)
+        app.logger.addHandler(handler)
+    logs.LOG_BODY_SAMPLE_RATE = sample_rate
+    logs.LOG_BODY_MAX_LENGTH = max_length
+
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        resp = client.put('/api/wishlists/1', json=body)
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert resp.status_code == 200, resp.status_code
+    if handler is not None:
+        app.logger.removeHandler(handler)
+        handler.close()
+    return sorted(latencies)
+
+
+def main():
+    """ Runs the benchmark and prints the results """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--body-items', type=int, default=200)
+    parser.add_argument('--output', help='where the logs go (default: a temporary file)')
+    parser.add_argument('--write-delay', type=float, default=0,
+                        help='milliseconds each write of a log line waits')
+    args = parser.parse_args()
+
+    output = args.output
+    if output is None:
+        output_fd, output = tempfile.mkstemp(suffix='.log')
+        os.close(output_fd)
+    body = {'name': 'wishlist', 'customer_id': 1,
+            'items': [{'product_id': number, 'product_name': 'product %d' % number}
+                      for number in range(args.body_items)]}
+    Wishlist(name='wishlist', customer_id=1).save()
+    client = app.test_client()
+    run(client, 100, body, None, SETUPS[0])    # warm up
+
+    print('%d requests with a body of %d characters, logs to %s (writes wait %s ms)'
+          % (args.requests, len(str(body)), output, args.write_delay))
+    print('%-12s %10s %10s %10s %12s' % ('logging', 'mean ms', 'p50 ms', 'p99 ms', 'added ms'))
+    baseline = None
+    with open(output, 'w') as stream:
+        if args.write_delay:
+            stream = SlowStream(stream, args.write_delay / 1000)
+        for setup in SETUPS:
+            latencies = run(client, args.requests, body, stream, setup)
+            mean = sum(latencies) / len(latencies)
+            baseline = mean if baseline is None else baseline
+            print('%-12s %10.3f %10.3f %10.3f %12.3f'
+                  % (setup[0], mean, latencies[len(latencies) // 2],
+                     latencies[int(len(latencies) * 0.99)], mean - baseline))
+    os.remove(DATABASE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Model layer microbenchmark
+
+Fills a new SQLite database with each of the --sizes numbers of wishlists,
+of --items items each, and times the serialize() and deserialize() of
+Wishlist and WishlistProduct and the queries of find_by_all(), find_page()
+and items_of() that every request runs. For each it reports the best time
+of a call out of --repeat runs, and with tracemalloc the peak memory a call
+allocates and the memory still held after it returned.
+
+The results are written to a JSON file. --compare reads the results of an
+earlier run and reports the cases whose time or peak memory grew by more
+than --threshold percent, and exits with 1 if there are any.
+
+Usage:
+  python benchmarks/model_layer.py [--sizes 100,1000,10000] [--items 10] [--repeat 5]
+      [--only serialize,find_by_all] [--output model_layer.json]
+      [--compare baseline.json] [--threshold 10]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the service reads its settings when it is imported
+if not os.getenv('DATABASE_URI'):
+    DATABASE_FD, DATABASE = tempfile.mkstemp(suffix='.db')
+    os.close(DATABASE_FD)
+    os.environ['DATABASE_URI'] = 'sqlite:///' + DATABASE
+
+# pylint: disable=wrong-import-position
+from service.models import DB, DatabaseConnection, Wishlist, WishlistProduct
+from service.service import init_db
+
+WISHLISTS_PER_CUSTOMER = 5
+MEMORY_SAMPLES = 20
+
+# prepare(fixture) returns the function called on each run
+Case = namedtuple('Case', 'name prepare')
+
+
+class Fixture():
+    """ The rows of a table size and the instances the cases work on """
+
+    def __init__(self, size, items, seed=42):
+        self.size = size
+        self.items = items
+        self.rand = random.Random(seed)
+        self.wishlist = None    # loaded with its items
+        self.item = None
+
+    def seed(self):
+        """ Fills new tables with `size` wishlists of `items` items each """
+        DB.drop_all()
+        DB.create_all()
+        DB.session.execute(Wishlist.__table__.insert(), [
+            {'id': number, 'customer_id': (number - 1) // WISHLISTS_PER_CUSTOMER + 1,
+             'name': 'wishlist %d' % number, 'version': 1}
+            for number in range(1, self.size + 1)])
+        for start in range(1, self.size + 1, 1000):
+            DB.session.execute(WishlistProduct.__table__.insert(), [
+                {'wishlist_id': wishlist_id, 'product_id': product_id,
+                 'product_name': 'product %d' % product_id}
+                for wishlist_id in range(start, min(start + 1000, self.size + 1))
+                for product_id in range(1, self.items + 1)])
+        DB.session.commit()
+        DB.session.remove()
+        DatabaseConnection.clear_caches()
+        self.wishlist = Wishlist.find(self.wishlist_id(), with_items=True)
+        self.item = self.wishlist.items[0] if self.wishlist.items else \
+            WishlistProduct(wishlist_id=self.wishlist.id, product_id=1, product_name='product 1')
+
+    def wishlist_id(self):
+        """ Returns a random wishlist id """
+        return self.rand.randint(1, self.size)
+
+    def customer_id(self):
+        """ Returns a random customer id """
+        return self.rand.randint(1, (self.size - 1) // WISHLISTS_PER_CUSTOMER + 1)
+
+
+def build_cases():
+    """ Returns the cases, each of them calls the model the way a request does """
+    def serialize_wishlist(fixture):
+        return fixture.wishlist.serialize
+
+    def serialize_wishlist_items(fixture):
+        return lambda: fixture.wishlist.serialize(with_items=True)
+
+    def deserialize_wishlist(fixture):
+        data = fixture.wishlist.serialize()
+        return lambda: Wishlist().deserialize(data)
+
+    def serialize_item(fixture):
+        return fixture.item.serialize
+
+    def deserialize_item(fixture):
+        data = fixture.item.serialize()
+        return lambda: WishlistProduct().deserialize(data)
+
+    def build_query(fixture):
+        customer_id, name = fixture.customer_id(), 'wishlist %d' % fixture.wishlist_id()
+        return lambda: Wishlist.find_by_all(customer_id=customer_id, name=name)
+
+    def find_by_customer(fixture):
+        customer_id = fixture.customer_id()
+        return lambda: Wishlist.find_by_all(customer_id=customer_id).all()
+
+    def find_by_customer_items(fixture):
+        customer_id = fixture.customer_id()
+        return lambda: Wishlist.find_by_all(customer_id=customer_id, with_items=True).all()
+
+    def find_by_name(fixture):
+        name = 'wishlist %d' % fixture.wishlist_id()
+        return lambda: Wishlist.find_by_all(name=name).all()
+
+    def find_items(fixture):
+        wishlist_id = fixture.wishlist_id()
+        return lambda: WishlistProduct.find_by_all(wishlist_id=wishlist_id).all()
+
+    def find_items_by_product(fixture):
+        product_id = fixture.rand.randint(1, max(fixture.items, 1))
+        return lambda: WishlistProduct.find_by_all(product_id=product_id).limit(20).all()
+
+    def find_page(fixture):
+        after_id = fixture.wishlist_id() // 2
+        return lambda: Wishlist.find_page(20, after_id=after_id)
+
+    def items_of(fixture):
+        wishlist_id = fixture.wishlist_id()
+        WishlistProduct.items_of(wishlist_id, 1)
+        return lambda: WishlistProduct.items_of(wishlist_id, 1)
+
+    return [
+        Case('wishlist.serialize', serialize_wishlist),
+        Case('wishlist.serialize-items', serialize_wishlist_items),
+        Case('wishlist.deserialize', deserialize_wishlist),
+        Case('item.serialize', serialize_item),
+        Case('item.deserialize', deserialize_item),
+        Case('find_by_all.build', build_query),
+        Case('find_by_all.customer', find_by_customer),
+        Case('find_by_all.customer-items', find_by_customer_items),
+        Case('find_by_all.name', find_by_name),
+        Case('find_by_all.items', find_items),
+        Case('find_by_all.product', find_items_by_product),
+        Case('find_page', find_page),
+        Case('items_of.cached', items_of),
+    ]
+
+
+def measure(func, repeat):
+    """ Returns the best time of a call and the memory it allocates """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat, number)) / number
+
+    peaks, kept = [], []
+    tracemalloc.start()
+    try:
+        for _ in range(MEMORY_SAMPLES):
+            tracemalloc.clear_traces()
+            result = func()
+            del result
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak)
+            kept.append(current)
+    finally:
+        tracemalloc.stop()
+    return {
+        'calls': number * repeat,
+        'us': round(best * 1e6, 3),
+        'peak_bytes': int(statistics.median(peaks)),
+        'kept_bytes': int(statistics.median(kept)),
+    }
+
+
+def compare(results, baseline, threshold):
+    """ Prints the changes from a baseline, returns the names of the regressed cases """
+    regressed = []
+    print('\n%-36s %10s %10s' % ('compared to baseline', 'time', 'peak'))
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before or not before['us']:
+            continue
+        duration = (result['us'] / before['us'] - 1) * 100
+        peak = (result['peak_bytes'] / before['peak_bytes'] - 1) * 100 \
+            if before['peak_bytes'] else 0
+        worse = duration > threshold or peak > threshold
+        if worse:
+            regressed.append(name)
+        print('%-36s %+9.1f%% %+9.1f%%%s' % (name, duration, peak,
+                                              '  REGRESSED' if worse else ''))
+    return regressed
+
+
+def main():
+    """ Runs the benchmark and prints the results """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='comma separated numbers of wishlists')
+    parser.add_argument('--items', type=int, default=10, help='items of each wishlist')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of each case')
+    parser.add_argument('--only', help='comma separated prefixes of the cases to run')
+    parser.add_argument('--output', default='model_layer.json', help='JSON file of the results')
+    parser.add_argument('--compare', help='JSON file of the results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='percent of change reported as a regression')
+    args = parser.parse_args()
+
+    cases = build_cases()
+    if args.only:
+        prefixes = tuple(args.only.split(','))
+        cases = [case for case in cases if case.name.startswith(prefixes)]
+        if not cases:
+            parser.error('no case starts with %s' % args.only)
+
+    logging.disable(logging.INFO)
+    init_db()
+    results = {}
+    print('%-36s %10s %12s %12s' % ('case', 'us/call', 'peak bytes', 'kept bytes'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        fixture = Fixture(size, args.items)
+        fixture.seed()
+        for case in cases:
+            name = '%s@%d' % (case.name, size)
+            result = results[name] = measure(case.prepare(fixture), args.repeat)
+            print('%-36s %10.2f %12d %12d' % (name, result['us'], result['peak_bytes'],
+                                              result['kept_bytes']))
+    DB.session.remove()
+    DB.drop_all()
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'settings': {name: value for name, value in vars(args).items()
+                         if name not in ('output', 'compare', 'threshold')},
+            'python': platform.python_version(),
+            'database': DB.engine.url.drivername,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'results': results,
+        }, output, indent=2, sort_keys=True)
+    print('\nresults written to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressed = compare(results, json.load(baseline)['results'], args.threshold)
+        if regressed:
+            sys.exit('regressed: %s' % ', '.join(regressed))
+
+
+if __name__ == '__main__':
+    main()
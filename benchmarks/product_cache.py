@@ -0,0 +1,81 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Product cache benchmark
+
+Starts the fake Product service (fakes/products.py) and looks up products
+the way add-to-cart does, first with the cache turned off, then with it on,
+and then as a second worker sharing the first one's backend. Most lookups go
+to a small set of hot products.
+
+Usage:
+  python benchmarks/product_cache.py [--lookups 2000] [--products 1000] [--hot 20]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from downstream import PRODUCTS_PORT, running    # pylint: disable=wrong-import-position
+from service.cache import Cache, MemoryBackend    # pylint: disable=wrong-import-position
+from service.models import Product    # pylint: disable=wrong-import-position
+
+
+def product_ids(lookups, products, hot):
+    """ Returns the products to look up: 90% of them among the hot products """
+    rand = random.Random(42)
+    return [rand.randint(1, hot) if rand.random() < 0.9 else rand.randint(1, products)
+            for _ in range(lookups)]
+
+
+def run(ids, cache):
+    """ Looks up every product with the given cache and returns the seconds taken """
+    Product.cache = cache
+    start = time.perf_counter()
+    for product_id in ids:
+        Product.get_product_details(product_id)
+    return time.perf_counter() - start
+
+
+def main():
+    """ Runs the benchmark and prints the results """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--hot', type=int, default=20)
+    args = parser.parse_args()
+
+    ids = product_ids(args.lookups, args.products, args.hot)
+    with running('products', PRODUCTS_PORT) as url:
+        Product.PRODUCT_SERV_URL = url
+        uncached = run(ids, Cache('product', 0, 60, backend=None))
+        backend = MemoryBackend()
+        cached = run(ids, Cache('product', 1024, 60, backend=backend))
+        cache = Cache('product', 1024, 60, backend=backend)
+        shared = run(ids, cache)
+
+    print('%d lookups of %d products (%d hot)' % (args.lookups, args.products, args.hot))
+    print('%-10s %10s %12s' % ('cache', 'seconds', 'lookups/s'))
+    for name, seconds in [('off', uncached), ('on', cached), ('shared', shared)]:
+        print('%-10s %10.3f %12.0f' % (name, seconds, args.lookups / seconds))
+    print('second worker hit ratio: %(hit_ratio).2f  from the backend: %(shared_hits)d'
+          % cache.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Worker scaling benchmark
+
+Serves the Wishlist service with gunicorn and gunicorn_config.py (preloaded
+app, fork-safe engines) with each of the --workers counts in turn, and runs
+the same scenarios of benchmarks/load.py against each. Reports the
+throughput of each scenario and how many times that of one worker it is.
+
+The workers can only add throughput while there are idle CPUs, and the
+threads sending the requests and the fake services take CPU too: on a
+machine with a single CPU more workers are slower. Run it with at least as
+many CPUs as the largest worker count.
+
+Usage:
+  python benchmarks/scaling.py [--workers 1,2,4] [--concurrency 16] [--requests 400]
+      [--wishlists 100] [--items 20] [--only get,items,add-to-cart] [--output scaling.json]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=wrong-import-position
+from downstream import PRODUCTS_PORT, SHOPCARTS_PORT, running
+from load import Dataset, build_scenarios, configure_service, run, service_under_gunicorn
+
+
+def main():
+    """ Runs the benchmark and prints the results """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=400, help='requests of each scenario')
+    parser.add_argument('--wishlists', type=int, default=100, help='wishlists to seed')
+    parser.add_argument('--items', type=int, default=20, help='items of each seeded wishlist')
+    parser.add_argument('--only', default='get,items,add-to-cart',
+                        help='comma separated scenarios to run')
+    parser.add_argument('--output', default='scaling.json', help='JSON file of the results')
+    args = parser.parse_args()
+
+    names = args.only.split(',')
+    scenarios = [scenario for scenario in build_scenarios() if scenario.name in names]
+    unknown = set(names) - {scenario.name for scenario in scenarios}
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(sorted(unknown)))
+    counts = [int(count) for count in args.workers.split(',')]
+
+    configure_service()
+    log_fd, log_path = tempfile.mkstemp(suffix='.log', prefix='scaling-')
+    results = {}
+    with os.fdopen(log_fd, 'w') as log_file, \
+            running('products', PRODUCTS_PORT), running('shopcarts', SHOPCARTS_PORT):
+        for count in counts:
+            with service_under_gunicorn(log_file, count, 1) as url:
+                dataset = Dataset(url)
+                dataset.seed(args.wishlists, args.items)
+                results[count] = {
+                    scenario.name: run(scenario, url, scenario.prepare(dataset, args.requests),
+                                       args.concurrency)
+                    for scenario in scenarios}
+
+    print('%d CPUs, %d requests from %d threads for each scenario'
+          % (os.cpu_count(), args.requests, args.concurrency))
+    print('%-22s' % 'req/s (speedup)' + ''.join('%18s' % ('%d workers' % count)
+                                                for count in counts))
+    for scenario in scenarios:
+        base = results[counts[0]][scenario.name]['throughput'] or None
+        row = []
+        for count in counts:
+            result = results[count][scenario.name]
+            result['speedup'] = round(result['throughput'] / base, 2) if base else None
+            row.append('%.1f (%sx)%s' % (result['throughput'], result['speedup'],
+                                         ' %d errors' % result['errors']
+                                         if result['errors'] else ''))
+        print('%-22s' % scenario.name + ''.join('%18s' % cell for cell in row))
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'settings': {name: value for name, value in vars(args).items() if name != 'output'},
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'results': results,
+        }, output, indent=2, sort_keys=True)
+    print('\nresults written to %s, the logs of the service to %s' % (args.output, log_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Startup benchmark
+
+Starts a new Python process --runs times for each mode, the way a gunicorn
+worker boots, and measures how long `import service` takes, how long the
+first and the second request to /api/wishlists take after it, and the time
+from starting the process until it answered both. The modes are:
+
+  schema     the worker creates the schema when it starts (DB_CREATE_SCHEMA=true)
+  no-schema  `python -m service.migrate` ran before (DB_CREATE_SCHEMA=false)
+
+The service uses a new SQLite database unless DATABASE_URI is set. SQLite
+answers the DDL at once; with a database over the network, and the import
+of its driver, the difference between the modes is larger.
+
+Usage:
+  python benchmarks/startup.py [--runs 10] [--output startup.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs in the new process, which prints its timings after MARKER; SQLAlchemy
+# imports the dialect of a database, and the driver, when it creates the engine
+MARKER = 'TIMINGS '
+WORKER = '''
+import json, sys, time
+start = time.perf_counter()
+import service
+imported = time.perf_counter()
+driver_loaded = any(name.startswith(('sqlalchemy.dialects.', 'ibm_db_sa'))
+                    for name in sys.modules)
+client = service.app.test_client()
+client.get('/api/wishlists')
+first = time.perf_counter()
+client.get('/api/wishlists')
+second = time.perf_counter()
+print(%r + json.dumps({'import_ms': (imported - start) * 1000,
+                      'first_request_ms': (first - imported) * 1000,
+                      'second_request_ms': (second - first) * 1000,
+                      'driver_loaded_on_import': driver_loaded}), flush=True)
+''' % MARKER
+
+MODES = {'schema': 'true', 'no-schema': 'false'}
+TIMINGS = ('import_ms', 'first_request_ms', 'second_request_ms', 'boot_to_response_ms')
+
+
+def boot(mode, env):
+    """ Starts a worker process in a mode and returns its timings """
+    start = time.perf_counter()
+    worker = subprocess.Popen([sys.executable, '-c', WORKER], cwd=ROOT,
+                              env=dict(env, DB_CREATE_SCHEMA=MODES[mode]),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True)
+    # the boot ends with the timings, after the second response but before the exit
+    for line in worker.stdout:
+        if line.startswith(MARKER):
+            booted = time.perf_counter()
+            timings = json.loads(line[len(MARKER):])
+            break
+    else:
+        raise RuntimeError('the worker exited with %s before answering' % worker.wait())
+    worker.stdout.read()
+    worker.wait()
+    timings['boot_to_response_ms'] = (booted - start) * 1000
+    return timings
+
+
+def summarize(runs):
+    """ Returns the median and the worst of each timing of the runs """
+    summary = {}
+    for timing in TIMINGS:
+        values = [run[timing] for run in runs]
+        summary[timing] = {'median': round(statistics.median(values), 3),
+                           'max': round(max(values), 3)}
+    summary['driver_loaded_on_import'] = any(run['driver_loaded_on_import'] for run in runs)
+    return summary
+
+
+def main():
+    """ Runs the benchmark and prints the results """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='processes started for each mode')
+    parser.add_argument('--output', help='JSON file of the results')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if not env.get('DATABASE_URI'):
+        database_fd, database = tempfile.mkstemp(suffix='.db')
+        os.close(database_fd)
+        env['DATABASE_URI'] = 'sqlite:///' + database
+    subprocess.run([sys.executable, '-m', 'service.migrate'], cwd=ROOT, check=True,
+                   env=dict(env, DB_CREATE_SCHEMA='false'),
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    results = {}
+    for mode in MODES:
+        boot(mode, env)    # warms the file system cache
+        results[mode] = summarize([boot(mode, env) for _ in range(args.runs)])
+
+    print('%d runs of each mode, median (max) in ms' % args.runs)
+    print('%-22s' % 'timing' + ''.join('%22s' % mode for mode in MODES))
+    for timing in TIMINGS:
+        print('%-22s' % timing + ''.join(
+            '%22s' % ('%.1f (%.1f)' % (results[mode][timing]['median'],
+                                       results[mode][timing]['max'])) for mode in MODES))
+    print('%-22s' % 'driver on import' + ''.join(
+        '%22s' % results[mode]['driver_loaded_on_import'] for mode in MODES))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'settings': vars(args), 'python': platform.python_version(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'results': results},
+                      output, indent=2, sort_keys=True)
+        print('\nresults written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
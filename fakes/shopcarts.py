@@ -4,35 +4,64 @@ Fakes for ShopCarts service
 """
 
 import logging
+import os
+import random
 import sys
-from flask import Flask, jsonify, make_response
+from flask import Flask, jsonify, make_response, request
 from flask_api import status    # HTTP Status Codes
+from werkzeug.serving import WSGIRequestHandler
 
 APP = Flask(__name__)
 
-if not APP.debug:
+# share of the requests answered with 503, to test how the service copes with failures
+APP.config['FAILURE_RATE'] = float(os.getenv('FAILURE_RATE', '0'))
+
+
+def setup_logging():
+    """ Logs to STDOUT """
     print('Setting up logging...')
     # Set up default logging for submodules to use STDOUT
     # datefmt='%m/%d/%Y %I:%M:%S %p'
-    FMT = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
-    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=FMT)
+    fmt = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=fmt)
     # Make a new log handler that uses STDOUT
-    HANDLER = logging.StreamHandler(sys.stdout)
-    HANDLER.setFormatter(logging.Formatter(FMT))
-    HANDLER.setLevel(logging.INFO)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(fmt))
+    handler.setLevel(logging.INFO)
     # Remove the Flask default handlers and use our own
-    HANDLER_LIST = list(APP.logger.handlers)
-    for log_handler in HANDLER_LIST:
+    handler_list = list(APP.logger.handlers)
+    for log_handler in handler_list:
         APP.logger.removeHandler(log_handler)
-    APP.logger.addHandler(HANDLER)
+    APP.logger.addHandler(handler)
     APP.logger.setLevel(logging.INFO)
     APP.logger.propagate = False
     APP.logger.info('Logging handler established')
 
+
+def injected_failure():
+    """ Returns a 503 response for FAILURE_RATE of the requests, or None """
+    if random.random() < APP.config['FAILURE_RATE']:
+        return make_response(jsonify(error='Injected failure'),
+                             status.HTTP_503_SERVICE_UNAVAILABLE)
+    return None
+
+
 @APP.route('/shopcarts/<int:customer_id>', methods=['POST'])
 def add_to_shopcart(customer_id):
     """ Fake route for adding item to shopcarts """
     APP.logger.info('Request to add product to shop cart of customer \'%s\'' % customer_id)
+    # read the item so the next request on a kept-alive connection starts clean
+    request.get_json(silent=True)
+    failure = injected_failure()
+    if failure is not None:
+        return failure
     return make_response(jsonify({}), status.HTTP_201_CREATED)
 
-APP.run(host='0.0.0.0', port=5002)
+
+if __name__ == '__main__':
+    if not APP.debug:
+        setup_logging()
+    # keep connections alive like the real service does
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    WSGIRequestHandler.disable_nagle_algorithm = True
+    APP.run(host='0.0.0.0', port=5002)
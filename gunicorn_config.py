@@ -0,0 +1,159 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Gunicorn configuration
+
+Runs as many workers as the CPUs and the memory of the instance allow: two
+per CPU plus one, but no more than fit in its memory next to the master. The
+app is loaded once by the master before forking (preload_app), so the workers
+share its memory and start at once. The connections of the SQLAlchemy engines
+can't be shared by processes, so the master closes them before forking a
+worker and the worker drops the pools it got from the master. Each worker is
+replaced after about GUNICORN_MAX_REQUESTS requests, the jitter keeps them
+from all restarting at the same time.
+
+With more than one worker the Prometheus metrics of the workers are kept in
+PROMETHEUS_MULTIPROC_DIR, a new directory unless it is set.
+
+Start it with:
+  gunicorn --config gunicorn_config.py service:app
+
+Environment:
+------------
+PORT - port to listen on (default: 5000)
+WEB_CONCURRENCY - number of workers (default: from the CPUs and the memory)
+MEMORY_LIMIT - memory of the instance, like 512M, set by Cloud Foundry
+               (default: the limit of the cgroup, or the physical memory)
+GUNICORN_WORKER_MEMORY_MB - memory taken by a worker (default: 100)
+GUNICORN_THREADS - threads of each worker (default: 1)
+GUNICORN_PRELOAD - load the app in the master before forking (default: true)
+GUNICORN_MAX_REQUESTS - requests after which a worker is replaced, 0 for never
+                        (default: 1000)
+GUNICORN_MAX_REQUESTS_JITTER - up to this many more requests, picked at random
+                               for each worker (default: a tenth of them)
+GUNICORN_TIMEOUT - seconds after which a silent worker is killed (default: 30)
+"""
+import math
+import os
+import tempfile
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+# cgroup v1 reports a limit close to 2**63 when there is none
+NO_LIMIT = 2 ** 60
+
+
+def parse_memory(value):
+    """ Returns the bytes of a memory size like 512M or 1G, or None """
+    value = (value or '').strip().upper().rstrip('B')
+    if not value:
+        return None
+    unit = value[-1] if value[-1] in UNITS else ''
+    try:
+        return int(float(value[:len(value) - len(unit)]) * UNITS[unit])
+    except ValueError:
+        return None
+
+
+def read_number(path):
+    """ Returns the number in a file, None if there is no such file or number """
+    try:
+        with open(path) as number_file:
+            return int(number_file.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def cpu_count():
+    """ Returns the CPUs this process may use, with the quota of its cgroup """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:    # cgroup v2
+            quota, period = cpu_max.read().split()
+        quota = None if quota == 'max' else int(quota)
+        period = int(period)
+    except (OSError, ValueError):
+        quota = read_number('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')    # cgroup v1
+        period = read_number('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and quota > 0 and period:
+        cpus = min(cpus, max(1, math.ceil(quota / period)))
+    return cpus
+
+
+def memory_limit():
+    """ Returns the bytes of memory of the instance """
+    limit = parse_memory(os.getenv('MEMORY_LIMIT'))
+    if limit:
+        return limit
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        limit = read_number(path)
+        if limit and limit < NO_LIMIT:
+            return limit
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def workers_for(cpus, memory, worker_memory):
+    """ Returns how many workers to run on `cpus` CPUs in `memory` bytes, at least one """
+    # the master takes about as much memory as a worker
+    return max(1, min(cpus * 2 + 1, memory // worker_memory - 1))
+
+
+# pylint: disable=invalid-name
+bind = '0.0.0.0:%s' % os.getenv('PORT', '5000')
+workers = int(os.getenv('WEB_CONCURRENCY') or workers_for(
+    cpu_count(), memory_limit(), int(os.getenv('GUNICORN_WORKER_MEMORY_MB', '100')) * 1024 ** 2))
+threads = int(os.getenv('GUNICORN_THREADS', '1'))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true') in ['True', 'true', '1']
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', str(max_requests // 10)))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+
+# prometheus_client reads it when the app imports it, after this module
+if workers > 1 and not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='wishlists-metrics-')
+
+
+def when_ready(server):
+    """ Tells how the workers were sized """
+    server.log.info('Starting %s workers of %s threads (%s CPUs, %s MB of memory)', workers,
+                    threads, cpu_count(), memory_limit() // 1024 ** 2)
+
+
+def pre_fork(_server, _worker):
+    """ Closes the database connections of the master, which the worker would share """
+    if preload_app:
+        from service.models import DatabaseConnection    # pylint: disable=import-outside-toplevel
+        DatabaseConnection.dispose()
+
+
+def post_fork(_server, _worker):
+    """ Gives the worker database connection pools of its own """
+    if preload_app:
+        from service.models import DatabaseConnection    # pylint: disable=import-outside-toplevel
+        DatabaseConnection.dispose()
+
+
+def child_exit(_server, worker):
+    """ Drops the live metrics of a worker that exited """
+    # pylint: disable=import-outside-toplevel
+    if preload_app:
+        from service import metrics
+        metrics.worker_exit(worker.pid)
+    elif os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        # without preload_app the master hasn't loaded the app, and needn't for this
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid, os.environ['PROMETHEUS_MULTIPROC_DIR'])
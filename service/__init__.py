@@ -24,18 +24,50 @@ import logging
 
 from flask import Flask
 
+from service.pool import engine_options
+
 # Get configuration from environment
 DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:////tmp/test.db')
+DATABASE_REPLICA_URIS = [uri.strip() for uri in os.getenv('DATABASE_REPLICA_URIS', '').split(',')
+                         if uri.strip()]
+READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', '5'))
 DISABLE_RESET_ENDPOINT = os.getenv('DISABLE_RESET_ENDPOINT', '0') in ['True', 'true', '1']
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '1000'))
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', '500'))
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '1000'))
+CART_WORKERS = int(os.getenv('CART_WORKERS', '8'))
+# the lookups by id are only cached by default when CACHE_URL shares the caches
+FIND_CACHE_SIZE = int(os.getenv('FIND_CACHE_SIZE', '1024' if os.getenv('CACHE_URL') else '0'))
+FIND_CACHE_TTL = float(os.getenv('FIND_CACHE_TTL', '10'))
+# the lists of items are cached for a version read from the database, never stale
+ITEMS_CACHE_SIZE = int(os.getenv('ITEMS_CACHE_SIZE', '1024'))
+QUERY_COUNT_HEADER = os.getenv('QUERY_COUNT_HEADER', '0') in ['True', 'true', '1']
+# false leaves the tables to `python -m service.migrate` and the database
+# connection, with the import of its driver, to the first request
+DB_CREATE_SCHEMA = os.getenv('DB_CREATE_SCHEMA', 'true') in ['True', 'true', '1']
 
 # Create Flask application
 app = Flask(__name__)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(DATABASE_URI)
+app.config['DATABASE_REPLICA_URIS'] = DATABASE_REPLICA_URIS
+app.config['READ_YOUR_WRITES_SECONDS'] = READ_YOUR_WRITES_SECONDS
 app.config['PROPAGATE_EXCEPTIONS'] = True
 app.config['DISABLE_RESET_ENDPOINT'] = DISABLE_RESET_ENDPOINT
 app.config['ERROR_404_HELP'] = False
+app.config['DEFAULT_PAGE_SIZE'] = DEFAULT_PAGE_SIZE
+app.config['MAX_PAGE_SIZE'] = MAX_PAGE_SIZE
+app.config['STREAM_CHUNK_SIZE'] = STREAM_CHUNK_SIZE
+app.config['MAX_BATCH_SIZE'] = MAX_BATCH_SIZE
+app.config['CART_WORKERS'] = CART_WORKERS
+app.config['QUERY_COUNT_HEADER'] = QUERY_COUNT_HEADER
+app.config['FIND_CACHE_SIZE'] = FIND_CACHE_SIZE
+app.config['FIND_CACHE_TTL'] = FIND_CACHE_TTL
+app.config['ITEMS_CACHE_SIZE'] = ITEMS_CACHE_SIZE
+app.config['DB_CREATE_SCHEMA'] = DB_CREATE_SCHEMA
 
 # Import the rutes After the Flask app is created
 from service import service, models
@@ -48,7 +80,7 @@ app.logger.info('  W I S H L I S T   S E R V I C E   R U N N I N G  '.center(70,
 app.logger.info(70 * '*')
 
 try:
-    service.init_db()  # make our sqlalchemy tables
+    service.init_db()  # make our sqlalchemy tables, unless DB_CREATE_SCHEMA is false
 except Exception as error:
     app.logger.critical('%s: Cannot continue', error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
@@ -0,0 +1,164 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Circuit breaker for the downstream services
+
+A CircuitBreaker starts closed and lets every call through. After
+`failure_threshold` failures in a row it opens, and calls fail at once with
+CircuitOpenError instead of waiting on a service that is down. Once
+`reset_timeout` seconds have passed it is half-open: one trial call goes
+through, and closes the circuit if it succeeds or opens it again if it fails.
+
+Exceptions and responses with a 5xx status code are failures. The state of
+each breaker, the times it opened and the calls it turned down are exported
+to Prometheus, labelled with the name of the breaker. The state is exported
+again whenever the metrics are scraped, so a breaker shows half-open once its
+cool-down is over, without waiting for a call.
+
+Environment:
+------------
+BREAKER_FAILURE_THRESHOLD - failures in a row that open the circuit (default: 5)
+BREAKER_RESET_TIMEOUT - seconds the circuit stays open before a trial call (default: 30)
+"""
+import os
+import threading
+import time
+import weakref
+
+from .metrics import BREAKER_OPENED, BREAKER_REJECTED, BREAKER_STATE, before_scrape
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+# the values of the state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# every breaker, to export their state when the metrics are scraped
+BREAKERS = weakref.WeakSet()
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of calling a service while its circuit is open """
+
+
+class CircuitBreaker():
+    """ Fails calls to a service fast while the service keeps failing """
+
+    def __init__(self, name, failure_threshold=None, reset_timeout=None, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold or \
+            int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+        self.reset_timeout = reset_timeout or float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self.opened = 0
+        self.rejected = 0
+        BREAKER_STATE.labels(name).set(STATE_VALUES[CLOSED])
+        BREAKERS.add(self)
+
+    def reset(self):
+        """ Closes the circuit and clears the counters """
+        with self._lock:
+            self._set_state(CLOSED)
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+            self.opened = 0
+            self.rejected = 0
+
+    @property
+    def state(self):
+        """ The state of the circuit: closed, open or half-open """
+        with self._lock:
+            return self._current_state()
+
+    def export_state(self):
+        """ Sets the state gauge, which turns half-open once the cool-down is over """
+        with self._lock:
+            BREAKER_STATE.labels(self.name).set(STATE_VALUES[self._current_state()])
+
+    def _current_state(self):
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._set_state(HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state):
+        if state != self._state:
+            self._state = state
+            BREAKER_STATE.labels(self.name).set(STATE_VALUES[state])
+
+    def call(self, func, *args, **kwargs):
+        """ Calls func unless the circuit is open, and records how the call went """
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._after_call(failed=True)
+            raise
+        status_code = getattr(result, 'status_code', None)
+        self._after_call(failed=isinstance(status_code, int) and status_code >= 500)
+        return result
+
+    def _before_call(self):
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            self.rejected += 1
+            BREAKER_REJECTED.labels(self.name).inc()
+        raise CircuitOpenError('The circuit of the %s service is open' % self.name)
+
+    def _after_call(self, failed):
+        with self._lock:
+            self._trial_running = False
+            if not failed:
+                self._set_state(CLOSED)
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self.opened += 1
+                    BREAKER_OPENED.labels(self.name).inc()
+                self._set_state(OPEN)
+                self._opened_at = self._clock()
+
+    def stats(self):
+        """ Returns the state of the circuit and its counters """
+        with self._lock:
+            return {
+                'state': self._current_state(),
+                'failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'opened': self.opened,
+                'rejected': self.rejected,
+            }
+
+
+def export_states():
+    """ Sets the state gauge of every breaker """
+    for breaker in list(BREAKERS):
+        breaker.export_state()
+
+
+before_scrape(export_states)
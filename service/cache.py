@@ -0,0 +1,463 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Caches
+
+TTLCache keeps at most `maxsize` entries, each for `ttl` seconds, and evicts
+the least recently used entry when it is full. It is safe to share between
+threads and counts its hits and misses.
+
+Cache is a named cache of JSON values for the hot lookups of the models. It
+keeps a TTLCache in each process, and when CACHE_URL names a shared backend,
+it also stores the values there so the other workers find them. Deleting a
+value removes it from the backend and publishes the key, so that every worker
+drops its own copy too. The values of tuple keys are grouped by the first part
+of the key (the wishlist), and the backend keeps the keys of each group, so a
+group is deleted without looking through every key.
+
+A value read from the database while it was being changed must not be cached
+after the change dropped it: the read-through callers take the generation()
+of the cache before reading and pass it to set(), which drops the value when
+anything was deleted in the meantime.
+
+Environment:
+------------
+CACHE_URL - the shared backend: redis://host:port/db for a Redis server (or
+            anything that speaks its protocol), memory:// for a backend shared
+            by the caches of this process only (for tests), unset for none
+CACHE_KEY_PREFIX - prefix of the keys in the shared backend (default: wishlists:)
+CACHE_LOCAL_TTL - seconds a worker keeps its copy of a shared value, in case it
+                  misses an invalidation (default: 5)
+CACHE_LISTEN_RETRY_SECONDS - seconds to wait before listening to the invalidations
+                             again when Redis couldn't be reached (default: 5)
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('flask.app')
+
+# Returned by TTLCache.get() when there is no live entry for the key
+MISSING = object()
+
+
+class TTLCache():
+    """ Bounded LRU cache whose entries expire after a time to live """
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()    # key -> (expires at, value), oldest first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns the value cached for a key, or MISSING """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """ Caches a value for `ttl` seconds (the cache's ttl by default) """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """ Removes the value cached for a key """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """ Removes the values of every key for which predicate(key) is true """
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        """ Removes every value and resets the counters """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """ Returns the size and the hit and miss counters of the cache """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class MemoryBackend():
+    """
+    Shared backend kept in this process
+
+    The caches that use it share their values and invalidations like workers
+    sharing a Redis server, which lets the tests run without one.
+    """
+
+    def __init__(self, maxsize=100000):
+        self._values = TTLCache(maxsize, 0)
+        self._groups = {}
+        self._subscribers = []
+
+    def get(self, key):
+        """ Returns the value stored for a key, or None """
+        value = self._values.get(key)
+        return None if value is MISSING else value
+
+    def set(self, key, value, ttl, group=None):
+        """ Stores a value for `ttl` seconds, as one of a group of keys """
+        self._values.set(key, value, ttl)
+        if group is not None:
+            self._groups.setdefault(group, set()).add(key)
+
+    def delete(self, key):
+        """ Removes the value stored for a key """
+        self._values.delete(key)
+
+    def delete_group(self, group):
+        """ Removes the values of every key of a group """
+        for key in self._groups.pop(group, ()):
+            self._values.delete(key)
+
+    def clear(self, prefix):
+        """ Removes the values of every key that starts with a prefix """
+        self._values.delete_matching(lambda key: key.startswith(prefix))
+        for group in [group for group in self._groups if group.startswith(prefix)]:
+            del self._groups[group]
+
+    def publish(self, message):
+        """ Sends a message to every subscriber """
+        for callback in list(self._subscribers):
+            callback(message)
+
+    def subscribe(self, callback):
+        """ Calls callback(message) for every message published """
+        self._subscribers.append(callback)
+
+
+class RedisBackend():    # pylint: disable=too-many-instance-attributes
+    """
+    Shared backend on a Redis server
+
+    Each process opens its own connections and its own thread listening to
+    the invalidation channel, started again if it dies. When Redis can't be
+    reached the caches carry on without it: reads miss and writes are dropped,
+    and the thread is started again after `retry_seconds`.
+
+    The keys of each group are kept in a Redis set that lives as long as the
+    last value added to it.
+    """
+
+    def __init__(self, url, channel):
+        import redis    # pylint: disable=import-outside-toplevel
+        self._redis = redis
+        self.url = url
+        self.channel = channel
+        self.retry_seconds = float(os.getenv('CACHE_LISTEN_RETRY_SECONDS', '5'))
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._pid = None
+        self._client = None
+        self._listener = None
+        self._listen_at = 0.0
+
+    def client(self):
+        """ Returns the Redis client of this process, listening to the channel """
+        if self._pid == os.getpid() and not self._must_listen():
+            return self._client
+        with self._lock:
+            if self._pid != os.getpid():
+                self._client = self._redis.Redis.from_url(self.url, socket_timeout=0.5,
+                                                          socket_connect_timeout=0.5)
+                self._listener = None
+                self._listen_at = 0.0
+                self._pid = os.getpid()
+            if self._must_listen():
+                self._listen()
+            return self._client
+
+    def _must_listen(self):
+        """ Tells if the listening thread should be started, now """
+        return bool(self._subscribers) \
+            and (self._listener is None or not self._listener.is_alive()) \
+            and time.monotonic() >= self._listen_at
+
+    def _listen(self):
+        """ Starts the thread listening to the channel, or waits to try again """
+        if self._listener is not None:
+            logger.warning('Cache invalidation listener died, starting it again')
+            self._listener = None
+        try:
+            pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._on_message})
+            self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        except self._redis.RedisError as error:
+            logger.warning('Cannot listen to cache invalidations, trying again in %ss: %s',
+                           self.retry_seconds, error)
+            self._listen_at = time.monotonic() + self.retry_seconds
+
+    def _on_message(self, message):
+        data = message['data'].decode('utf-8')
+        for callback in list(self._subscribers):
+            callback(data)
+
+    def _call(self, method, *args, **kwargs):
+        try:
+            return getattr(self.client(), method)(*args, **kwargs)
+        except self._redis.RedisError as error:
+            logger.warning('Cache backend %s failed: %s', method, error)
+            return None
+
+    def get(self, key):
+        """ Returns the value stored for a key, or None """
+        value = self._call('get', key)
+        return None if value is None else value.decode('utf-8')
+
+    def set(self, key, value, ttl, group=None):
+        """ Stores a value for `ttl` seconds, as one of a group of keys """
+        milliseconds = max(int(ttl * 1000), 1)
+        if group is None:
+            self._call('set', key, value, px=milliseconds)
+            return
+        try:
+            pipeline = self.client().pipeline(transaction=False)
+            pipeline.set(key, value, px=milliseconds)
+            pipeline.sadd(group, key)
+            pipeline.pexpire(group, milliseconds)
+            pipeline.execute()
+        except self._redis.RedisError as error:
+            logger.warning('Cache backend set failed: %s', error)
+
+    def delete(self, key):
+        """ Removes the value stored for a key """
+        self._call('delete', key)
+
+    def delete_group(self, group):
+        """ Removes the values of every key of a group """
+        keys = list(self._call('smembers', group) or [])
+        self._call('delete', group)
+        for start in range(0, len(keys), 500):
+            self._call('delete', *keys[start:start + 500])
+
+    def clear(self, prefix):
+        """
+        Removes the values of every key that starts with a prefix
+
+        It scans every key of the server, so it's only for resetting the
+        service and for tests.
+        """
+        pattern = ''.join('[%s]' % char if char in '*?[]\\' else char for char in prefix) + '*'
+        keys = self._call('scan_iter', match=pattern, count=500)
+        try:
+            keys = list(keys or [])
+        except self._redis.RedisError as error:
+            logger.warning('Cache backend scan failed: %s', error)
+            return
+        for start in range(0, len(keys), 500):
+            self._call('delete', *keys[start:start + 500])
+
+    def publish(self, message):
+        """ Sends a message to the workers listening to the channel """
+        self._call('publish', self.channel, message)
+
+    def subscribe(self, callback):
+        """ Calls callback(message) for every message published on the channel """
+        self._subscribers.append(callback)
+        self.client()
+
+
+def backend_from_url(url):
+    """ Returns the shared backend a CACHE_URL names, or None """
+    if not url:
+        return None
+    if url.startswith('memory:'):
+        return MemoryBackend()
+    prefix = os.getenv('CACHE_KEY_PREFIX', 'wishlists:')
+    return RedisBackend(url, prefix + 'invalidate')
+
+
+BACKEND = backend_from_url(os.getenv('CACHE_URL', ''))
+
+
+class Cache():    # pylint: disable=too-many-instance-attributes
+    """
+    A named cache of JSON values, shared between the workers through a backend
+
+    The keys are ints, strings, or tuples of them, grouped by the first part
+    of the tuples. Without a backend it works like a TTLCache of this process.
+    """
+
+    def __init__(self, name, maxsize, ttl, backend=BACKEND, local_ttl=None):
+        # pylint: disable=too-many-arguments
+        self.name = name
+        self.ttl = ttl
+        self.backend = backend
+        self.prefix = os.getenv('CACHE_KEY_PREFIX', 'wishlists:') + name + ':'
+        if backend is not None and local_ttl is None:
+            local_ttl = min(ttl, float(os.getenv('CACHE_LOCAL_TTL', '5')))
+        self.local_ttl = ttl if local_ttl is None else local_ttl
+        self.local = TTLCache(maxsize, self.local_ttl)
+        self.shared_hits = 0
+        self._lock = threading.Lock()
+        self._generation = 0
+        if backend is not None:
+            backend.subscribe(self._on_invalidate)
+
+    @staticmethod
+    def key(key):
+        """ Returns the string of a key """
+        if isinstance(key, tuple):
+            return ':'.join(str(part) for part in key)
+        return str(key)
+
+    def group(self, key):
+        """ Returns the name in the backend of the group of a key, None for no group """
+        if not isinstance(key, tuple):
+            return None
+        return self.prefix + 'group:' + str(key[0])
+
+    def get(self, key):
+        """ Returns the value cached for a key, or MISSING """
+        key = self.key(key)
+        value = self.local.get(key)
+        if value is not MISSING or self.backend is None or self.local.maxsize <= 0:
+            return value
+        data = self.backend.get(self.prefix + key)
+        if data is None:
+            return MISSING
+        with self._lock:
+            self.shared_hits += 1
+        value = json.loads(data)
+        self.local.set(key, value)
+        return value
+
+    def generation(self):
+        """ Returns the number of the last deletion, to pass to set() """
+        return self._generation
+
+    def _deleted(self):
+        with self._lock:
+            self._generation += 1
+
+    def set(self, key, value, ttl=None, generation=None):
+        """
+        Caches a value for `ttl` seconds (the cache's ttl by default)
+
+        With a `generation`, the value isn't cached if anything was deleted since.
+        """
+        if self.local.maxsize <= 0:
+            return
+        group = self.group(key)
+        key = self.key(key)
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self.local.set(key, value, min(ttl, self.local_ttl))
+        if self.backend is not None:
+            self.backend.set(self.prefix + key, json.dumps(value), ttl, group=group)
+            if generation is not None and generation != self._generation:
+                # deleted while it was stored
+                self.backend.delete(self.prefix + key)
+
+    def delete(self, key):
+        """ Removes the value cached for a key from every worker """
+        key = self.key(key)
+        self._deleted()
+        self.local.delete(key)
+        if self.backend is not None:
+            self.backend.delete(self.prefix + key)
+            self.backend.publish(json.dumps({'cache': self.name, 'key': key}))
+
+    def delete_group(self, first):
+        """ Removes the values of every tuple key starting with `first` from every worker """
+        prefix = self.key(first) + ':'
+        self._deleted()
+        self.local.delete_matching(lambda key: key.startswith(prefix))
+        if self.backend is not None:
+            self.backend.delete_group(self.group((first,)))
+            self.backend.publish(json.dumps({'cache': self.name, 'prefix': prefix}))
+
+    def clear(self):
+        """ Removes every value from every worker and resets the counters of this one """
+        self._deleted()
+        self.local.clear()
+        with self._lock:
+            self.shared_hits = 0
+        if self.backend is not None:
+            self.backend.clear(self.prefix)
+            self.backend.publish(json.dumps({'cache': self.name, 'prefix': ''}))
+
+    def _on_invalidate(self, message):
+        """ Drops the copy of a value another worker deleted """
+        try:
+            message = json.loads(message)
+        except ValueError:
+            return
+        if message.get('cache') != self.name:
+            return
+        self._deleted()
+        if 'key' in message:
+            self.local.delete(message['key'])
+        else:
+            prefix = message.get('prefix', '')
+            self.local.delete_matching(lambda key: key.startswith(prefix))
+
+    def __len__(self):
+        return len(self.local)
+
+    def stats(self):
+        """ Returns the size and the hit and miss counters of the cache in this worker """
+        stats = self.local.stats()
+        stats['ttl'] = self.ttl
+        stats['backend'] = type(self.backend).__name__ if self.backend is not None else None
+        if self.backend is not None:
+            # a miss of the local copy that the backend had is a hit
+            stats['shared_hits'] = self.shared_hits
+            stats['hits'] += self.shared_hits
+            stats['misses'] -= self.shared_hits
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
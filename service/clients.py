@@ -0,0 +1,78 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+HTTP clients for the downstream services
+
+Each HTTPClient keeps one requests Session per process, so connections to a
+service are kept alive and reused between requests instead of being opened
+for every call. The session is created again after a fork, because gunicorn
+workers must not share the sockets of their parent.
+
+Environment:
+------------
+HTTP_POOL_SIZE - connections kept alive to each service per worker (default: 10)
+HTTP_CONNECT_TIMEOUT - seconds to wait for a connection (default: 3.05)
+HTTP_READ_TIMEOUT - seconds to wait for a response (default: 10)
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HTTPClient():
+    """ A pooled keep-alive Session per process with connect and read timeouts """
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None):
+        self.pool_size = pool_size or int(os.getenv('HTTP_POOL_SIZE', '10'))
+        self.timeout = (connect_timeout or float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05')),
+                        read_timeout or float(os.getenv('HTTP_READ_TIMEOUT', '10')))
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session = None
+
+    def session(self):
+        """ Returns the Session of this process """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._session = self._new_session()
+                self._pid = os.getpid()
+            return self._session
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get(self, url, **kwargs):
+        """ Sends a GET request with the timeouts of the client """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session().get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """ Sends a POST request with the timeouts of the client """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session().post(url, **kwargs)
+
+    def close(self):
+        """ Closes the connections of this process """
+        with self._lock:
+            if self._session is not None and self._pid == os.getpid():
+                self._session.close()
+            self._session = None
+            self._pid = None
@@ -0,0 +1,154 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Log handlers
+
+create_handler() returns the handler the service logs to STDOUT with. It
+writes each line as text or as a JSON object, and with LOG_QUEUE the request
+threads only put the records on a queue, which a thread of each process
+writes out. log_body() logs the body of a request, or only a sample of them.
+
+Environment:
+------------
+LOG_FORMAT - text or json (default: text)
+LOG_QUEUE - write the logs from a background thread (default: false)
+LOG_BODY_SAMPLE_RATE - share of the request bodies logged, 0 to 1 (default: 1)
+LOG_BODY_MAX_LENGTH - characters of a body logged, 0 for all of them (default: 1000)
+"""
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
+
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_QUEUE = os.getenv('LOG_QUEUE', 'false') in ['True', 'true', '1']
+LOG_BODY_SAMPLE_RATE = float(os.getenv('LOG_BODY_SAMPLE_RATE', '1'))
+LOG_BODY_MAX_LENGTH = int(os.getenv('LOG_BODY_MAX_LENGTH', '1000'))
+
+
+class JSONFormatter(logging.Formatter):
+    """ Formats each record as a JSON object on one line """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+                            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        # a record from the queue only has the text of its exception
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Puts the records on a queue that a thread writes out with another handler
+
+    The thread is started by the first record of each process, so it runs in
+    the workers a server forks after loading the app too. The traceback of a
+    record is queued as text next to its message, not inside it, so the
+    handler of the thread still writes it apart.
+    """
+
+    def __init__(self, handler):
+        super().__init__(queue.Queue(-1))
+        self.handler = handler
+        self._lock = threading.Lock()
+        self._listener = None
+        self._pid = None
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.Queue(-1)
+                    self._listener = QueueListener(self.queue, self.handler,
+                                                   respect_handler_level=True)
+                    self._listener.start()
+                    self._pid = os.getpid()
+        super().enqueue(record)
+
+    def prepare(self, record):
+        """ Returns a copy of the record with its message and traceback as text """
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def close(self):
+        """ Writes out the records left on the queue and stops the thread """
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._pid = None
+        super().close()
+
+
+def create_handler(log_level, stream=None, fmt=None, queued=None):
+    """
+    Returns a handler that writes to a stream (STDOUT by default)
+
+    fmt is 'text' or 'json' and queued writes from a background thread, they
+    default to LOG_FORMAT and LOG_QUEUE.
+    """
+    fmt = LOG_FORMAT if fmt is None else fmt
+    queued = LOG_QUEUE if queued is None else queued
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    handler.setFormatter(JSONFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    handler.setLevel(log_level)
+    if queued:
+        handler = BackgroundHandler(handler)
+        handler.setLevel(log_level)
+        # only the message and the traceback are formatted on the request thread
+        handler.setFormatter(logging.Formatter('%(message)s'))
+    return handler
+
+
+def log_body(logger, body, sample_rate=None, max_length=None):
+    """
+    Logs the body of a request at INFO
+
+    Only a sample_rate share of the bodies is logged, each cut after
+    max_length characters. They default to LOG_BODY_SAMPLE_RATE and
+    LOG_BODY_MAX_LENGTH.
+    """
+    sample_rate = LOG_BODY_SAMPLE_RATE if sample_rate is None else sample_rate
+    max_length = LOG_BODY_MAX_LENGTH if max_length is None else max_length
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    if sample_rate < 1 and random.random() >= sample_rate:
+        return
+    text = str(body)
+    if max_length and len(text) > max_length:
+        text = '%s... (%d characters)' % (text[:max_length], len(text))
+    logger.info('Body: %s', text)
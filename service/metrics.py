@@ -0,0 +1,188 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Prometheus metrics
+
+Counts the requests of each endpoint and method, with their latency, the
+requests in progress and the SQL statements they run, and times the calls to
+the Product and ShopCart services. The endpoints are the names of the
+flask-restplus resources, so there are only a few of each. The circuit
+breakers of the services report their state, how often they opened and how
+many calls they turned down.
+
+The SQL statements of each request are counted too, and with the
+QUERY_COUNT_HEADER setting the response tells how many ran and how long they
+took in the X-Query-Count and X-Query-Time-Ms headers.
+
+With several gunicorn workers each one keeps its own values, so
+PROMETHEUS_MULTIPROC_DIR must name an empty directory the workers share,
+which latest() adds up. Each value is a few bytes of a memory mapped file of
+the worker, updating it takes no system call.
+
+Environment:
+------------
+PROMETHEUS_MULTIPROC_DIR - directory of the values of the workers (default:
+                           none, the values of this process only)
+"""
+import os
+import time
+from functools import wraps
+
+# prometheus_client picks the way it keeps values when it is imported
+if os.getenv('PROMETHEUS_MULTIPROC_DIR') and not os.getenv('prometheus_multiproc_dir'):
+    os.environ['prometheus_multiproc_dir'] = os.environ['PROMETHEUS_MULTIPROC_DIR']
+
+# pylint: disable=wrong-import-position
+from flask import current_app, g, has_request_context, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter,
+                               Gauge, Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+MULTIPROCESS = bool(os.getenv('prometheus_multiproc_dir'))
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+REQUESTS = Counter('wishlists_http_requests_total', 'Requests answered',
+                   ['endpoint', 'method', 'status'])
+REQUEST_LATENCY = Histogram('wishlists_http_request_duration_seconds',
+                            'Time taken to answer the requests', ['endpoint', 'method'])
+IN_PROGRESS = Gauge('wishlists_http_requests_in_progress', 'Requests being answered',
+                    ['endpoint', 'method'], multiprocess_mode='livesum')
+QUERIES = Counter('wishlists_db_queries_total', 'SQL statements run', ['endpoint'])
+QUERY_LATENCY = Histogram('wishlists_db_query_duration_seconds', 'Time taken by the SQL statements',
+                          ['endpoint'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1,
+                                                 .25, .5, 1, 2.5, float('inf')))
+DOWNSTREAM_LATENCY = Histogram('wishlists_downstream_request_duration_seconds',
+                               'Time taken by the calls to the Product and ShopCart services',
+                               ['service', 'status'])
+# one value per live worker, max without (pid) is the worst state of any
+BREAKER_STATE = Gauge('wishlists_breaker_state',
+                      'State of the circuit breakers: 0 closed, 1 half-open, 2 open',
+                      ['breaker'], multiprocess_mode='liveall')
+BREAKER_OPENED = Counter('wishlists_breaker_opened_total', 'Times the circuit breakers opened',
+                         ['breaker'])
+BREAKER_REJECTED = Counter('wishlists_breaker_rejected_total',
+                           'Calls the circuit breakers turned down while open', ['breaker'])
+
+
+def current_endpoint():
+    """ Returns the endpoint of the request being answered, 'none' outside of a request """
+    if not has_request_context():
+        return 'none'
+    return request.endpoint or 'unmatched'
+
+
+def start_request():
+    """ Counts a request in progress (call before each request) """
+    labels = (current_endpoint(), request.method)
+    g.metrics = (labels, time.perf_counter())
+    g.query_count, g.query_seconds = 0, 0.0
+    IN_PROGRESS.labels(*labels).inc()
+
+
+def record_status(response):
+    """ Remembers the status of the response (call after each request) """
+    g.metrics_status = response.status_code
+    return response
+
+
+def add_query_headers(response):
+    """ Adds the SQL statements the request ran to the response, with QUERY_COUNT_HEADER """
+    if current_app.config.get('QUERY_COUNT_HEADER'):
+        response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+        response.headers['X-Query-Time-Ms'] = '%.3f' % (g.get('query_seconds', 0.0) * 1000)
+    return response
+
+
+def finish_request():
+    """ Counts a request answered (call when each request is torn down) """
+    metrics = g.pop('metrics', None)
+    if metrics is None:
+        return
+    labels, start = metrics
+    IN_PROGRESS.labels(*labels).dec()
+    REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - start)
+    REQUESTS.labels(*labels, g.pop('metrics_status', 500)).inc()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, *_args):
+    """ Notes when a statement starts """
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_query(conn, *_args):
+    """ Counts a statement run, against the endpoint it ran for """
+    started = conn.info.get('metrics_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    endpoint = current_endpoint()
+    QUERIES.labels(endpoint).inc()
+    QUERY_LATENCY.labels(endpoint).observe(elapsed)
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+        g.query_seconds = g.get('query_seconds', 0.0) + elapsed
+
+
+@event.listens_for(Engine, 'handle_error')
+def forget_query(context):
+    """ Forgets when a statement that failed started """
+    if context.connection is not None and context.connection.info.get('metrics_started'):
+        context.connection.info['metrics_started'].pop()
+
+
+def downstream(service):
+    """ Times the calls of a function to a service, by status of the response """
+    def decorator(func):
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                response = func(*args, **kwargs)
+                outcome = getattr(response, 'status_code', 'error')
+                return response
+            finally:
+                DOWNSTREAM_LATENCY.labels(service, outcome).observe(time.perf_counter() - start)
+        return timed
+    return decorator
+
+
+# called by latest() to update the values that change with time alone
+SCRAPE_HOOKS = []
+
+
+def before_scrape(hook):
+    """ Calls hook() every time the metrics are scraped """
+    SCRAPE_HOOKS.append(hook)
+
+
+def latest():
+    """ Returns the metrics of every worker in the text format of Prometheus """
+    for hook in SCRAPE_HOOKS:
+        hook()
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def worker_exit(pid):
+    """ Drops the live values of a worker that exited (gunicorn child_exit hook) """
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
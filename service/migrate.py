@@ -0,0 +1,46 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Schema migration
+
+Creates the tables of the service, and the columns and indexes that tables
+created by an earlier version are missing. The web processes do it when they
+start unless DB_CREATE_SCHEMA is false, which is faster to scale out; run
+this once before starting them instead:
+  DB_CREATE_SCHEMA=false python -m service.migrate
+
+Exits with 4 when the database can't be migrated, like a web process that
+can't start.
+"""
+import logging
+import sys
+
+from service.models import DatabaseConnection
+
+logger = logging.getLogger('flask.app')
+
+
+def main():
+    """ Brings the schema of the database up to date """
+    try:
+        DatabaseConnection.create_schema()
+    except Exception as error:    # pylint: disable=broad-except
+        logger.critical('%s: Cannot migrate the database', error)
+        sys.exit(4)
+    logger.info('Database schema is up to date')
+
+
+if __name__ == '__main__':
+    main()
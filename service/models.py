@@ -26,6 +26,7 @@ Wishlist Attributes:
 id (integer) - the id of the wishlist.
 customer_id (integer) - the id of the customer to whom the wishlist belongs
 name (string) - the name of the wishlist.
+version (integer) - bumped whenever the wishlist or one of its products changes.
 
 Model
 ------
@@ -37,46 +38,224 @@ Wishlist Product Attributes:
 wishlist_id(integer) - the wishlist id.
 product_id (integer) - the product id.
 
+Model
+------
+Cart Job - A request to move a Wishlist Product to the cart, waiting in the outbox for the
+worker
+
+Cart Job Attributes:
+-------------
+id (integer) - the id of the job.
+wishlist_id (integer), product_id (integer) - the Wishlist Product to move.
+customer_id (integer) - the customer whose cart gets the product.
+status (string) - pending, running, done or failed.
+attempts (integer) - how many times the worker tried to move the product.
 
 """
 import logging
 import os
+import sqlite3
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from flask_sqlalchemy import SQLAlchemy
-from werkzeug.exceptions import NotFound, InternalServerError
+from flask import has_request_context
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm import make_transient_to_detached, selectinload
+from werkzeug.exceptions import HTTPException, NotFound, InternalServerError, \
+    ServiceUnavailable
 from flask_api import status    # HTTP Status Codes
 
 from . import app
+from .breaker import CircuitBreaker, CircuitOpenError
+from .cache import MISSING, Cache
+from .clients import HTTPClient
+from .metrics import downstream
+from .pool import pool_status
+from .replicas import REPLICAS, RoutingSession, RoutingSQLAlchemy, current_replica, \
+    wrote_recently
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-DB = SQLAlchemy(app)
+# GET handlers can read from the replicas in DATABASE_REPLICA_URIS
+DB = RoutingSQLAlchemy(app)
 logger = logging.getLogger('flask.app')
 
+# Wishlist.find() and WishlistProduct.find() read through these caches of rows.
+# Without a shared CACHE_URL each process has its own, so another process may
+# see a change up to FIND_CACHE_TTL seconds late, and FIND_CACHE_SIZE is 0 (off)
+# by default. A client that wrote recently always reads the rows from the database.
+FIND_CACHE_SIZE = app.config['FIND_CACHE_SIZE']
+FIND_CACHE_TTL = app.config['FIND_CACHE_TTL']
+
+
+def find_through_cache(cls, cache, identity):
+    """
+    Returns the instance of a model with a primary key, or None
+
+    The instance is built from the row in the cache when there is one and
+    merged into the session without a query, otherwise it is loaded and its
+    row is cached. Rows read from a replica are not cached, they may be older
+    than the primary's. The cache is left alone for a client that wrote within
+    the read-your-writes window, another worker may not have dropped the row yet.
+    """
+    key = inspect(cls).identity_key_from_primary_key(
+        identity if isinstance(identity, tuple) else (identity,))
+    in_session = DB.session.identity_map.get(key)
+    if in_session is not None:
+        return in_session
+    if has_request_context() and wrote_recently():
+        return cls.query.get(identity)
+    generation = cache.generation()
+    row = cache.get(identity)
+    if row is not MISSING:
+        instance = cls(**row)
+        make_transient_to_detached(instance)
+        return DB.session.merge(instance, load=False)
+    instance = cls.query.get(identity)
+    if instance is not None and current_replica() is None:
+        cache.set(identity, {column.key: getattr(instance, column.key)
+                             for column in cls.__table__.columns}, generation=generation)
+    return instance
+
+
+@event.listens_for(Engine, 'connect')
+def enforce_foreign_keys(dbapi_connection, _connection_record):
+    """ Turns on the foreign keys of each SQLite connection, which ignores them otherwise """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+def invalidate_on_commit(invalidate):
+    """ Calls invalidate() once the running transaction commits """
+    DB.session.info.setdefault('invalidate', []).append(invalidate)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def run_invalidations(session):
+    """ Drops the cached rows the committed transaction changed """
+    for invalidate in session.info.pop('invalidate', []):
+        invalidate()
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_invalidations(session):
+    """ Keeps the cached rows when the transaction that changed them rolled back """
+    session.info.pop('invalidate', None)
+
+
 class DatabaseConnection():
     """ Handles the connection to a database """
     @classmethod
-    def init(cls):
-        """ Initializes the database session """
+    def init(cls, create_schema=True):
+        """
+        Initializes the database session, and the schema with create_schema
+
+        Without the schema nothing connects to the database until the first query.
+        """
         logger.info('Initializing database')
         # This is where we initialize SQLAlchemy from the Flask app
         DB.init_app(app)
         app.app_context().push()
+        if create_schema:
+            cls.create_schema()
+
+    @classmethod
+    def create_schema(cls):
+        """ Creates the missing tables, and the missing columns and indexes of existing ones """
         DB.create_all()  # make our sqlalchemy tables
+        cls.create_columns()
+        cls.create_indexes()
+        cls.check_autoincrement()
+
+    @classmethod
+    def create_columns(cls):
+        """ Adds the columns missing from tables that already existed """
+        inspector = inspect(DB.engine)
+        for table in DB.metadata.sorted_tables:
+            existing = set(column['name'] for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in existing:
+                    logger.info('Adding column %s.%s', table.name, column.name)
+                    DB.engine.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                        table.name, CreateColumn(column).compile(dialect=DB.engine.dialect)))
+
+    @classmethod
+    def create_indexes(cls):
+        """ Creates the indexes missing from tables that already existed """
+        inspector = inspect(DB.engine)
+        for table in DB.metadata.sorted_tables:
+            existing = set(index['name'] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    logger.info('Creating index %s', index.name)
+                    index.create(DB.engine)
+
+    @classmethod
+    def check_autoincrement(cls):
+        """
+        Warns about the SQLite tables that existed before they were AUTOINCREMENT
+
+        SQLite can't add it to a table, so they keep giving the ids of deleted
+        rows again until they are created again.
+        """
+        if DB.engine.dialect.name != 'sqlite':
+            return
+        for table in DB.metadata.sorted_tables:
+            if not table.dialect_options['sqlite']['autoincrement']:
+                continue
+            sql = DB.engine.execute("SELECT sql FROM sqlite_master WHERE type = 'table' "
+                                    "AND name = ?", table.name).scalar()
+            if sql is not None and 'AUTOINCREMENT' not in sql.upper():
+                logger.warning('Table %s was created without AUTOINCREMENT and reuses the ids '
+                               'of deleted rows, create it again to stop it', table.name)
+
+    @classmethod
+    def pool_status(cls):
+        """ Returns the state of the connection pool of the database """
+        return pool_status(DB.engine.pool)
 
     @classmethod
     def disconnect(cls):
         """ Disconnect from the database """
         logger.info('Disconnecting from the database')
         DB.session.remove()
+        REPLICAS.dispose()
+
+    @classmethod
+    def dispose(cls):
+        """
+        Closes the pooled connections to the database and its replicas
+
+        The engines open new ones when they need them. Call it before and after
+        forking, so that the processes don't share connections.
+        """
+        DB.session.remove()
+        DB.engine.dispose()
+        REPLICAS.dispose()
+
+    @classmethod
+    def clear_caches(cls):
+        """ Empties the caches of the lookups by primary key """
+        Wishlist.find_cache.clear()
+        WishlistProduct.find_cache.clear()
+        WishlistProduct.list_cache.clear()
 
     @classmethod
     def reset_db(cls):
-        """ Resets the database (use for testing)  """
+        """ Resets the database (use for testing), which also empties the caches """
         DB.session.remove()
         DB.drop_all()
         DB.create_all()
 
+@event.listens_for(DB.metadata, 'after_drop')
+def clear_caches_after_drop(*_args, **_kwargs):
+    """ Forgets the cached rows of dropped tables """
+    DatabaseConnection.clear_caches()
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
     pass
@@ -92,9 +271,26 @@ class Wishlist(DB.Model):
     id = DB.Column(DB.Integer, primary_key=True)
     customer_id = DB.Column(DB.Integer)
     name = DB.Column(DB.String(50))
-
-    # Relationship to be added (in order to retreive the items of a wishlist)
-    # items = DB.relationship('WishlistProduct')
+    # bumped by every write to the wishlist or its items, it is the ETag of both
+    version = DB.Column(DB.Integer, nullable=False, default=1, server_default='1')
+
+    find_cache = Cache('wishlist', FIND_CACHE_SIZE, FIND_CACHE_TTL)
+
+    # (customer_id, name) also serves the lookups by customer_id alone. The ids
+    # of deleted wishlists are never given again, not even by SQLite, since
+    # (id, version) is the ETag and the key of the cached items. Only new SQLite
+    # tables get this, check_autoincrement() warns about the old ones.
+    __table_args__ = (
+        DB.Index('ix_wishlist_customer_id_name', 'customer_id', 'name'),
+        DB.Index('ix_wishlist_name', 'name'),
+        {'sqlite_autoincrement': True},
+    )
+
+    # The items of the wishlist, only loaded when asked for. Items that aren't
+    # loaded are removed by the ON DELETE CASCADE of the foreign key, which
+    # SQLite enforces once enforce_foreign_keys() turned it on.
+    items = DB.relationship('WishlistProduct', order_by='WishlistProduct.product_id',
+                            cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return '<Wishlist %r>' % (self.name)
@@ -106,19 +302,111 @@ class Wishlist(DB.Model):
         logger.info('Saving %s', self.name)
         if not self.id:
             DB.session.add(self)
+        else:
+            self.version = Wishlist.version + 1
+            Wishlist.invalidate(self.id)
+        DB.session.commit()
+
+    @classmethod
+    def save_all(cls, wishlists):
+        """
+        Saves a batch of new Wishlists to the data store in a single transaction
+
+        The ids are assigned in the order of the list. Databases that return
+        the inserted rows get them all with a single INSERT, the others (SQLite,
+        Db2) with an INSERT for each.
+        """
+        logger.info('Saving %s wishlists', len(wishlists))
+        dialect = DB.engine.dialect
+        if not (wishlists and dialect.implicit_returning and dialect.supports_multivalues_insert):
+            DB.session.bulk_save_objects(wishlists, return_defaults=True)
+            DB.session.commit()
+            return
+        for wishlist in wishlists:
+            wishlist.version = wishlist.version or 1
+        result = DB.session.execute(cls.__table__.insert().values(
+            [{'customer_id': wishlist.customer_id, 'name': wishlist.name,
+              'version': wishlist.version} for wishlist in wishlists]).returning(cls.id))
+        # the ids come from a sequence, in the order of the rows
+        for wishlist, wishlist_id in zip(wishlists, sorted(row[0] for row in result)):
+            wishlist.id = wishlist_id
         DB.session.commit()
 
+    @classmethod
+    def touch(cls, wishlist_id):
+        """ Bumps the version of a Wishlist in the running transaction """
+        DB.session.query(cls).filter(cls.id == wishlist_id) \
+            .update({cls.version: cls.version + 1}, synchronize_session=False)
+        cls.invalidate(wishlist_id)
+
+    @classmethod
+    def invalidate(cls, wishlist_id):
+        """ Drops the cached row of a Wishlist when the running transaction commits """
+        invalidate_on_commit(lambda: cls.find_cache.delete(wishlist_id))
+
+    @classmethod
+    def version_of(cls, wishlist_id):
+        """ Returns the version of a Wishlist without loading it, or None if it doesn't exist """
+        return DB.session.query(cls.version).filter(cls.id == wishlist_id).scalar()
+
     def delete(self):
         """ Removes a Wishlist from the data store """
         logger.info('Deleting %s', self.name)
         DB.session.delete(self)
+        wishlist_id = self.id
+        Wishlist.invalidate(wishlist_id)
+        # the products go with it
+        invalidate_on_commit(lambda: WishlistProduct.find_cache.delete_group(wishlist_id))
+        invalidate_on_commit(lambda: WishlistProduct.list_cache.delete_group(wishlist_id))
         DB.session.commit()
 
-    def serialize(self):
-        """ Serializes a Wishlist into a dictionary """
-        return {"id": self.id,
+    def add_to_cart(self, max_workers):
+        """
+        Moves every item of the wishlist to the cart of its customer
+
+        The items are moved concurrently on up to `max_workers` threads, and the
+        ones that made it to the cart are deleted from the wishlist together.
+        Returns the result of each item, so one failure doesn't stop the rest.
+        """
+        customer_id, wishlist_id = self.customer_id, self.id
+        product_ids = [item.product_id for item in self.items]
+        if not product_ids:
+            return []
+        logger.info('Moving %d items of Wishlist %s to the cart', len(product_ids), wishlist_id)
+
+        def move(product_id):
+            try:
+                WishlistProduct.move_to_cart(customer_id, wishlist_id, product_id)
+            except HTTPException as error:
+                logger.warning('Cannot move Product %s to the cart: %s', product_id,
+                               error.description)
+                return {'product_id': product_id, 'status': 'failed', 'code': error.code,
+                        'message': error.description}
+            except Exception as error:    # pylint: disable=broad-except
+                # anything else must not keep the moved items in the wishlist
+                logger.exception('Cannot move Product %s to the cart', product_id)
+                code = status.HTTP_502_BAD_GATEWAY \
+                    if isinstance(error, requests.exceptions.RequestException) \
+                    else status.HTTP_500_INTERNAL_SERVER_ERROR
+                return {'product_id': product_id, 'status': 'failed', 'code': code,
+                        'message': str(error) or error.__class__.__name__}
+            return {'product_id': product_id, 'status': 'moved', 'code': status.HTTP_200_OK}
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(product_ids))) as executor:
+            results = list(executor.map(move, product_ids))
+
+        WishlistProduct.delete_all(wishlist_id, [result['product_id'] for result in results
+                                                 if result['status'] == 'moved'])
+        return results
+
+    def serialize(self, with_items=False):
+        """ Serializes a Wishlist into a dictionary, optionally with its items """
+        data = {"id": self.id,
                 "name": self.name,
                 "customer_id": self.customer_id}
+        if with_items:
+            data["items"] = [item.serialize() for item in self.items]
+        return data
 
     def deserialize(self, data):
         """
@@ -131,10 +419,11 @@ class Wishlist(DB.Model):
             self.name = data['name']
             self.customer_id = data['customer_id']
         except KeyError as error:
-            raise DataValidationError('Invalid wishlist: missing ' + error.args[0])
+            raise DataValidationError('Invalid wishlist: missing ' + error.args[0]) \
+                from error
         except TypeError as error:
             raise DataValidationError('Invalid wishlist: body of request contained' \
-                                      'bad or no data')
+                                      'bad or no data') from error
         return self
 
     @classmethod
@@ -143,14 +432,21 @@ class Wishlist(DB.Model):
         return cls.query.all()
 
     @classmethod
-    def find(cls, wishlist_id):
-        """ Finds a Wishlist by it's ID """
+    def find(cls, wishlist_id, with_items=False):
+        """ Finds a Wishlist by it's ID, optionally loading its items at once """
         logger.info('Processing lookup for id %s ...', wishlist_id)
-        return cls.query.get(wishlist_id)
+        if with_items:
+            return cls.query.options(selectinload(cls.items)).get(wishlist_id)
+        return find_through_cache(cls, cls.find_cache, wishlist_id)
 
     @classmethod
-    def find_by_all(cls, wishlist_id=None, name=None, customer_id=None):
-        """ Returns wishlists of the given id, name, and customer_id """
+    def find_by_all(cls, wishlist_id=None, name=None, customer_id=None, with_items=False):
+        """
+        Returns wishlists of the given id, name, and customer_id
+
+        With with_items the items of all the wishlists are loaded by a single
+        extra query instead of one query per wishlist.
+        """
         queries = []
 
         if wishlist_id:
@@ -162,7 +458,35 @@ class Wishlist(DB.Model):
         if name:
             queries.append(cls.name == name)
 
-        return cls.query.filter(*queries)
+        query = cls.query.filter(*queries)
+        if with_items:
+            query = query.options(selectinload(cls.items))
+        return query
+
+    @classmethod
+    def find_after(cls, after_id=None, **filters):
+        """ Returns the wishlists matching the filters after the given id, ordered by id """
+        query = cls.find_by_all(**filters)
+        if after_id:
+            query = query.filter(cls.id > after_id)
+        return query.order_by(cls.id)
+
+    @classmethod
+    def find_page(cls, limit, after_id=None, **filters):
+        """
+        Returns a page of at most `limit` wishlists matching the filters and the
+        id to continue from (None on the last page)
+
+        The primary key is used as the cursor, so every page costs the same no
+        matter how deep into the table it is.
+        """
+        wishlists = cls.find_after(after_id, **filters).limit(limit + 1).all()
+
+        next_after_id = None
+        if len(wishlists) > limit:
+            wishlists = wishlists[:limit]
+            next_after_id = wishlists[-1].id
+        return wishlists, next_after_id
 
 class WishlistProduct(DB.Model):
     """
@@ -178,6 +502,17 @@ class WishlistProduct(DB.Model):
     product_name = DB.Column(DB.String(64), nullable=False)
     # product_price = DB.Column(DB.Numeric(10,2))
 
+    # product_id is only the second column of the primary key
+    __table_args__ = (
+        DB.Index('ix_wishlist_product_product_id', 'product_id'),
+        DB.Index('ix_wishlist_product_product_name', 'product_name'),
+    )
+
+    find_cache = Cache('wishlist_product', FIND_CACHE_SIZE, FIND_CACHE_TTL)
+    # the items of a wishlist by (wishlist_id, version): a write bumps the
+    # version, so the lists never need to be invalidated
+    list_cache = Cache('wishlist_items', app.config['ITEMS_CACHE_SIZE'], FIND_CACHE_TTL)
+
     def __repr__(self):
         return '<Wishlist Product %r>' % (self.product_id)
 
@@ -187,16 +522,130 @@ class WishlistProduct(DB.Model):
         """
         logger.info('Saving product {} in wishlist {}'.\
                                     format(self.product_id, self.wishlist_id))
-        if DB.session.query(WishlistProduct).filter_by(wishlist_id=self.wishlist_id,\
-                                                       product_id=self.product_id).count() == 0:
+        state = inspect(self)
+        if state.persistent:
+            # already in the data store, only the changes need to be flushed
+            Wishlist.touch(self.wishlist_id)
+            WishlistProduct.invalidate(self.wishlist_id, [self.product_id])
+            DB.session.commit()
+            return
+
+        Wishlist.touch(self.wishlist_id)
+
+        upsert = self.upsert_statement()
+        if upsert is None:
+            if DB.session.query(WishlistProduct).filter_by(wishlist_id=self.wishlist_id,\
+                                                   product_id=self.product_id).count() == 0:
+                DB.session.add(self)
+            DB.session.commit()
+            return
+
+        DB.session.execute(upsert, [self.row()])
+        DB.session.commit()
+        # keep using this instance as the persistent one, like add() would
+        make_transient_to_detached(self)
+        if DB.session.identity_map.get(state.key) is None:
             DB.session.add(self)
+
+    @classmethod
+    def save_all(cls, wishlist_id, wishlist_products):
+        """
+        Saves a batch of Products in a Wishlist in a single transaction
+
+        Products already in the Wishlist (or repeated in the batch) are skipped,
+        and so are the ones another request added since they were looked up.
+        Returns the list of the Wishlist Products that were created.
+        """
+        logger.info('Saving %s products in wishlist %s', len(wishlist_products), wishlist_id)
+        product_ids = [wishlist_product.product_id for wishlist_product in wishlist_products]
+        present = set(product_id for (product_id,) in DB.session.query(cls.product_id)\
+                      .filter(cls.wishlist_id == wishlist_id, cls.product_id.in_(product_ids)))
+
+        created = []
+        for wishlist_product in wishlist_products:
+            if wishlist_product.product_id not in present:
+                present.add(wishlist_product.product_id)
+                created.append(wishlist_product)
+
+        if created:
+            inserted = cls.insert_missing([wishlist_product.row() for wishlist_product in created])
+            created = [wishlist_product for wishlist_product in created
+                       if wishlist_product.product_id in inserted]
+        if created:
+            Wishlist.touch(wishlist_id)
         DB.session.commit()
+        return created
+
+    @classmethod
+    def insert_missing(cls, rows):
+        """
+        Inserts the rows of the Products of a Wishlist that aren't in the data store
+
+        Returns the product ids of the rows it inserted. Where the database can
+        return the inserted rows they are inserted by a single statement,
+        elsewhere by one statement each, which tells if it inserted its row.
+        """
+        dialect = DB.engine.dialect.name
+        if dialect == 'postgresql' or \
+                (dialect == 'sqlite' and sqlite3.sqlite_version_info >= (3, 35)):
+            values, params = [], {}
+            for position, row in enumerate(rows):
+                values.append('(:wishlist_id{0}, :product_id{0}, :product_name{0})'
+                              .format(position))
+                params.update({'%s%s' % (name, position): value for name, value in row.items()})
+            result = DB.session.execute(
+                'INSERT INTO wishlist_product (wishlist_id, product_id, product_name) '
+                'VALUES %s ON CONFLICT (wishlist_id, product_id) DO NOTHING '
+                'RETURNING product_id' % ', '.join(values), params)
+            return set(product_id for (product_id,) in result)
+        upsert = cls.upsert_statement()
+        if upsert is None:
+            # without an upsert a concurrent insert fails the transaction
+            DB.session.execute(cls.__table__.insert(), rows)
+            return set(row['product_id'] for row in rows)
+        return set(row['product_id'] for row in rows if DB.session.execute(upsert, row).rowcount)
+
+    @classmethod
+    def upsert_statement(cls):
+        """
+        Returns a single INSERT statement that skips the Wishlist Products
+        already in the data store, or None if the database has no such statement
+        """
+        return UPSERT_STATEMENTS.get(DB.engine.dialect.name)
+
+    def row(self):
+        """ Returns the column values of a Wishlist Product """
+        return {'wishlist_id': self.wishlist_id, 'product_id': self.product_id,
+                'product_name': self.product_name}
 
     def delete(self):
         """ Removes a Wishlist Product from the data store """
         logger.info('Deleting Product %s in Wishlist %s', self.product_id, self.wishlist_id)
         DB.session.delete(self)
+        Wishlist.touch(self.wishlist_id)
+        WishlistProduct.invalidate(self.wishlist_id, [self.product_id])
+        DB.session.commit()
+
+    @classmethod
+    def delete_all(cls, wishlist_id, product_ids):
+        """ Removes some Products of a Wishlist from the data store in one transaction """
+        if not product_ids:
+            return
+        logger.info('Deleting %d Products in Wishlist %s', len(product_ids), wishlist_id)
+        cls.query.filter(cls.wishlist_id == wishlist_id, cls.product_id.in_(product_ids)) \
+            .delete(synchronize_session=False)
+        Wishlist.touch(wishlist_id)
+        cls.invalidate(wishlist_id, product_ids)
         DB.session.commit()
+        DB.session.expire_all()
+
+    @classmethod
+    def invalidate(cls, wishlist_id, product_ids):
+        """ Drops the cached rows of Products of a Wishlist when the running transaction commits """
+        def invalidate():
+            for product_id in product_ids:
+                cls.find_cache.delete((wishlist_id, product_id))
+        invalidate_on_commit(invalidate)
 
     def serialize(self):
         """ Serializes a Wishlist-Product into a dictionary """
@@ -217,10 +666,11 @@ class WishlistProduct(DB.Model):
             self.product_name = data['product_name']
             # self.product_price = data['product_price']
         except KeyError as error:
-            raise DataValidationError('Invalid Wishlist-Product: missing ' + error.args[0])
+            raise DataValidationError('Invalid Wishlist-Product: missing ' + error.args[0]) \
+                from error
         except TypeError as error:
             raise DataValidationError('Invalid Wishlist-Product: body of request contained' \
-                                      'bad or no data')
+                                      'bad or no data') from error
         return self
 
     @classmethod
@@ -234,7 +684,22 @@ class WishlistProduct(DB.Model):
 
         logger.info('Processing lookup for product {} in wishlist \
                         {}...'.format(product_id, wishlist_id))
-        return cls.query.get((wishlist_id, product_id))
+        return find_through_cache(cls, cls.find_cache, (wishlist_id, product_id))
+
+    @classmethod
+    def items_of(cls, wishlist_id, version):
+        """
+        Returns the serialized items of a Wishlist at a version
+
+        The list is cached, except when it is read from a replica.
+        """
+        generation = cls.list_cache.generation()
+        items = cls.list_cache.get((wishlist_id, version))
+        if items is MISSING:
+            items = [item.serialize() for item in cls.find_by_all(wishlist_id=wishlist_id)]
+            if current_replica() is None:
+                cls.list_cache.set((wishlist_id, version), items, generation=generation)
+        return items
 
     @classmethod
     def find_by_all(cls, wishlist_id=None, product_id=None, product_name=None):
@@ -253,11 +718,21 @@ class WishlistProduct(DB.Model):
 
     def add_to_cart(self, customer_id):
         """ Adds an item from the wishlist to the cart. Deletes from the wishlist. """
-        resp_get_product = Product.get_product_details(self.product_id)
+        WishlistProduct.move_to_cart(customer_id, self.wishlist_id, self.product_id)
+
+    @staticmethod
+    def move_to_cart(customer_id, wishlist_id, product_id):
+        """
+        Adds a product of a wishlist to the cart of a customer
+
+        Only calls the Product and ShopCart services and never touches the
+        database, so it can run in another thread than the request.
+        """
+        resp_get_product = Product.get_product_details(product_id)
 
         if resp_get_product.status_code == status.HTTP_404_NOT_FOUND:
             raise NotFound("Product with id '{}' was not found in Wishlist \
-                            with id '{}'.".format(self.product_id, self.wishlist_id))
+                            with id '{}'.".format(product_id, wishlist_id))
 
         if resp_get_product.status_code != status.HTTP_200_OK:
             raise InternalServerError("Internal Server error in processing Add to cart")
@@ -274,27 +749,207 @@ class WishlistProduct(DB.Model):
         if product_price == -1:
             raise InternalServerError('Unable to fetch price for product')
 
-        resp_add_to_cart = ShopCart.add_to_cart(customer_id, self.product_id, product_price,
+        resp_add_to_cart = ShopCart.add_to_cart(customer_id, product_id, product_price,
                                                 product_name)
 
         if resp_add_to_cart.status_code != status.HTTP_200_OK \
             and resp_add_to_cart.status_code != status.HTTP_201_CREATED:
             raise InternalServerError('Unable to add product to cart')
 
+class CartJob(DB.Model):
+    """
+    Class that represents a request to move a Wishlist Product to the cart
+
+    The jobs are an outbox: the service only writes them, and the worker
+    (service.worker) claims them in batches, calls the Product and ShopCart
+    services and removes the product from the wishlist once it is in the cart.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    # Table Schema
+    id = DB.Column(DB.Integer, primary_key=True)
+    wishlist_id = DB.Column(DB.Integer, nullable=False)
+    product_id = DB.Column(DB.Integer, nullable=False)
+    customer_id = DB.Column(DB.Integer, nullable=False)
+    status = DB.Column(DB.String(16), nullable=False, default=PENDING)
+    attempts = DB.Column(DB.Integer, nullable=False, default=0)
+    last_error = DB.Column(DB.String(255))
+    # when the job may be claimed: after a retry delay, or when the lease of a
+    # worker that died while running it runs out
+    available_at = DB.Column(DB.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = DB.Column(DB.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = DB.Column(DB.DateTime, nullable=False, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        DB.Index('ix_cart_job_status_available_at', 'status', 'available_at'),
+    )
+
+    def __repr__(self):
+        return '<Cart Job %r>' % (self.id)
+
+    def serialize(self):
+        """ Serializes a Cart Job into a dictionary """
+        return {"id": self.id,
+                "wishlist_id": self.wishlist_id,
+                "product_id": self.product_id,
+                "customer_id": self.customer_id,
+                "status": self.status,
+                "attempts": self.attempts,
+                "last_error": self.last_error,
+                "created_at": self.created_at,
+                "updated_at": self.updated_at}
+
+    @classmethod
+    def enqueue(cls, customer_id, wishlist_id, product_id):
+        """ Adds a job to move a Wishlist Product to the cart of a customer """
+        job = cls(customer_id=customer_id, wishlist_id=wishlist_id, product_id=product_id)
+        DB.session.add(job)
+        DB.session.commit()
+        logger.info('Queued job %s to move product %s in wishlist %s to the cart',
+                    job.id, product_id, wishlist_id)
+        return job
+
+    @classmethod
+    def find(cls, job_id):
+        """ Finds a Cart Job by it's ID """
+        return cls.query.get(job_id)
+
+    @classmethod
+    def claim(cls, batch_size, lease_seconds):
+        """
+        Claims up to `batch_size` jobs that are due, oldest first
+
+        A job stays claimed for `lease_seconds`. If the worker hasn't finished
+        it by then, another worker may claim it again. Each job is claimed with
+        a conditional UPDATE so that two workers never both get it.
+        """
+        now = datetime.utcnow()
+        due = (cls.status.in_([cls.PENDING, cls.RUNNING]), cls.available_at <= now)
+        job_ids = [job_id for job_id, in DB.session.query(cls.id).filter(*due)
+                   .order_by(cls.id).limit(batch_size)]
+        claimed = []
+        for job_id in job_ids:
+            if cls.query.filter(cls.id == job_id, *due).update(
+                    {cls.status: cls.RUNNING, cls.attempts: cls.attempts + 1,
+                     cls.available_at: now + timedelta(seconds=lease_seconds),
+                     cls.updated_at: now},
+                    synchronize_session=False):
+                claimed.append(job_id)
+        DB.session.commit()
+        if not claimed:
+            return []
+        return cls.query.filter(cls.id.in_(claimed)).order_by(cls.id).all()
+
+    def complete(self):
+        """ Removes the moved product from the wishlist and marks the job done, together """
+        WishlistProduct.query.filter_by(wishlist_id=self.wishlist_id,
+                                        product_id=self.product_id) \
+            .delete(synchronize_session=False)
+        Wishlist.touch(self.wishlist_id)
+        WishlistProduct.invalidate(self.wishlist_id, [self.product_id])
+        self.status = self.DONE
+        self.last_error = None
+        DB.session.commit()
+
+    def retry(self, error, delay_seconds):
+        """ Puts the job back in the outbox to be tried again in `delay_seconds` """
+        self.status = self.PENDING
+        self.last_error = error[:255]
+        self.available_at = datetime.utcnow() + timedelta(seconds=delay_seconds)
+        DB.session.commit()
+
+    def fail(self, error):
+        """ Gives up on the job """
+        self.status = self.FAILED
+        self.last_error = error[:255]
+        DB.session.commit()
+
+# Inserts of a Wishlist Product that do nothing when it's already there, by dialect
+_ON_CONFLICT_DO_NOTHING = text(
+    'INSERT INTO wishlist_product (wishlist_id, product_id, product_name) '
+    'VALUES (:wishlist_id, :product_id, :product_name) '
+    'ON CONFLICT (wishlist_id, product_id) DO NOTHING')
+_MERGE_WHEN_NOT_MATCHED = text(
+    'MERGE INTO wishlist_product AS t USING (VALUES (CAST(:wishlist_id AS INTEGER), '
+    'CAST(:product_id AS INTEGER), CAST(:product_name AS VARCHAR(64)))) '
+    'AS s (wishlist_id, product_id, product_name) '
+    'ON t.wishlist_id = s.wishlist_id AND t.product_id = s.product_id '
+    'WHEN NOT MATCHED THEN INSERT (wishlist_id, product_id, product_name) '
+    'VALUES (s.wishlist_id, s.product_id, s.product_name)')
+UPSERT_STATEMENTS = {
+    'sqlite': _ON_CONFLICT_DO_NOTHING,
+    'postgresql': _ON_CONFLICT_DO_NOTHING,
+    'ibm_db_sa': _MERGE_WHEN_NOT_MATCHED,
+}
+
+class CachedResponse():
+    """ The parts of a Product service response kept in the cache """
+
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Returns the response a dict from to_dict() holds """
+        return cls(data['status_code'], data['body'])
+
+    def to_dict(self):
+        """ Returns the response as a dict, which the cache can store """
+        return {'status_code': self.status_code, 'body': self.body}
+
+    def json(self):
+        """ Returns the body of the response, like requests.Response.json() """
+        return self.body
+
+
 class Product():
     """Wrapper for all interactions with Product Service"""
     PRODUCT_SERV_URL = os.getenv('PRODUCT_SERV_URL', 'http://127.0.0.1:5001')
+    http = HTTPClient()
+    breaker = CircuitBreaker('Products')
 
     @classmethod
+    @downstream('products')
     def _get_product_details(cls, product_id):
         """ Invokes Product service to get product details """
-        return requests.get('%s/products/%s' % (cls.PRODUCT_SERV_URL, product_id))
+        return cls.http.get('%s/products/%s' % (cls.PRODUCT_SERV_URL, product_id))
+
+    # product details are cached for PRODUCT_CACHE_TTL seconds, unknown products
+    # for PRODUCT_CACHE_NEGATIVE_TTL seconds; PRODUCT_CACHE_SIZE=0 turns it off
+    NEGATIVE_TTL = float(os.getenv('PRODUCT_CACHE_NEGATIVE_TTL', '10'))
+    cache = Cache('product', int(os.getenv('PRODUCT_CACHE_SIZE', '1024')),
+                  float(os.getenv('PRODUCT_CACHE_TTL', '60')))
 
     @classmethod
     def get_product_details(cls, product_id):
-        """ Gets Product details """
+        """ Gets Product details, from the cache when they were looked up recently """
+        cached = cls.cache.get(product_id)
+        if cached is not MISSING:
+            return CachedResponse.from_dict(cached)
+        response = cls._fetch_product_details(product_id)
+        if response.status_code == status.HTTP_200_OK:
+            try:
+                cls.cache.set(product_id,
+                              CachedResponse(response.status_code, response.json()).to_dict())
+            except ValueError:
+                pass    # not JSON: let the caller deal with it, but don't keep it
+        elif response.status_code == status.HTTP_404_NOT_FOUND:
+            cls.cache.set(product_id, CachedResponse(response.status_code).to_dict(),
+                          ttl=cls.NEGATIVE_TTL)
+        return response
+
+    @classmethod
+    def _fetch_product_details(cls, product_id):
+        """ Gets Product details from the Product service """
         try:
-            return Product._get_product_details(product_id)
+            return cls.breaker.call(Product._get_product_details, product_id)
+        except CircuitOpenError:
+            raise ServiceUnavailable("Products service is unavailable")
         except requests.exceptions.HTTPError:
             raise InternalServerError("Internal Server error in getting product details")
         except requests.exceptions.ConnectionError:
@@ -309,11 +964,14 @@ class Product():
 class ShopCart():
     """Wrapper for all interactions with ShopCart Service"""
     SHOPCART_SERV_URL = os.getenv('SHOPCART_SERV_URL', 'http://127.0.0.1:5002')
+    http = HTTPClient()
+    breaker = CircuitBreaker('ShopCarts')
 
     @classmethod
+    @downstream('shopcarts')
     def _add_to_cart(cls, customer_id, product_id, product_price, product_name):
         """ Invokes ShopCarts service to add an item from the wishlist to the cart """
-        return requests.post('%s/shopcarts/%s' % (cls.SHOPCART_SERV_URL, customer_id), json={
+        return cls.http.post('%s/shopcarts/%s' % (cls.SHOPCART_SERV_URL, customer_id), json={
             'product_id': product_id,
             'customer_id': customer_id,
             'quantity': 1,
@@ -325,7 +983,10 @@ class ShopCart():
     def add_to_cart(cls, customer_id, product_id, product_price, product_name):
         """ Adds an item from the wishlist to the cart """
         try:
-            return ShopCart._add_to_cart(customer_id, product_id, product_price, product_name)
+            return cls.breaker.call(ShopCart._add_to_cart, customer_id, product_id,
+                                    product_price, product_name)
+        except CircuitOpenError:
+            raise ServiceUnavailable("ShopCarts service is unavailable")
         except requests.exceptions.HTTPError:
             raise InternalServerError("Internal Server error in processing Add to cart")
         except requests.exceptions.ConnectionError:
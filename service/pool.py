@@ -0,0 +1,124 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Database connection pool
+
+Engine options for the SQLAlchemy connection pool taken from the environment,
+and a QueuePool that keeps statistics of how long checkouts wait so the pool
+can be sized for each gunicorn worker.
+
+Environment:
+------------
+DB_POOL_SIZE - connections kept open in the pool (SQLAlchemy default: 5)
+DB_MAX_OVERFLOW - connections allowed on top of the pool size (default: 10)
+DB_POOL_TIMEOUT - seconds to wait for a connection before failing (default: 30)
+DB_POOL_RECYCLE - seconds after which a connection is replaced (default: 1800)
+DB_POOL_PRE_PING - test connections when they are checked out (default: true)
+"""
+import os
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+def engine_options(database_uri):
+    """ Returns the SQLAlchemy engine options for the pool of a database """
+    if database_uri.startswith('sqlite'):
+        # SQLite connections are not pooled by Flask-SQLAlchemy
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true') in ['True', 'true', '1'],
+    }
+    for option, variable in [('pool_size', 'DB_POOL_SIZE'),
+                             ('max_overflow', 'DB_MAX_OVERFLOW'),
+                             ('pool_timeout', 'DB_POOL_TIMEOUT')]:
+        if os.getenv(variable):
+            options[option] = int(os.getenv(variable))
+    return options
+
+
+class CheckoutStats():
+    """ Counts checkouts from a pool and the time they spent waiting """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait, timed_out=False):
+        """ Records a checkout that waited `wait` seconds """
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += int(timed_out)
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def as_dict(self):
+        """ Returns the statistics as a dictionary """
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': round(self.wait_total, 6),
+                'wait_seconds_max': round(self.wait_max, 6),
+                'wait_seconds_avg': round(self.wait_total / self.checkouts, 6) \
+                                    if self.checkouts else 0.0,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout takes
+
+    The time includes waiting for a free connection and opening a new one
+    when the pool is allowed to grow.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.checkout_stats = CheckoutStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+        except PoolTimeoutError:
+            self.checkout_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.checkout_stats.record(time.perf_counter() - start)
+        return connection
+
+
+def pool_status(pool):
+    """ Returns the state of a connection pool as a dictionary """
+    status = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'idle': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow,
+        })
+    if isinstance(pool, TimedQueuePool):
+        status.update(pool.checkout_stats.as_dict())
+    return status
@@ -0,0 +1,171 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Request profiler
+
+ProfilerMiddleware runs cProfile for the requests that send the
+X-Profile-Token header with the PROFILE_TOKEN, and for a PROFILE_SAMPLE_RATE
+share of the others. The stats of the last PROFILE_BUFFER_SIZE profiled
+requests of each worker are kept in a ProfileBuffer, and the response of a
+profiled request tells its id in the X-Profile-Id header.
+
+When neither is set a request costs the middleware one comparison, and
+cProfile and pstats aren't even imported.
+
+Environment:
+------------
+PROFILE_TOKEN - secret that a request sends in X-Profile-Token to be profiled
+                (default: none, the header is ignored)
+PROFILE_SAMPLE_RATE - share of the requests profiled, 0 to 1 (default: 0)
+PROFILE_BUFFER_SIZE - profiles kept by each worker (default: 20)
+"""
+import hmac
+import io
+import itertools
+import marshal
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+TOKEN_HEADER = 'HTTP_X_PROFILE_TOKEN'
+# downloading the profiles doesn't push them out of the buffer
+EXCLUDED_PATHS = ('/api/admin/profiles',)
+
+
+class ProfileBuffer():
+    """ The last `size` profiles, oldest first """
+
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._profiles = OrderedDict()    # id -> (summary, marshalled stats)
+
+    def next_id(self):
+        """ Returns the id of the next profile """
+        return next(self._ids)
+
+    def add(self, summary, stats):
+        """ Keeps the stats of a request, dropping the oldest profile when it is full """
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._profiles[summary['id']] = (summary, marshal.dumps(stats))
+            while len(self._profiles) > self.size:
+                self._profiles.popitem(last=False)
+
+    def summaries(self):
+        """ Returns the summaries of the profiles, newest first """
+        with self._lock:
+            return [summary for summary, _ in reversed(self._profiles.values())]
+
+    def stats(self, profile_id):
+        """ Returns the stats of a profile in the pstats file format, or None """
+        with self._lock:
+            profile = self._profiles.get(profile_id)
+        return None if profile is None else profile[1]
+
+    def report(self, profile_id, sort='cumulative', limit=50):
+        """ Returns the stats of a profile as text, or None """
+        data = self.stats(profile_id)
+        if data is None:
+            return None
+        import pstats    # pylint: disable=import-outside-toplevel
+        stream = io.StringIO()
+        stats = pstats.Stats(Marshalled(data), stream=stream)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def clear(self):
+        """ Forgets every profile """
+        with self._lock:
+            self._profiles.clear()
+
+
+class Marshalled():
+    """ Stats in the pstats file format, which pstats.Stats can load """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, data):
+        self.stats = marshal.loads(data)
+
+    def create_stats(self):
+        """ The stats are already there """
+
+
+class ProfilerMiddleware():
+    """ WSGI middleware that profiles the requests asking for it and a sample of the others """
+
+    def __init__(self, wsgi_app, buffer, token=None, sample_rate=None):
+        self.wsgi_app = wsgi_app
+        self.buffer = buffer
+        self.token = os.getenv('PROFILE_TOKEN') if token is None else token
+        self.sample_rate = float(os.getenv('PROFILE_SAMPLE_RATE', '0')) \
+            if sample_rate is None else sample_rate
+
+    def authorized(self, environ):
+        """ Returns True when the request sent the profile token """
+        sent = environ.get(TOKEN_HEADER)
+        return bool(self.token and sent) and hmac.compare_digest(sent, self.token)
+
+    def trigger(self, environ):
+        """ Returns why to profile a request, or None """
+        if environ.get('PATH_INFO', '').startswith(EXCLUDED_PATHS):
+            return None
+        if self.authorized(environ):
+            return 'token'
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return 'sample'
+        return None
+
+    def __call__(self, environ, start_response):
+        trigger = self.trigger(environ) if self.token or self.sample_rate > 0 else None
+        if trigger is None:
+            return self.wsgi_app(environ, start_response)
+
+        profile_id = self.buffer.next_id()
+        response_status = []
+
+        def start_profiled_response(status, headers, exc_info=None):
+            response_status.append(int(status.split(' ', 1)[0]))
+            headers.append(('X-Profile-Id', str(profile_id)))
+            return start_response(status, headers, exc_info)
+
+        import cProfile    # pylint: disable=import-outside-toplevel
+        profile = cProfile.Profile()
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            return profile.runcall(self.wsgi_app, environ, start_profiled_response)
+        finally:
+            duration = time.perf_counter() - start
+            profile.create_stats()
+            self.buffer.add({
+                'id': profile_id,
+                'method': environ.get('REQUEST_METHOD'),
+                'path': environ.get('PATH_INFO'),
+                'query': environ.get('QUERY_STRING', ''),
+                'status': response_status[0] if response_status else None,
+                'trigger': trigger,
+                'started_at': started_at,
+                'duration_ms': round(duration * 1000, 3),
+                'pid': os.getpid(),
+            }, profile.stats)
+
+
+# the profiles of this worker
+PROFILES = ProfileBuffer(int(os.getenv('PROFILE_BUFFER_SIZE', '20')))
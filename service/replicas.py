@@ -0,0 +1,137 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Read replica routing
+
+When DATABASE_REPLICA_URIS lists one or more read replicas, the handlers
+wrapped with use_replica run their queries on a replica chosen round-robin,
+while everything else (and every flush) stays on the primary database.
+
+A client that wrote something less than READ_YOUR_WRITES_SECONDS ago is sent
+to the primary for its reads too, so it never sees data older than its own
+writes. The time of the last write is kept in the LAST_WRITE_COOKIE cookie,
+which is also set when FIND_CACHE_SIZE caches rows in each worker: such a
+client reads the rows from the database rather than from the cache.
+"""
+import itertools
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm
+
+from .pool import engine_options
+
+LAST_WRITE_COOKIE = 'wishlists_last_write'
+
+# the replica engine used by the handler running in this thread, if any
+_current = threading.local()
+
+
+class ReplicaSet():
+    """ The engines of the read replicas, handed out round-robin """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._uris = ()
+        self._engines = []
+        self._cycle = None
+
+    def engines(self):
+        """ Returns the engines of the replicas configured in the app """
+        uris = tuple(current_app.config['DATABASE_REPLICA_URIS'])
+        with self._lock:
+            if uris != self._uris:
+                self._dispose()
+                self._uris = uris
+                self._engines = [create_engine(uri, **engine_options(uri)) for uri in uris]
+                self._cycle = itertools.cycle(self._engines)
+            return list(self._engines)
+
+    def choose(self):
+        """ Returns the engine of the next replica, or None without replicas """
+        if not self.engines():
+            return None
+        with self._lock:
+            return next(self._cycle)
+
+    def dispose(self):
+        """ Closes the connections of every replica """
+        with self._lock:
+            self._dispose()
+
+    def _dispose(self):
+        for engine in self._engines:
+            engine.dispose()
+
+
+REPLICAS = ReplicaSet()
+
+
+def current_replica():
+    """ Returns the replica engine chosen for the running handler, if any """
+    return getattr(_current, 'engine', None)
+
+
+def wrote_recently():
+    """ Tells whether the client of the request wrote within the read-your-writes window """
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+    except ValueError:
+        return False
+    return time.time() - last_write < current_app.config['READ_YOUR_WRITES_SECONDS']
+
+
+def use_replica(func):
+    """ Runs the queries of a read-only handler on a read replica """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        _current.engine = None if wrote_recently() else REPLICAS.choose()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.engine = None
+    return wrapper
+
+
+def remember_write(response):
+    """ Marks the client of a successful write so its next reads go to the primary """
+    if request.method in ('POST', 'PUT', 'DELETE') and response.status_code < 400 \
+            and (current_app.config['DATABASE_REPLICA_URIS']
+                 or current_app.config['FIND_CACHE_SIZE']):
+        window = int(math.ceil(current_app.config['READ_YOUR_WRITES_SECONDS']))
+        response.set_cookie(LAST_WRITE_COOKIE, '%.3f' % time.time(), max_age=window,
+                            httponly=True)
+    return response
+
+
+class RoutingSession(SignallingSession):
+    """ Session that runs the queries of read-only handlers on a replica """
+
+    def get_bind(self, mapper=None, clause=None):
+        engine = current_replica()
+        if engine is not None and not self._flushing:
+            return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with sessions that can read from replicas """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -18,29 +18,47 @@ Wishlist Service
 Paths:
 ------
 GET / - Displays a UI for Selenium testing
-GET /wishlists - Returns a list all of the Wishlists
-GET /wishlists/{id} - Returns the Properties of the selected Wishlist
+GET /wishlists - Returns a page of the Wishlists (?limit=&after_id=&expand=items)
+GET /wishlists/{id} - Returns the Properties of the selected Wishlist (?expand=items)
 GET /wishlists/{id}/items - Returns a list of all Items inside a Wishlist
+    (the GETs of a Wishlist and its Items send an ETag and answer If-None-Match with 304)
 GET /wishlists/{id}/items/{id} - Returns the Properties of the selected Product
 POST /wishlists - creates a new Wishlists record in the database
+POST /wishlists:batch - creates a Wishlist for each entry of an array
 POST /wishlists/{id}/items - adds a new Product to the Wishlist
+POST /wishlists/{id}/items:batch - adds every Product of an array to the Wishlist
 PUT /wishlists/{id} - updates a Wishlist record in the database
 PUT /wishlists/{id}/items/{id} - updates a Product record in the database
 DELETE /wishlists/{id} - deletes a Wishlist record in the database
 DELETE /wishlists/{id}/items/{id} - deletes a Product record in the database
-PUT /wishlists/{id}/items/{id}/add-to-cart - adds to Cart Product
+PUT /wishlists/{id}/items/{id}/add-to-cart - adds to Cart Product (?async=true to queue it)
+GET /cart-jobs/{id} - Returns the status of a Product queued for the Cart
+PUT /wishlists/{id}/add-to-cart - moves every Product of the Wishlist to the Cart
+GET /admin/pool - Returns the statistics of the database connection pool
+GET /admin/caches - Returns the statistics of the caches
+GET /admin/breakers - Returns the state of the circuit breakers of the downstream services
+GET /admin/profiles - Returns the requests profiled by this worker
+GET /admin/profiles/{id} - Returns the cProfile stats of a request (?format=text for a report)
+GET /metrics - Returns the metrics of the service in the text format of Prometheus
 """
 
 import atexit
-import sys
 import logging
+import json
+from urllib.parse import urlencode
 
-from flask import jsonify, request, make_response, abort
+from flask import Response, jsonify, request, make_response, abort, stream_with_context
 from flask_api import status    # HTTP Status Codes
-from flask_restplus import Api, Resource, fields, reqparse
+from flask_restplus import Api, Resource, fields, inputs, reqparse
 from werkzeug.exceptions import NotFound
-
-from service.models import Wishlist, WishlistProduct, DataValidationError, DatabaseConnection
+from werkzeug.http import quote_etag
+
+from service.models import Wishlist, WishlistProduct, Product, ShopCart, CartJob, \
+    DataValidationError, DatabaseConnection
+from service import metrics
+from service.logs import create_handler, log_body
+from service.profiler import PROFILES, ProfilerMiddleware
+from service.replicas import use_replica, remember_write
 # Import Flask application
 from . import app
 
@@ -49,14 +67,32 @@ from . import app
 wishlist_args = reqparse.RequestParser()
 wishlist_args.add_argument('id', type=int, required=False, help='List Wishlists by id')
 wishlist_args.add_argument('name', type=str, required=False, help='List Wishlists by name')
-wishlist_args.add_argument('customer_id', type=str, required=False, help='List Wishlists by \
+wishlist_args.add_argument('customer_id', type=int, required=False, help='List Wishlists by \
                                                                           customer id')
+wishlist_args.add_argument('limit', type=int, required=False,
+                           help='Maximum number of Wishlists to return')
+wishlist_args.add_argument('after_id', type=int, required=False,
+                           help='Return Wishlists with an id greater than this one')
+wishlist_args.add_argument('stream', type=inputs.boolean, required=False, default=False,
+                           help='Stream every matching Wishlist instead of a single page')
+wishlist_args.add_argument('expand', type=str, required=False, choices=('items',),
+                           help='Include the items of each Wishlist')
+
+wishlist_expand_args = reqparse.RequestParser()
+wishlist_expand_args.add_argument('expand', type=str, required=False, choices=('items',),
+                                  help='Include the items of the Wishlist')
 
 wishlist_item_args = reqparse.RequestParser()
 wishlist_item_args.add_argument('product_id', type=int, required=False,
                                 help='List Wishlists Item by Product id')
 wishlist_item_args.add_argument('product_name', type=str, required=False,
                                 help='List Wishlist Item by Product name')
+wishlist_item_args.add_argument('stream', type=inputs.boolean, required=False, default=False,
+                                help='Stream the Wishlist Items as they are read')
+
+add_to_cart_args = reqparse.RequestParser()
+add_to_cart_args.add_argument('async', type=inputs.boolean, required=False, default=False,
+                              help='Queue the item for the worker and return at once')
 
 ######################################################################
 # Error Handlers
@@ -75,6 +111,35 @@ def bad_request(error):
                    error='Bad Request',
                    message=message), status.HTTP_400_BAD_REQUEST
 
+@app.after_request
+def after_write(response):
+    """ Sends the reads that follow a write to the primary database """
+    return remember_write(response)
+
+@app.before_request
+def before_metrics():
+    """ Counts the request in progress """
+    metrics.start_request()
+
+@app.after_request
+def after_metrics(response):
+    """ Remembers the status of the response for the metrics """
+    return metrics.record_status(response)
+
+@app.after_request
+def after_queries(response):
+    """ Tells how many SQL statements the request ran, with QUERY_COUNT_HEADER """
+    return metrics.add_query_headers(response)
+
+@app.teardown_request
+def teardown_metrics(_error):
+    """ Counts the request answered, with its latency """
+    metrics.finish_request()
+
+# Profiles the requests that send PROFILE_TOKEN, or a PROFILE_SAMPLE_RATE share of them
+PROFILER = ProfilerMiddleware(app.wsgi_app, PROFILES)
+app.wsgi_app = PROFILER
+
 ######################################################################
 # Configure Swagger
 ######################################################################
@@ -130,6 +195,38 @@ create_wishlist_product_model = api.model('Create Wishlist Product', {
                                   description='Name of the product')
 })
 
+wishlist_items_model = api.inherit('Wishlist With Items', wishlist_model, {
+    'items': fields.List(fields.Nested(wishlist_product_model),
+                         description='The items of the Wishlist, only sent with expand=items')
+})
+
+wishlist_product_batch_model = api.inherit('Wishlist Product Batch Result',
+                                           wishlist_product_model, {
+    'status': fields.String(enum=['created', 'already-present'],
+                            description='Whether the product was added or already in the Wishlist')
+})
+
+cart_job_model = api.model('Cart Job', {
+    'id': fields.Integer(readOnly=True, description='The unique id of the job'),
+    'wishlist_id': fields.Integer(description='Wishlist unique ID'),
+    'product_id': fields.Integer(description='ID number of the product'),
+    'customer_id': fields.Integer(description='The customer whose cart gets the product'),
+    'status': fields.String(enum=['pending', 'running', 'done', 'failed'],
+                            description='Where the job is at'),
+    'attempts': fields.Integer(description='How many times the worker tried the job'),
+    'last_error': fields.String(description='Why the last attempt failed'),
+    'created_at': fields.DateTime(description='When the job was queued'),
+    'updated_at': fields.DateTime(description='When the job last changed')
+})
+
+wishlist_cart_result_model = api.model('Wishlist Add To Cart Result', {
+    'product_id': fields.Integer(description='ID number of the product'),
+    'status': fields.String(enum=['moved', 'failed'],
+                            description='Whether the product was moved to the cart'),
+    'code': fields.Integer(description='The HTTP status code of moving the product'),
+    'message': fields.String(description='Why the product could not be moved')
+})
+
 ######################################################################
 #  PATH: /wishlists
 ######################################################################
@@ -154,19 +251,9 @@ class WishlistCollection(Resource):
         app.logger.info('Request to create a wishlist')
         check_content_type('application/json')
         body = request.get_json()
-        app.logger.info('Body: %s', body)
-
-        name = body.get('name', '')
-        customer_id = body.get('customer_id', 0)
+        log_body(app.logger, body)
 
-        if name == '':
-            raise DataValidationError('Invalid request: missing name')
-
-        if not isinstance(customer_id, int) or customer_id <= 0:
-            raise DataValidationError('Invalid request: Wrong customer_id. ' \
-                                      'Expected a number > 0')
-
-        wishlist = Wishlist(name=name, customer_id=customer_id)
+        wishlist = new_wishlist(body)
         wishlist.save()
 
         message = wishlist.serialize()
@@ -182,31 +269,108 @@ class WishlistCollection(Resource):
     @api.doc('list_wishlist')
     @api.expect(wishlist_args, validate=True)
     @api.response(404, 'No wishlist found.')
-    @api.marshal_list_with(wishlist_model)
+    @api.response(400, 'Invalid request: limit must be between 1 and the maximum page size')
+    @api.header('Link', 'URL of the next page of results, with rel="next"')
+    @api.response(200, 'Success', [wishlist_items_model])
+    @use_replica
     def get(self):
-        """ Query a wishlist by its id """
-        app.logger.info('Querying Wishlist list')
-        wishlist_id = request.args.get('id')
-        customer_id = request.args.get('customer_id')
-        name = request.args.get('name')
-
-        wishlist = []
+        """
+        Query a wishlist by its id
 
-        if not wishlist_id and not name and not customer_id:
-            wishlist = Wishlist.all()
-        else:
-            wishlist = Wishlist.find_by_all(wishlist_id=wishlist_id,
-                                            customer_id=customer_id, name=name)
+        Results are ordered by id and paginated: pass the id of the last
+        wishlist received as after_id to get the next page. With stream=true
+        every matching wishlist is sent instead, as it is read. With
+        expand=items the items of all the wishlists are loaded in one extra
+        query and nested in each wishlist.
+        """
+        app.logger.info('Querying Wishlist list')
+        args = wishlist_args.parse_args()
+        with_items = args['expand'] == 'items'
+        model = wishlist_items_model if with_items else wishlist_model
+        limit = args['limit']
+        if limit is None:
+            limit = app.config['DEFAULT_PAGE_SIZE']
+
+        if limit < 1 or limit > app.config['MAX_PAGE_SIZE']:
+            api.abort(400, 'Invalid request: limit must be between 1 and {}'\
+                      .format(app.config['MAX_PAGE_SIZE']))
+
+        if args['stream']:
+            if args['limit'] is not None:
+                api.abort(400, 'Invalid request: limit cannot be used with stream')
+            response = stream_json_list(Wishlist.find_after(args['after_id'],
+                                                            wishlist_id=args['id'],
+                                                            customer_id=args['customer_id'],
+                                                            name=args['name'],
+                                                            with_items=with_items),
+                                        model, with_items=with_items)
+            if not response:
+                api.abort(404, "No wishlist found.")
+            return response
+
+        wishlist, next_after_id = Wishlist.find_page(limit, after_id=args['after_id'],
+                                                     wishlist_id=args['id'],
+                                                     customer_id=args['customer_id'],
+                                                     name=args['name'],
+                                                     with_items=with_items)
 
         if not wishlist:
             api.abort(404, "No wishlist found.")
 
-        response_content = [res.serialize() for res in wishlist]
+        response_content = api.marshal([res.serialize(with_items) for res in wishlist], model)
 
-        if response_content is None or len(response_content) == 0:
-            api.abort(404, "No wishlist found.")
+        headers = {}
+        if next_after_id:
+            headers['Link'] = '<{}>; rel="next"'.format(next_page_url(limit, next_after_id))
 
-        return response_content, status.HTTP_200_OK
+        return response_content, status.HTTP_200_OK, headers
+
+######################################################################
+#  PATH: /wishlists:batch
+######################################################################
+@api.route('/wishlists:batch')
+class WishlistBatch(Resource):
+    """ Handles the creation of many Wishlists in a single request """
+
+    #------------------------------------------------------------------
+    # CREATE WISHLISTS
+    #------------------------------------------------------------------
+    @api.doc('create_wishlists_batch')
+    @api.expect([create_wishlist_model])
+    @api.response(400, 'Validation errors: "Invalid request: entry N: missing name" or \
+                  "Invalid request: entry N: Wrong customer_id. Expected a number > 0"')
+    @api.marshal_list_with(wishlist_model, code=201)
+    def post(self):
+        """
+        Create many Wishlists
+        This endpoint will create a Wishlist for each entry of the array in
+        the body, all in one transaction. Every entry is validated before
+        anything is created, and the new Wishlists are returned in the order
+        of the request.
+        """
+        app.logger.info('Request to create a batch of wishlists')
+        check_content_type('application/json')
+        body = request.get_json()
+
+        if not isinstance(body, list) or not body:
+            raise DataValidationError('Invalid request: expected a non-empty array of wishlists')
+
+        if len(body) > app.config['MAX_BATCH_SIZE']:
+            raise DataValidationError('Invalid request: at most {} wishlists can be created '\
+                                      'at once'.format(app.config['MAX_BATCH_SIZE']))
+
+        wishlists = []
+        for position, entry in enumerate(body):
+            try:
+                wishlists.append(new_wishlist(entry))
+            except DataValidationError as error:
+                raise DataValidationError(str(error).replace(
+                    'Invalid request: ', 'Invalid request: entry %s: ' % position)) from error
+
+        Wishlist.save_all(wishlists)
+        app.logger.info('Created %s wishlists', len(wishlists))
+
+        return [wishlist.serialize() for wishlist in wishlists], status.HTTP_201_CREATED
 
 ######################################################################
 #  PATH: /wishlists/{wishlist_id}
@@ -219,20 +383,33 @@ class WishlistResource(Resource):
     # RETRIEVE A WISHLIST
     #------------------------------------------------------------------
     @api.doc('get_wishlist')
+    @api.expect(wishlist_expand_args, validate=True)
     @api.response(404, 'Wishlist not found')
-    @api.marshal_with(wishlist_model)
+    @api.response(304, 'Not Modified since the ETag in If-None-Match')
+    @api.response(200, 'Success', wishlist_items_model)
+    @use_replica
     def get(self, wishlist_id):
         """
         Retrieve a single Wishlist
 
-        This endpoint will return a Wishlist based on it's id
+        This endpoint will return a Wishlist based on it's id, with its
+        items when expand=items
         """
         app.logger.info("Request to Retrieve a wishlist with id [%s]", wishlist_id)
+        args = wishlist_expand_args.parse_args()
+        with_items = args['expand'] == 'items'
+
+        # the items are only loaded once the client is known not to have them
         wishlist = Wishlist.find(wishlist_id)
         if not wishlist:
             api.abort(status.HTTP_404_NOT_FOUND,
                       "Wishlist with id '{}' was not found.".format(wishlist_id))
-        return wishlist.serialize(), status.HTTP_200_OK
+        etag = wishlist_etag(wishlist_id, wishlist.version)
+        if client_has(etag):
+            return not_modified(etag)
+        model = wishlist_items_model if with_items else wishlist_model
+        return api.marshal(wishlist.serialize(with_items), model), status.HTTP_200_OK, \
+            {'ETag': quote_etag(etag)}
 
     #------------------------------------------------------------------
     # RENAME WISHLIST
@@ -250,7 +427,7 @@ class WishlistResource(Resource):
         app.logger.info('Request to rename a wishlist with id: %s', wishlist_id)
         check_content_type('application/json')
         body = request.get_json()
-        app.logger.info('Body: %s', body)
+        log_body(app.logger, body)
 
         name = body.get('name', '')
 
@@ -303,6 +480,76 @@ if not app.config['DISABLE_RESET_ENDPOINT']:
         app.logger.info('Request to remove all wishlists from database')
         return make_response('', status.HTTP_204_NO_CONTENT)
 
+######################################################################
+# CONNECTION POOL STATISTICS
+######################################################################
+@app.route('/api/admin/pool', methods=['GET'])
+def pool_stats():
+    """ Returns the connections checked out and idle in the pool of this worker """
+    return make_response(jsonify(DatabaseConnection.pool_status()), status.HTTP_200_OK)
+
+######################################################################
+# CACHE STATISTICS
+######################################################################
+@app.route('/api/admin/caches', methods=['GET'])
+def cache_stats():
+    """ Returns the size and hit ratio of the caches of this worker """
+    return make_response(jsonify({'products': Product.cache.stats(),
+                                  'wishlists': Wishlist.find_cache.stats(),
+                                  'wishlist_products': WishlistProduct.find_cache.stats(),
+                                  'wishlist_items': WishlistProduct.list_cache.stats()}),
+                         status.HTTP_200_OK)
+
+######################################################################
+# CIRCUIT BREAKER STATES
+######################################################################
+@app.route('/api/admin/breakers', methods=['GET'])
+def breaker_stats():
+    """ Returns the state of the circuit breakers of the downstream services """
+    return make_response(jsonify({'products': Product.breaker.stats(),
+                                  'shopcarts': ShopCart.breaker.stats()}), status.HTTP_200_OK)
+
+######################################################################
+# REQUEST PROFILES
+######################################################################
+def check_profile_token():
+    """ Checks the request sent the profile token, and refuses it when there is none """
+    if not PROFILER.token:
+        abort(status.HTTP_403_FORBIDDEN, 'The profiles are only available with a PROFILE_TOKEN')
+    if not PROFILER.authorized(request.environ):
+        abort(status.HTTP_403_FORBIDDEN, 'The X-Profile-Token header is required')
+
+@app.route('/api/admin/profiles', methods=['GET'])
+def list_profiles():
+    """ Returns the requests profiled by this worker, newest first """
+    check_profile_token()
+    return make_response(jsonify(PROFILES.summaries()), status.HTTP_200_OK)
+
+@app.route('/api/admin/profiles/<int:profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """ Returns the stats of a profiled request, as a pstats file or a text report """
+    check_profile_token()
+    if request.args.get('format') == 'text':
+        report = PROFILES.report(profile_id, sort=request.args.get('sort', 'cumulative'))
+        if report is None:
+            abort(status.HTTP_404_NOT_FOUND, "Profile with id '%s' was not found." % profile_id)
+        return Response(report, status=status.HTTP_200_OK, mimetype='text/plain')
+    stats = PROFILES.stats(profile_id)
+    if stats is None:
+        abort(status.HTTP_404_NOT_FOUND, "Profile with id '%s' was not found." % profile_id)
+    return Response(stats, status=status.HTTP_200_OK, mimetype='application/octet-stream',
+                    headers={'Content-Disposition':
+                             'attachment; filename=profile-%s.prof' % profile_id})
+
+######################################################################
+# PROMETHEUS METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """ Returns the metrics of every worker for Prometheus to scrape """
+    return Response(metrics.latest(), status=status.HTTP_200_OK,
+                    content_type=metrics.CONTENT_TYPE)
+
 ######################################################################
 #  PATH: /wishlists/{id}/items
 ######################################################################
@@ -317,27 +564,50 @@ class ProductCollection(Resource):
     @api.doc('list_wishlist_item')
     @api.expect(wishlist_item_args, validate=True)
     @api.response(404, 'No wishlist item found.')
-    @api.marshal_list_with(wishlist_product_model)
+    @api.response(304, 'Not Modified since the ETag in If-None-Match')
+    @api.response(200, 'Success', [wishlist_product_model])
+    @use_replica
     def get(self, wishlist_id):
         """ Query a wishlist items from URL """
         app.logger.info('Querying Wishlist items')
 
-        product_id = request.args.get('product_id')
-        product_name = request.args.get('product_name')
-        wishlist_item = []
+        args = wishlist_item_args.parse_args()
+
+        version = Wishlist.version_of(wishlist_id)
+        if version is None:
+            api.abort(404, "No wishlist item found.")
+        etag = wishlist_etag(wishlist_id, version)
+        if client_has(etag):
+            return not_modified(etag)
+
+        if not (args['product_id'] or args['product_name'] or args['stream']):
+            # the whole list, which is cached for its version
+            wishlist_item = WishlistProduct.items_of(wishlist_id, version)
+            if not wishlist_item:
+                api.abort(404, "No wishlist item found.")
+            return (api.marshal(wishlist_item, wishlist_product_model), status.HTTP_200_OK,
+                    {'ETag': quote_etag(etag)})
 
         wishlist_item = WishlistProduct.find_by_all(wishlist_id=wishlist_id,
-                                                    product_id=product_id,
-                                                    product_name=product_name)
+                                                    product_id=args['product_id'],
+                                                    product_name=args['product_name'])
+        if args['stream']:
+            response = stream_json_list(wishlist_item, wishlist_product_model)
+            if not response:
+                api.abort(404, "No wishlist item found.")
+            response.set_etag(etag)
+            return response
+
         if not wishlist_item:
             api.abort(404, "No wishlist item found.")
 
-        response_content = [res.serialize() for res in wishlist_item]
+        response_content = api.marshal([res.serialize() for res in wishlist_item],
+                                       wishlist_product_model)
 
         if response_content is None or len(response_content) == 0:
             api.abort(404, "No wishlist item found.")
 
-        return response_content, status.HTTP_200_OK
+        return response_content, status.HTTP_200_OK, {'ETag': quote_etag(etag)}
 
     #---------------------------------------------------------------------
     # ADD NEW ITEM TO WISHLIST
@@ -359,24 +629,11 @@ class ProductCollection(Resource):
         if not wishlist:
             api.abort(status.HTTP_404_NOT_FOUND,
                       "Wishlist with id '%s' was not found." % wishlist_id)
-        wishlist_product = WishlistProduct()
-        wishlist_product.wishlist_id = wishlist_id
 
         body = request.get_json()
-        app.logger.info('Body: %s', body)
-
-        product_name = body.get('product_name', '')
-        product_id = body.get('product_id', 0)
-
-        if product_name == '':
-            raise DataValidationError('Invalid request: missing name')
+        log_body(app.logger, body)
 
-        wishlist_product.product_name = product_name
-
-        if product_id == 0:
-            raise DataValidationError('Invalid request: missing product id')
-
-        wishlist_product.product_id = product_id
+        wishlist_product = new_wishlist_product(wishlist_id, body)
 
         app.logger.info('Request to add %s item to wishlist %s' % (wishlist_product.product_id,
                                                                    wishlist_id))
@@ -384,11 +641,73 @@ class ProductCollection(Resource):
         wishlist_product.save()
         message = wishlist_product.serialize()
 
-        location_url = api.url_for(ProductResource, wishlist_id=wishlist.id,
+        location_url = api.url_for(ProductResource, wishlist_id=wishlist_id,
                                    product_id=wishlist_product.product_id, _external=True)
 
         return message, status.HTTP_201_CREATED, {'Location': location_url}
 
+######################################################################
+#  PATH: /wishlists/{id}/items:batch
+######################################################################
+@api.route('/wishlists/<int:wishlist_id>/items:batch')
+@api.param('wishlist_id', 'The Wishlists unique ID number')
+class ProductBatch(Resource):
+    """ Handles adding many Products to a Wishlist in a single request """
+
+    #---------------------------------------------------------------------
+    # ADD NEW ITEMS TO WISHLIST
+    #---------------------------------------------------------------------
+    @api.doc('add_wishlist_items_batch')
+    @api.expect([create_wishlist_product_model])
+    @api.response(404, 'Wishlist with id \'input_wishlist_id\' was not found.')
+    @api.response(400, 'Validation errors: "Invalid request: entry N: missing name" or \
+                  "Invalid request: entry N: missing product id"')
+    @api.marshal_list_with(wishlist_product_batch_model)
+    def post(self, wishlist_id):
+        """
+        Add many items to a Wishlist
+        This endpoint adds every product of the array in the body to a
+        Wishlist in one transaction. Products already in the Wishlist are
+        left as they are. The status of each entry is returned in the order
+        of the request.
+        """
+        app.logger.info('Request to add a batch of items into wishlist %s', wishlist_id)
+        check_content_type('application/json')
+
+        wishlist = Wishlist.find(wishlist_id)
+        if not wishlist:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Wishlist with id '%s' was not found." % wishlist_id)
+
+        body = request.get_json()
+
+        if not isinstance(body, list) or not body:
+            raise DataValidationError('Invalid request: expected a non-empty array of items')
+
+        if len(body) > app.config['MAX_BATCH_SIZE']:
+            raise DataValidationError('Invalid request: at most {} items can be added '\
+                                      'at once'.format(app.config['MAX_BATCH_SIZE']))
+
+        wishlist_products = []
+        for position, entry in enumerate(body):
+            try:
+                wishlist_products.append(new_wishlist_product(wishlist_id, entry))
+            except DataValidationError as error:
+                raise DataValidationError(str(error).replace(
+                    'Invalid request: ', 'Invalid request: entry %s: ' % position)) from error
+
+        created = set(WishlistProduct.save_all(wishlist_id, wishlist_products))
+
+        results = []
+        for wishlist_product in wishlist_products:
+            result = wishlist_product.serialize()
+            result['status'] = 'created' if wishlist_product in created else 'already-present'
+            results.append(result)
+        app.logger.info('Added %s of %s items to wishlist %s', len(created),
+                        len(wishlist_products), wishlist_id)
+
+        return results, status.HTTP_200_OK
+
 ######################################################################
 # PATH: /wishlists/{id}/items/{id}
 ######################################################################
@@ -410,18 +729,26 @@ class ProductResource(Resource):
     #---------------------------------------------------------------------
     @api.doc('get_product_details')
     @api.response(404, 'Product not found')
-    @api.marshal_with(wishlist_product_model)
+    @api.response(304, 'Not Modified since the ETag in If-None-Match')
+    @api.response(200, 'Success', wishlist_product_model)
+    @use_replica
     def get(self, wishlist_id, product_id):
         """
         Retrieve a single Product from a Wishlist
         """
         app.logger.info('Request for {} item in wishlist {}'.format(product_id, wishlist_id))
 
+        version = Wishlist.version_of(wishlist_id)
+        etag = wishlist_etag(wishlist_id, version)
+        if version is not None and client_has(etag):
+            return not_modified(etag)
+
         wishlist_product = WishlistProduct.find(wishlist_id, product_id)
         if not wishlist_product:
             api.abort(status.HTTP_404_NOT_FOUND, "The wishlist-product tuple ({},{}) you\
                       are looking for was not found.".format(wishlist_id, product_id))
-        return wishlist_product.serialize(), status.HTTP_200_OK
+        return api.marshal(wishlist_product.serialize(), wishlist_product_model), \
+            status.HTTP_200_OK, {'ETag': quote_etag(etag)}
 
     #---------------------------------------------------------------------
     # UPDATE WISHLIST PRODUCT
@@ -440,10 +767,10 @@ class ProductResource(Resource):
                         product_id, wishlist_id)
         check_content_type('application/json')
 
-        wishlist = Wishlist.find(wishlist_id)
         wishlist_product = WishlistProduct.find(wishlist_id, product_id)
 
-        if not wishlist:
+        # an item is always in an existing wishlist
+        if not wishlist_product and not Wishlist.find(wishlist_id):
             api.abort(status.HTTP_404_NOT_FOUND, "Wishlist with id '{}' not found"\
                        .format(wishlist_id))
         elif not wishlist_product:
@@ -451,7 +778,7 @@ class ProductResource(Resource):
                       wishlist with id '{}'.".format(product_id, wishlist_id))
 
         body = request.get_json()
-        app.logger.info('Body: %s', body)
+        log_body(app.logger, body)
 
         product_name = body.get('product_name', '')
 
@@ -459,9 +786,11 @@ class ProductResource(Resource):
             api.abort(status.HTTP_400_BAD_REQUEST, "Product needs a non-empty name.")
 
         wishlist_product.product_name = product_name
+        # serialized before the commit expires it, which would read it again
+        message = wishlist_product.serialize()
         wishlist_product.save()
 
-        return wishlist_product.serialize(), status.HTTP_200_OK
+        return message, status.HTTP_200_OK
 
     #---------------------------------------------------------------------
     # DELETE A WISHLIST PRODUCT
@@ -501,14 +830,20 @@ class AddToCartResource(Resource):
     #---------------------------------------------------------------------
 
     @api.doc('addtocart_wishlistproduct')
+    @api.expect(add_to_cart_args, validate=True)
+    @api.response(503, 'Products or ShopCarts service unavailable')
     @api.response(404, 'Wishlist/Product not found')
+    @api.response(202, 'Product queued for the cart', cart_job_model)
     @api.response(204, 'Product added to cart')
     def put(self, wishlist_id, product_id):
         """
             Move item from Wishlist to cart
             This endpoint will request to move and item in wishlist to cart
+            With async=true the item is queued for the worker, and the job
+            returned can be polled at /cart-jobs/{id}
         """
         app.logger.info('Request to move item %s in wishlist %s to cart', product_id, wishlist_id)
+        args = add_to_cart_args.parse_args()
         wishlist = Wishlist.find(wishlist_id)
         if not wishlist:
             raise NotFound("Wishlist with id '{}' was not found.".format(wishlist_id))
@@ -518,18 +853,156 @@ class AddToCartResource(Resource):
             raise NotFound("Wishlist Product with id '{}' was not found in Wishlist \
                             with id '{}'.".format(product_id, wishlist_id))
 
+        if args['async']:
+            job = CartJob.enqueue(wishlist.customer_id, wishlist_id, product_id)
+            location_url = api.url_for(CartJobResource, job_id=job.id, _external=True)
+            return api.marshal(job.serialize(), cart_job_model), status.HTTP_202_ACCEPTED, \
+                {'Location': location_url}
+
         wishlist_product.add_to_cart(wishlist.customer_id)
         wishlist_product.delete()
 
         return '', status.HTTP_204_NO_CONTENT
 
+######################################################################
+# PATH: /cart-jobs/{id}
+######################################################################
+@api.route('/cart-jobs/<int:job_id>')
+@api.param('job_id', 'The Cart Job unique ID number')
+class CartJobResource(Resource):
+    """ Status of the items queued for the cart """
+
+    @api.doc('get_cart_job')
+    @api.response(404, 'Cart Job not found')
+    @api.marshal_with(cart_job_model)
+    @use_replica
+    def get(self, job_id):
+        """
+        Retrieve a single Cart Job
+
+        Poll this to know whether a queued item made it to the cart.
+        """
+        app.logger.info('Request to retrieve cart job %s', job_id)
+        job = CartJob.find(job_id)
+        if not job:
+            raise NotFound("Cart Job with id '{}' was not found.".format(job_id))
+        return job.serialize(), status.HTTP_200_OK
+
+######################################################################
+# PATH: /wishlists/{id}/add-to-cart
+######################################################################
+@api.route('/wishlists/<int:wishlist_id>/add-to-cart')
+@api.param('wishlist_id', 'The Wishlists unique ID number')
+class WishlistAddToCartResource(Resource):
+    """ Moves every item of a Wishlist to the cart """
+
+    @api.doc('addtocart_wishlist')
+    @api.response(404, 'Wishlist not found')
+    @api.marshal_list_with(wishlist_cart_result_model, skip_none=True)
+    def put(self, wishlist_id):
+        """
+        Move every item of a Wishlist to the cart
+
+        The items are moved concurrently and the result of each one is returned.
+        The items that were moved are deleted from the Wishlist, the others stay.
+        """
+        app.logger.info('Request to move the items of wishlist %s to cart', wishlist_id)
+        wishlist = Wishlist.find(wishlist_id, with_items=True)
+        if not wishlist:
+            raise NotFound("Wishlist with id '{}' was not found.".format(wishlist_id))
+
+        return wishlist.add_to_cart(app.config['CART_WORKERS']), status.HTTP_200_OK
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
 def init_db():
-    """ Initialies the SQLAlchemy app """
-    DatabaseConnection.init()
+    """ Initialies the SQLAlchemy app, and the schema unless DB_CREATE_SCHEMA is false """
+    DatabaseConnection.init(app.config['DB_CREATE_SCHEMA'])
+
+def new_wishlist(data):
+    """ Validates the data of a create wishlist request and returns the new Wishlist """
+    if not isinstance(data, dict):
+        raise DataValidationError('Invalid request: body of request contained bad or no data')
+
+    name = data.get('name', '')
+    customer_id = data.get('customer_id', 0)
+
+    if name == '':
+        raise DataValidationError('Invalid request: missing name')
+
+    if not isinstance(customer_id, int) or customer_id <= 0:
+        raise DataValidationError('Invalid request: Wrong customer_id. ' \
+                                  'Expected a number > 0')
+
+    return Wishlist(name=name, customer_id=customer_id)
+
+def new_wishlist_product(wishlist_id, data):
+    """ Validates the data of an add item request and returns the new WishlistProduct """
+    if not isinstance(data, dict):
+        raise DataValidationError('Invalid request: body of request contained bad or no data')
+
+    product_name = data.get('product_name', '')
+    product_id = data.get('product_id', 0)
+
+    if product_name == '':
+        raise DataValidationError('Invalid request: missing name')
+
+    if product_id == 0:
+        raise DataValidationError('Invalid request: missing product id')
+
+    return WishlistProduct(wishlist_id=wishlist_id, product_id=product_id,
+                           product_name=product_name)
+
+def next_page_url(limit, after_id):
+    """ Builds the URL of the next page keeping the query of the current request """
+    args = request.args.to_dict()
+    args['limit'] = limit
+    args['after_id'] = after_id
+    return '%s?%s' % (request.base_url, urlencode(args))
+
+def wishlist_etag(wishlist_id, version):
+    """ Returns the ETag of a version of a Wishlist, shared by its items """
+    return '{}-{}'.format(wishlist_id, version)
+
+def client_has(etag):
+    """ Tells whether the If-None-Match header of the request matches an ETag """
+    return request.if_none_match.contains(etag)
+
+def not_modified(etag):
+    """ Returns an empty 304 Not Modified response """
+    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+def stream_json_list(query, model, **serialize_args):
+    """
+    Streams the rows of a query as a JSON array
+
+    Rows are fetched STREAM_CHUNK_SIZE at a time with a server-side cursor and
+    written out as soon as each chunk is encoded, so memory use does not grow
+    with the number of rows. Returns None when the query has no rows.
+    """
+    chunk_size = app.config['STREAM_CHUNK_SIZE']
+    rows = iter(query.yield_per(chunk_size))
+    first = next(rows, None)
+    if first is None:
+        return None
+
+    def generate():
+        chunk = ['[', json.dumps(api.marshal(first.serialize(**serialize_args), model))]
+        for row in rows:
+            chunk.append(',')
+            chunk.append(json.dumps(api.marshal(row.serialize(**serialize_args), model)))
+            if len(chunk) >= 2 * chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+        chunk.append(']')
+        yield ''.join(chunk)
+
+    return Response(stream_with_context(generate()), status=status.HTTP_200_OK,
+                    mimetype='application/json')
 
 def check_content_type(content_type):
     """ Checks that the media type is correct """
@@ -542,18 +1015,17 @@ def initialize_logging(log_level=logging.INFO):
     """ Initialized the default logging to STDOUT """
     if not app.debug:
         print('Setting up logging...')
-        # Set up default logging for submodules to use STDOUT
-        # datefmt='%m/%d/%Y %I:%M:%S %p'
-        fmt = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
-        logging.basicConfig(stream=sys.stdout, level=log_level, format=fmt)
-        # Make a new log handler that uses STDOUT
-        handler = logging.StreamHandler(sys.stdout)
-        handler.setFormatter(logging.Formatter(fmt))
-        handler.setLevel(log_level)
+        # Make a new log handler that uses STDOUT, as text or JSON (LOG_FORMAT)
+        # and from a background thread with LOG_QUEUE
+        handler = create_handler(log_level)
+        # Set up default logging for submodules to use it too
+        logging.basicConfig(level=log_level, handlers=[handler])
         # Remove the Flask default handlers and use our own
         handler_list = list(app.logger.handlers)
         for log_handler in handler_list:
             app.logger.removeHandler(log_handler)
+            if log_handler not in logging.getLogger().handlers:
+                log_handler.close()
         app.logger.addHandler(handler)
         app.logger.setLevel(log_level)
         app.logger.propagate = False
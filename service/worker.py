@@ -0,0 +1,138 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Add-to-cart worker
+
+Drains the outbox of Cart Jobs written by the asynchronous add-to-cart: it
+claims the jobs that are due in batches, moves each product to the cart and
+removes it from the wishlist. Failed calls to the Product and ShopCart
+services are retried with an exponential backoff, products the Product
+service doesn't know are given up on at once. A job that fails in any other
+way is rolled back and retried the same way, and the loop carries on when
+the database can't be reached, so one bad job or outage doesn't stop it.
+
+Run it next to the web processes with:
+  python -m service.worker
+
+Environment:
+------------
+CART_JOB_BATCH_SIZE - jobs claimed at a time (default: 50)
+CART_JOB_POLL_SECONDS - seconds to wait when the outbox is empty (default: 1)
+CART_JOB_MAX_ATTEMPTS - attempts before a job fails (default: 5)
+CART_JOB_RETRY_SECONDS - delay before the first retry, doubled for each next one (default: 2)
+CART_JOB_LEASE_SECONDS - seconds after which a job claimed by a worker that died
+                         is claimed again (default: 60)
+"""
+import logging
+import os
+import signal
+import threading
+
+from werkzeug.exceptions import HTTPException, NotFound
+
+from service.models import CartJob, WishlistProduct, DB
+
+logger = logging.getLogger('flask.app')
+
+
+class CartWorker():
+    """ Moves the products of the queued Cart Jobs to the cart """
+
+    def __init__(self):
+        self.batch_size = int(os.getenv('CART_JOB_BATCH_SIZE', '50'))
+        self.poll_seconds = float(os.getenv('CART_JOB_POLL_SECONDS', '1'))
+        self.max_attempts = int(os.getenv('CART_JOB_MAX_ATTEMPTS', '5'))
+        self.retry_seconds = float(os.getenv('CART_JOB_RETRY_SECONDS', '2'))
+        self.lease_seconds = float(os.getenv('CART_JOB_LEASE_SECONDS', '60'))
+        self._stopping = threading.Event()
+
+    def run(self):
+        """ Drains the outbox until stop() is called """
+        logger.info('Cart worker started')
+        while not self._stopping.is_set():
+            try:
+                drained = self.drain()
+            except Exception:    # pylint: disable=broad-except
+                logger.exception('Cart worker failed to claim jobs')
+                DB.session.rollback()
+                drained = 0
+            if not drained:
+                self._stopping.wait(self.poll_seconds)
+        logger.info('Cart worker stopped')
+
+    def stop(self, *_):
+        """ Stops the worker once the batch it is running is done """
+        self._stopping.set()
+
+    def drain(self):
+        """ Runs a batch of the jobs that are due and returns how many there were """
+        jobs = CartJob.claim(self.batch_size, self.lease_seconds)
+        for job in jobs:
+            try:
+                self.process(job)
+            except Exception as error:    # pylint: disable=broad-except
+                logger.exception('Cart job %s failed', job.id)
+                DB.session.rollback()
+                try:
+                    self.retry_or_fail(job, str(error) or error.__class__.__name__)
+                except Exception:    # pylint: disable=broad-except
+                    # the lease runs out and the job is claimed again
+                    logger.exception('Cannot record the failure of cart job %s', job.id)
+                    DB.session.rollback()
+        return len(jobs)
+
+    def process(self, job):
+        """ Moves the product of a job to the cart """
+        if job.attempts > self.max_attempts:
+            job.fail(job.last_error or 'Gave up after {} attempts'.format(self.max_attempts))
+            return
+        # not WishlistProduct.find, its cache may still have an item just deleted
+        if WishlistProduct.find_by_all(wishlist_id=job.wishlist_id,
+                                       product_id=job.product_id).first() is None:
+            job.fail("Product with id '{}' is no longer in Wishlist with id '{}'."
+                     .format(job.product_id, job.wishlist_id))
+            return
+        try:
+            WishlistProduct.move_to_cart(job.customer_id, job.wishlist_id, job.product_id)
+        except NotFound as error:
+            logger.warning('Cart job %s failed: %s', job.id, error.description)
+            job.fail(error.description)
+        except HTTPException as error:
+            self.retry_or_fail(job, error.description)
+        else:
+            job.complete()
+            logger.info('Cart job %s moved product %s to the cart', job.id, job.product_id)
+
+    def retry_or_fail(self, job, error):
+        """ Retries a job that failed later, or gives up on it after the last attempt """
+        if job.attempts >= self.max_attempts:
+            logger.error('Cart job %s failed for good: %s', job.id, error)
+            job.fail(error)
+        else:
+            delay = self.retry_seconds * 2 ** (job.attempts - 1)
+            logger.warning('Cart job %s failed, retrying in %ss: %s', job.id, delay, error)
+            job.retry(error, delay)
+
+
+def main():
+    """ Runs a worker until it gets SIGTERM or SIGINT """
+    worker = CartWorker()
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Helpers shared by the test cases
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from service import app
+from service.models import Wishlist, WishlistProduct, DB
+
+
+def query_plan(query):
+    """ Returns the SQLite query plan of a SQLAlchemy query as a single string """
+    statement = query.statement.compile(DB.engine, compile_kwargs={'literal_binds': True})
+    rows = DB.session.execute('EXPLAIN QUERY PLAN %s' % statement).fetchall()
+    return ' | '.join(row[-1] for row in rows)
+
+
+@contextmanager
+def recorded_statements():
+    """ Yields the list of the SQL statements the block runs """
+    statements = []
+    def record(_conn, _cursor, statement, *_args):
+        statements.append(statement)
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+
+
+def count_statements(func, *args, **kwargs):
+    """ Calls func and returns its result and the SQL statements it ran """
+    with recorded_statements() as statements:
+        result = func(*args, **kwargs)
+    return result, statements
+
+
+@contextmanager
+def assert_max_queries(count):
+    """
+    Fails when the block runs more than `count` SQL statements
+
+    The statements run are listed in the failure, which shows the N+1 queries.
+    """
+    with recorded_statements() as statements:
+        yield statements
+    if len(statements) > count:
+        raise AssertionError('%d SQL statements, expected at most %d:\n%s'
+                             % (len(statements), count, '\n'.join(statements)))
+
+
+@contextmanager
+def find_caches(size=1024):
+    """ Turns on the caches of the lookups by id, which are off without a CACHE_URL """
+    caches = [Wishlist.find_cache.local, WishlistProduct.find_cache.local]
+    sizes = [cache.maxsize for cache in caches]
+    saved = app.config['FIND_CACHE_SIZE']
+    for cache in caches:
+        cache.maxsize = size
+    app.config['FIND_CACHE_SIZE'] = size
+    try:
+        yield
+    finally:
+        for cache, maxsize in zip(caches, sizes):
+            cache.clear()
+            cache.maxsize = maxsize
+        app.config['FIND_CACHE_SIZE'] = saved
@@ -0,0 +1,226 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the circuit breaker of the downstream services
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from prometheus_client import CollectorRegistry, multiprocess, values
+
+from werkzeug.exceptions import InternalServerError, ServiceUnavailable
+from werkzeug.serving import make_server
+
+from fakes import products as fake_products
+from service import metrics
+from service.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from service.models import Product
+from tests.test_cache import FakeClock
+from tests.test_metrics import sample
+
+
+def failing():
+    """ A call to a service that is down """
+    raise ConnectionError('down')
+
+
+#######################################################################
+#  T E S T   C A S E S
+#######################################################################
+class TestCircuitBreaker(unittest.TestCase):
+    """ Test Cases for CircuitBreaker """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker('Test', failure_threshold=2, reset_timeout=10,
+                                      clock=self.clock)
+
+    def open_circuit(self):
+        """ Fails calls until the circuit opens """
+        for _ in range(2):
+            self.assertRaises(ConnectionError, self.breaker.call, failing)
+
+    def test_environment(self):
+        """ Read the threshold and cool-down from the environment """
+        with patch.dict('os.environ', {'BREAKER_FAILURE_THRESHOLD': '3',
+                                       'BREAKER_RESET_TIMEOUT': '7'}):
+            breaker = CircuitBreaker('Test')
+        self.assertEqual(breaker.failure_threshold, 3)
+        self.assertEqual(breaker.reset_timeout, 7)
+
+    def test_closed(self):
+        """ Let calls through while closed """
+        self.assertEqual(self.breaker.call(lambda x: x + 1, 1), 2)
+        self.assertRaises(ConnectionError, self.breaker.call, failing)
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        self.assertRaises(ConnectionError, self.breaker.call, failing)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_open(self):
+        """ Fail fast after too many failures in a row """
+        self.open_circuit()
+        self.assertEqual(self.breaker.state, OPEN)
+        func = MagicMock()
+        self.assertRaises(CircuitOpenError, self.breaker.call, func)
+        func.assert_not_called()
+        stats = self.breaker.stats()
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['rejected'], 1)
+
+    def test_metrics(self):
+        """ Export the state of the circuit and its counters to Prometheus """
+        breaker = CircuitBreaker('Metered', failure_threshold=1, reset_timeout=10,
+                                 clock=self.clock)
+        self.assertEqual(sample('wishlists_breaker_state', breaker='Metered'), 0)
+        self.assertRaises(ConnectionError, breaker.call, failing)
+        self.assertEqual(sample('wishlists_breaker_state', breaker='Metered'), 2)
+        self.assertEqual(sample('wishlists_breaker_opened_total', breaker='Metered'), 1)
+        self.assertRaises(CircuitOpenError, breaker.call, failing)
+        self.assertEqual(sample('wishlists_breaker_rejected_total', breaker='Metered'), 1)
+        self.clock.now = 10
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertEqual(sample('wishlists_breaker_state', breaker='Metered'), 1)
+        breaker.call(lambda: 'ok')
+        self.assertEqual(sample('wishlists_breaker_state', breaker='Metered'), 0)
+        self.assertEqual(sample('wishlists_breaker_opened_total', breaker='Metered'), 1)
+
+    def test_metrics_half_open(self):
+        """ Export the half-open state when the metrics are scraped after the cool-down """
+        breaker = CircuitBreaker('Cooling', failure_threshold=1, reset_timeout=10,
+                                 clock=self.clock)
+        self.assertRaises(ConnectionError, breaker.call, failing)
+        self.clock.now = 10
+        self.assertEqual(sample('wishlists_breaker_state', breaker='Cooling'), 2)
+        metrics.latest()
+        self.assertEqual(sample('wishlists_breaker_state', breaker='Cooling'), 1)
+
+    def test_metrics_dead_worker(self):
+        """ Drop the state exported by a worker once it exited """
+        with tempfile.TemporaryDirectory() as path, \
+                patch.dict(os.environ, {'prometheus_multiproc_dir': path}), \
+                patch.object(values, 'ValueClass', values.MultiProcessValue(lambda: 4242)), \
+                patch.object(metrics, 'MULTIPROCESS', True):
+            breaker = CircuitBreaker('Recycled', failure_threshold=1, clock=self.clock)
+            self.assertRaises(ConnectionError, breaker.call, failing)
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry, path)
+            self.assertEqual(registry.get_sample_value(
+                'wishlists_breaker_state', {'breaker': 'Recycled', 'pid': '4242'}), 2)
+            metrics.worker_exit(4242)
+            self.assertIsNone(registry.get_sample_value(
+                'wishlists_breaker_state', {'breaker': 'Recycled', 'pid': '4242'}))
+
+    def test_server_errors(self):
+        """ Count 5xx responses as failures """
+        for _ in range(2):
+            self.breaker.call(MagicMock(return_value=MagicMock(status_code=503)))
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_half_open_success(self):
+        """ Close the circuit when the trial call succeeds """
+        self.open_circuit()
+        self.clock.now = 10
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_half_open_failure(self):
+        """ Open the circuit again when the trial call fails """
+        self.open_circuit()
+        self.clock.now = 10
+        self.assertRaises(ConnectionError, self.breaker.call, failing)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.stats()['opened'], 2)
+        self.clock.now = 15
+        self.assertRaises(CircuitOpenError, self.breaker.call, failing)
+
+    def test_half_open_single_trial(self):
+        """ Let a single trial call through while half-open """
+        self.open_circuit()
+        self.clock.now = 10
+        trial_started = threading.Event()
+        finish_trial = threading.Event()
+
+        def trial():
+            trial_started.set()
+            finish_trial.wait(5)
+
+        thread = threading.Thread(target=self.breaker.call, args=(trial,))
+        thread.start()
+        trial_started.wait(5)
+        self.assertRaises(CircuitOpenError, self.breaker.call, lambda: 'ok')
+        finish_trial.set()
+        thread.join()
+        self.assertEqual(self.breaker.state, CLOSED)
+
+
+class TestProductBreaker(unittest.TestCase):
+    """ Test the circuit breaker of Product against a failing fake Product service """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = make_server('127.0.0.1', 0, fake_products.APP, threaded=True)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.thread.join()
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patches = [
+            patch.object(Product, 'PRODUCT_SERV_URL', 'http://127.0.0.1:%s' % self.server.port),
+            patch.object(Product, 'breaker', CircuitBreaker('Products', failure_threshold=3,
+                                                            reset_timeout=30, clock=self.clock)),
+            patch.dict(fake_products.APP.config, {'FAILURE_RATE': 1.0}),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+        Product.cache.clear()
+
+    def tearDown(self):
+        for patcher in reversed(self.patches):
+            patcher.stop()
+        Product.cache.clear()
+
+    def test_fail_fast_and_recover(self):
+        """ Fail fast while the Product service is down and recover when it is back """
+        for product_id in range(3):
+            response = Product.get_product_details(product_id)
+            self.assertEqual(response.status_code, 503)
+        with patch.object(Product, '_get_product_details') as product_request_mock:
+            self.assertRaises(ServiceUnavailable, Product.get_product_details, 4)
+            product_request_mock.assert_not_called()
+
+        fake_products.APP.config['FAILURE_RATE'] = 0.0
+        self.clock.now = 30
+        self.assertEqual(Product.get_product_details(5).status_code, 200)
+        self.assertEqual(Product.breaker.state, CLOSED)
+
+    def test_connection_errors(self):
+        """ Open the circuit when the Product service cannot be reached """
+        with patch.object(Product, 'PRODUCT_SERV_URL', 'http://127.0.0.1:1'):
+            for product_id in range(3):
+                self.assertRaises(InternalServerError, Product.get_product_details, product_id)
+        self.assertEqual(Product.breaker.state, OPEN)
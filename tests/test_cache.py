@@ -0,0 +1,257 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the caches
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+from service.cache import MISSING, Cache, MemoryBackend, RedisBackend, TTLCache, \
+    backend_from_url
+
+
+class FakeClock():
+    """ A clock that only moves when told to """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedisError(Exception):
+    """ Stands for redis.RedisError """
+
+
+#######################################################################
+#  T E S T   C A S E S
+#######################################################################
+class TestTTLCache(unittest.TestCase):
+    """ Test Cases for TTLCache """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TTLCache(2, 10, clock=self.clock)
+
+    def test_get_and_set(self):
+        """ Get a cached value """
+        self.assertIs(self.cache.get(1), MISSING)
+        self.cache.set(1, 'one')
+        self.assertEqual(self.cache.get(1), 'one')
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_cache_none(self):
+        """ Cache a None value """
+        self.cache.set(1, None)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_expire(self):
+        """ Expire values after their time to live """
+        self.cache.set(1, 'one')
+        self.cache.set(2, 'two', ttl=1)
+        self.clock.now = 5
+        self.assertIs(self.cache.get(2), MISSING)
+        self.assertEqual(self.cache.get(1), 'one')
+        self.clock.now = 10
+        self.assertIs(self.cache.get(1), MISSING)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_evict_least_recently_used(self):
+        """ Evict the least recently used value when full """
+        self.cache.set(1, 'one')
+        self.cache.set(2, 'two')
+        self.cache.get(1)
+        self.cache.set(3, 'three')
+        self.assertIs(self.cache.get(2), MISSING)
+        self.assertEqual(self.cache.get(1), 'one')
+        self.assertEqual(self.cache.get(3), 'three')
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_disabled(self):
+        """ Cache nothing when the size is 0 """
+        cache = TTLCache(0, 10)
+        cache.set(1, 'one')
+        self.assertIs(cache.get(1), MISSING)
+
+    def test_delete_and_clear(self):
+        """ Delete values and clear the cache """
+        self.cache.set(1, 'one')
+        self.cache.set(2, 'two')
+        self.cache.delete(1)
+        self.cache.delete(1)
+        self.assertIs(self.cache.get(1), MISSING)
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()['size'], 0)
+        self.assertEqual(self.cache.stats()['misses'], 0)
+
+
+class TestSharedCache(unittest.TestCase):
+    """ Test Cases for Cache, with two workers sharing a backend """
+
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.worker1 = Cache('test', 10, 60, backend=self.backend)
+        self.worker2 = Cache('test', 10, 60, backend=self.backend)
+
+    def test_shared_values(self):
+        """ A value cached by one worker is found by the other """
+        self.worker1.set((1, 2), {'name': 'one'})
+        self.assertEqual(self.worker2.get((1, 2)), {'name': 'one'})
+        self.assertEqual(self.worker2.stats()['shared_hits'], 1)
+        self.assertEqual(self.worker2.stats()['hits'], 1)
+        # then from its own copy
+        self.assertEqual(self.worker2.get((1, 2)), {'name': 'one'})
+        self.assertEqual(self.worker2.stats()['shared_hits'], 1)
+        self.assertIs(self.worker2.get((1, 3)), MISSING)
+
+    def test_delete_reaches_every_worker(self):
+        """ A value deleted by one worker is dropped by the other """
+        self.worker1.set(1, 'one')
+        self.assertEqual(self.worker2.get(1), 'one')
+        self.worker1.delete(1)
+        self.assertIs(self.worker2.local.get('1'), MISSING)
+        self.assertIs(self.worker2.get(1), MISSING)
+
+    def test_delete_group(self):
+        """ Delete the values of every key of a group in every worker """
+        self.worker1.set((1, 1), 'a')
+        self.worker1.set((1, 2), 'b')
+        self.worker1.set((11, 1), 'c')
+        self.worker1.set(1, 'd')
+        self.assertEqual(self.worker2.get((1, 1)), 'a')
+        self.worker1.delete_group(1)
+        self.assertIs(self.worker2.get((1, 1)), MISSING)
+        self.assertIs(self.worker1.get((1, 2)), MISSING)
+        self.assertEqual(self.worker2.get((11, 1)), 'c')
+        self.assertEqual(self.worker2.get(1), 'd')
+
+    def test_other_caches_untouched(self):
+        """ Invalidations only reach the caches with the same name """
+        other = Cache('other', 10, 60, backend=self.backend)
+        other.set(1, 'other')
+        self.worker1.delete(1)
+        self.assertEqual(other.local.get('1'), 'other')
+
+    def test_clear(self):
+        """ Clearing a cache clears it in every worker """
+        self.worker1.set(1, 'one')
+        self.worker2.get(1)
+        self.worker1.clear()
+        self.assertEqual(len(self.worker2), 0)
+        self.assertIs(self.worker2.get(1), MISSING)
+
+    def test_set_after_invalidation(self):
+        """ A value read before another worker deleted it is not cached """
+        generation = self.worker1.generation()
+        self.worker2.delete(1)    # the row changed after worker1 read it
+        self.worker1.set(1, 'old', generation=generation)
+        self.assertIs(self.worker1.get(1), MISSING)
+        self.assertIs(self.worker2.get(1), MISSING)
+        # one read after the invalidation is cached
+        generation = self.worker1.generation()
+        self.worker1.set(1, 'new', generation=generation)
+        self.assertEqual(self.worker2.get(1), 'new')
+
+    def test_invalidation_while_storing(self):
+        """ A value deleted while it was stored in the backend is dropped again """
+        store = self.backend.set
+
+        def set_and_invalidate(*args, **kwargs):
+            store(*args, **kwargs)
+            self.worker2.delete_group(1)
+        with patch.object(self.backend, 'set', side_effect=set_and_invalidate):
+            self.worker1.set((1, 2), 'old', generation=self.worker1.generation())
+        self.assertIs(self.worker1.get((1, 2)), MISSING)
+        self.assertIs(self.worker2.get((1, 2)), MISSING)
+
+    def test_local_ttl(self):
+        """ Workers keep their own copy for at most the local ttl """
+        cache = Cache('test', 10, 60, backend=self.backend, local_ttl=0)
+        cache.set(1, 'one')
+        self.assertIs(cache.local.get('1'), MISSING)
+        self.assertEqual(cache.get(1), 'one')
+
+    def test_without_backend(self):
+        """ Without a backend the values stay in the worker """
+        cache = Cache('test', 10, 60, backend=None)
+        cache.set(1, ['one'])
+        self.assertEqual(cache.get(1), ['one'])
+        self.assertIsNone(cache.stats()['backend'])
+        cache.delete(1)
+        self.assertIs(cache.get(1), MISSING)
+
+    def test_backend_from_url(self):
+        """ Pick the backend named by CACHE_URL """
+        self.assertIsNone(backend_from_url(''))
+        self.assertIsInstance(backend_from_url('memory://'), MemoryBackend)
+
+
+class TestRedisBackend(unittest.TestCase):
+    """ Test Cases for RedisBackend, with a mock of the redis package """
+
+    def setUp(self):
+        self.redis = MagicMock(RedisError=FakeRedisError)
+        with patch.dict(sys.modules, {'redis': self.redis}):
+            self.backend = RedisBackend('redis://cache:6379/0', 'test:invalidate')
+        self.client = self.redis.Redis.from_url.return_value
+        self.pubsub = self.client.pubsub.return_value
+
+    def test_groups(self):
+        """ Keep the keys of a group in a set, and delete them without scanning """
+        self.backend.set('test:1:2', '"b"', 1.5, group='test:group:1')
+        pipeline = self.client.pipeline.return_value
+        pipeline.set.assert_called_once_with('test:1:2', '"b"', px=1500)
+        pipeline.sadd.assert_called_once_with('test:group:1', 'test:1:2')
+        pipeline.pexpire.assert_called_once_with('test:group:1', 1500)
+        pipeline.execute.assert_called_once_with()
+
+        self.client.smembers.return_value = {b'test:1:2'}
+        self.backend.delete_group('test:group:1')
+        self.client.delete.assert_any_call('test:group:1')
+        self.client.delete.assert_any_call(b'test:1:2')
+        self.client.scan_iter.assert_not_called()
+
+    def test_listener_started_again(self):
+        """ Start the invalidation listener again when its thread died """
+        self.backend.subscribe(MagicMock())
+        self.assertEqual(self.pubsub.run_in_thread.call_count, 1)
+        self.backend.get('test:1')
+        self.assertEqual(self.pubsub.run_in_thread.call_count, 1)
+        self.pubsub.run_in_thread.return_value.is_alive.return_value = False
+        self.backend.get('test:1')
+        self.assertEqual(self.pubsub.run_in_thread.call_count, 2)
+
+    def test_listen_backoff(self):
+        """ Wait before listening again when Redis can't be reached """
+        self.pubsub.subscribe.side_effect = FakeRedisError('down')
+        with patch('service.cache.time.monotonic', return_value=100.0):
+            self.backend.subscribe(MagicMock())
+            self.backend.get('test:1')
+            self.backend.get('test:1')
+        self.assertEqual(self.pubsub.subscribe.call_count, 1)
+        self.pubsub.subscribe.side_effect = None
+        with patch('service.cache.time.monotonic', return_value=100.0 + self.backend.retry_seconds):
+            self.backend.get('test:1')
+        self.assertEqual(self.pubsub.subscribe.call_count, 2)
+        self.pubsub.run_in_thread.assert_called_once()
@@ -0,0 +1,77 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the HTTP clients of the downstream services
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import socket
+import unittest
+from unittest.mock import patch
+
+import requests
+from werkzeug.exceptions import InternalServerError
+
+from service.clients import HTTPClient
+from service.models import Product
+
+#######################################################################
+#  T E S T   C A S E S
+#######################################################################
+class TestHTTPClient(unittest.TestCase):
+    """ Test Cases for HTTPClient """
+
+    def setUp(self):
+        self.client = HTTPClient(pool_size=4, connect_timeout=0.5, read_timeout=0.1)
+        # a server that accepts connections but never answers
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.url = 'http://127.0.0.1:%s/' % self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_environment(self):
+        """ Read the pool size and timeouts from the environment """
+        with patch.dict('os.environ', {'HTTP_POOL_SIZE': '3', 'HTTP_CONNECT_TIMEOUT': '1',
+                                       'HTTP_READ_TIMEOUT': '2'}):
+            client = HTTPClient()
+        self.assertEqual(client.pool_size, 3)
+        self.assertEqual(client.timeout, (1.0, 2.0))
+
+    def test_session_per_process(self):
+        """ Reuse the session in a process and make a new one after a fork """
+        session = self.client.session()
+        self.assertIs(self.client.session(), session)
+        adapter = session.get_adapter(self.url)
+        self.assertEqual(adapter._pool_maxsize, 4)  # pylint: disable=protected-access
+        with patch('os.getpid', return_value=-1):
+            self.assertIsNot(self.client.session(), session)
+
+    def test_read_timeout(self):
+        """ Give up on a service that doesn't answer """
+        self.assertRaises(requests.exceptions.ReadTimeout, self.client.get, self.url)
+        self.assertRaises(requests.exceptions.ReadTimeout, self.client.post, self.url, json={})
+
+    def test_product_timeout(self):
+        """ Fail a product lookup when the Product service doesn't answer """
+        Product.cache.clear()
+        with patch.object(Product, 'http', self.client), \
+                patch.object(Product, 'PRODUCT_SERV_URL', self.url.rstrip('/')):
+            self.assertRaises(InternalServerError, Product.get_product_details, 1)
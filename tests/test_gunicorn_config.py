@@ -0,0 +1,106 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the gunicorn configuration
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import logging
+from unittest.mock import MagicMock, patch
+
+from service.models import Wishlist, DB, DatabaseConnection
+from service.service import app, init_db, initialize_logging, disconnect_db
+
+# one worker, so that importing it doesn't turn on the multiprocess metrics
+with patch.dict(os.environ, {'WEB_CONCURRENCY': '1'}):
+    import gunicorn_config
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:////tmp/test.db')
+MB = 1024 ** 2
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestGunicornConfig(unittest.TestCase):
+    """ Gunicorn Configuration Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        app.debug = False
+        initialize_logging(logging.INFO)
+        # Set up the test database
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        disconnect_db()
+
+    def setUp(self):
+        """ Runs before each test """
+        DB.drop_all()    # clean up the last tests
+        DB.create_all()  # create new tables
+
+    def tearDown(self):
+        DB.session.remove()
+        DB.drop_all()
+
+    def test_parse_memory(self):
+        """ Parse the memory sizes of Cloud Foundry """
+        self.assertEqual(gunicorn_config.parse_memory('512M'), 512 * MB)
+        self.assertEqual(gunicorn_config.parse_memory('1g'), 1024 * MB)
+        self.assertEqual(gunicorn_config.parse_memory('1.5GB'), 1536 * MB)
+        self.assertEqual(gunicorn_config.parse_memory('4096'), 4096)
+        self.assertIsNone(gunicorn_config.parse_memory(''))
+        self.assertIsNone(gunicorn_config.parse_memory('lots'))
+
+    def test_workers_for(self):
+        """ Run two workers per CPU plus one, as many as fit in memory """
+        self.assertEqual(gunicorn_config.workers_for(1, 4096 * MB, 100 * MB), 3)
+        self.assertEqual(gunicorn_config.workers_for(4, 4096 * MB, 100 * MB), 9)
+        self.assertEqual(gunicorn_config.workers_for(4, 512 * MB, 100 * MB), 4)
+        self.assertEqual(gunicorn_config.workers_for(4, 128 * MB, 100 * MB), 1)
+
+    def test_memory_limit(self):
+        """ Take the memory of the instance from MEMORY_LIMIT """
+        with patch.dict(os.environ, {'MEMORY_LIMIT': '512M'}):
+            self.assertEqual(gunicorn_config.memory_limit(), 512 * MB)
+        self.assertGreaterEqual(gunicorn_config.cpu_count(), 1)
+
+    def test_fork(self):
+        """ Close the connections of the master before forking and in the worker after """
+        with patch.object(DatabaseConnection, 'dispose') as dispose:
+            gunicorn_config.pre_fork(MagicMock(), MagicMock())
+            gunicorn_config.post_fork(MagicMock(), MagicMock())
+        self.assertEqual(dispose.call_count, 2)
+
+    def test_dispose(self):
+        """ Open new connections after disposing of them """
+        Wishlist(name='wishlist', customer_id=1).save()
+        pool = DB.engine.pool
+        DatabaseConnection.dispose()
+        self.assertIsNot(DB.engine.pool, pool)
+        self.assertEqual(Wishlist.find_by_all(name='wishlist').count(), 1)
+
+    def test_child_exit(self):
+        """ Drop the live metrics of a worker that exited """
+        with patch('service.metrics.worker_exit') as worker_exit:
+            gunicorn_config.child_exit(MagicMock(), MagicMock(pid=42))
+        worker_exit.assert_called_once_with(42)
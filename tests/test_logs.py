@@ -0,0 +1,128 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the log handlers
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import io
+import json
+import logging
+import unittest
+
+from service.logs import BackgroundHandler, create_handler, log_body
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLogs(unittest.TestCase):
+    """ Test Cases for the log handlers """
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.logger = logging.getLogger('test_logs')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def use(self, handler):
+        """ Makes the test logger write with a handler """
+        self.logger.addHandler(handler)
+        return handler
+
+    def lines(self):
+        """ Returns the lines written so far """
+        return self.stream.getvalue().splitlines()
+
+    def test_text(self):
+        """ Write a line of text for each record """
+        self.use(create_handler(logging.INFO, self.stream, 'text', False))
+        self.logger.info('hello %s', 'world')
+        self.logger.debug('not written')
+        self.assertEqual(len(self.lines()), 1)
+        self.assertIn('INFO in test_logs: hello world', self.lines()[0])
+
+    def test_json(self):
+        """ Write a JSON object for each record """
+        self.use(create_handler(logging.INFO, self.stream, 'json', False))
+        self.logger.info('hello %s', 'world')
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('failed')
+        first, second = [json.loads(line) for line in self.lines()]
+        self.assertEqual(first['message'], 'hello world')
+        self.assertEqual(first['level'], 'INFO')
+        self.assertEqual(first['logger'], 'test_logs')
+        self.assertIn('ValueError: boom', second['exception'])
+
+    def test_queued(self):
+        """ Write the records from a background thread """
+        handler = self.use(create_handler(logging.INFO, self.stream, 'json', True))
+        self.assertIsInstance(handler, BackgroundHandler)
+        for number in range(100):
+            self.logger.info('line %d', number)
+        handler.close()    # waits for the queue to be written out
+        self.assertEqual(len(self.lines()), 100)
+        self.assertEqual(json.loads(self.lines()[-1])['message'], 'line 99')
+        # and starts again when there is more
+        self.logger.info('again')
+        handler.close()
+        self.assertEqual(json.loads(self.lines()[-1])['message'], 'again')
+
+    def test_queued_exception(self):
+        """ Write the traceback of a queued record apart from its message """
+        for fmt in ['json', 'text']:
+            handler = self.use(create_handler(logging.INFO, self.stream, fmt, True))
+            try:
+                raise ValueError('boom')
+            except ValueError:
+                self.logger.exception('failed %s', fmt)
+            handler.close()
+            self.logger.removeHandler(handler)
+        entry = json.loads(self.lines()[0])
+        self.assertEqual(entry['message'], 'failed json')
+        self.assertIn('ValueError: boom', entry['exception'])
+        self.assertIn('ERROR in test_logs: failed text', self.lines()[1])
+        self.assertIn('ValueError: boom', self.lines()[-1])
+
+    def test_log_body(self):
+        """ Log request bodies """
+        self.use(create_handler(logging.INFO, self.stream, 'text', False))
+        log_body(self.logger, {'name': 'wishlist'}, sample_rate=1, max_length=0)
+        self.assertIn("Body: {'name': 'wishlist'}", self.lines()[-1])
+
+    def test_log_body_truncated(self):
+        """ Cut long request bodies """
+        self.use(create_handler(logging.INFO, self.stream, 'text', False))
+        log_body(self.logger, 'x' * 100, sample_rate=1, max_length=10)
+        self.assertTrue(self.lines()[-1].endswith('Body: xxxxxxxxxx... (100 characters)'))
+
+    def test_log_body_sampled(self):
+        """ Log only a sample of the request bodies """
+        self.use(create_handler(logging.INFO, self.stream, 'text', False))
+        for _ in range(10):
+            log_body(self.logger, 'body', sample_rate=0, max_length=0)
+        self.assertEqual(self.lines(), [])
+        self.logger.setLevel(logging.WARNING)
+        log_body(self.logger, 'body', sample_rate=1, max_length=0)
+        self.assertEqual(self.lines(), [])
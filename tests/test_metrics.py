@@ -0,0 +1,121 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Prometheus metrics
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import logging
+from unittest.mock import MagicMock
+
+from flask_api import status    # HTTP Status Codes
+from prometheus_client import REGISTRY
+
+from service import metrics
+from service.models import Wishlist, DB
+from service.service import app, init_db, initialize_logging, disconnect_db
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:////tmp/test.db')
+
+
+def sample(name, **labels):
+    """ Returns the value of a metric, 0 when it wasn't recorded yet """
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Prometheus Metrics Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        app.debug = False
+        initialize_logging(logging.INFO)
+        # Set up the test database
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        disconnect_db()
+
+    def setUp(self):
+        """ Runs before each test """
+        DB.drop_all()    # clean up the last tests
+        DB.create_all()  # create new tables
+        self.app = app.test_client()
+
+    def tearDown(self):
+        DB.session.remove()
+        DB.drop_all()
+
+    def test_requests(self):
+        """ Count the requests of each endpoint, method and status """
+        Wishlist(name='wishlist', customer_id=1).save()
+        labels = {'endpoint': 'wishlist_resource', 'method': 'GET'}
+        found = sample('wishlists_http_requests_total', status='200', **labels)
+        missing = sample('wishlists_http_requests_total', status='404', **labels)
+        timed = sample('wishlists_http_request_duration_seconds_count', **labels)
+        self.app.get('/api/wishlists/1')
+        self.app.get('/api/wishlists/2')
+        self.assertEqual(sample('wishlists_http_requests_total', status='200', **labels),
+                         found + 1)
+        self.assertEqual(sample('wishlists_http_requests_total', status='404', **labels),
+                         missing + 1)
+        self.assertEqual(sample('wishlists_http_request_duration_seconds_count', **labels),
+                         timed + 2)
+        self.assertEqual(sample('wishlists_http_requests_in_progress', **labels), 0)
+
+    def test_queries(self):
+        """ Count the SQL statements of each endpoint """
+        queries = sample('wishlists_db_queries_total', endpoint='wishlist_collection')
+        resp = self.app.post('/api/wishlists', json={'name': 'wishlist', 'customer_id': 1})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertGreater(sample('wishlists_db_queries_total', endpoint='wishlist_collection'),
+                           queries)
+        self.assertGreater(sample('wishlists_db_query_duration_seconds_count',
+                                  endpoint='wishlist_collection'), 0)
+
+    def test_downstream(self):
+        """ Time the calls to the downstream services by status """
+        calls = sample('wishlists_downstream_request_duration_seconds_count',
+                       service='test', status='404')
+        errors = sample('wishlists_downstream_request_duration_seconds_count',
+                        service='test', status='error')
+        call = metrics.downstream('test')(MagicMock(return_value=MagicMock(status_code=404)))
+        self.assertEqual(call().status_code, 404)
+        fail = metrics.downstream('test')(MagicMock(side_effect=ValueError('down')))
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(sample('wishlists_downstream_request_duration_seconds_count',
+                                service='test', status='404'), calls + 1)
+        self.assertEqual(sample('wishlists_downstream_request_duration_seconds_count',
+                                service='test', status='error'), errors + 1)
+
+    def test_metrics_endpoint(self):
+        """ Export the metrics in the text format of Prometheus """
+        self.app.get('/api/wishlists')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        body = resp.get_data(as_text=True)
+        self.assertIn('wishlists_http_requests_total{endpoint="wishlist_collection"', body)
+        self.assertIn('wishlists_http_request_duration_seconds_bucket', body)
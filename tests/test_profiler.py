@@ -0,0 +1,145 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the request profiler
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import logging
+import pstats
+import tempfile
+
+from flask_api import status    # HTTP Status Codes
+
+from service.models import DB, Wishlist
+from service.profiler import PROFILES, ProfileBuffer
+from service.service import app, init_db, initialize_logging, disconnect_db, PROFILER
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:////tmp/test.db')
+TOKEN = {'X-Profile-Token': 'secret'}
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestProfiler(unittest.TestCase):
+    """ Request Profiler Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        app.debug = False
+        initialize_logging(logging.INFO)
+        # Set up the test database
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        disconnect_db()
+
+    def setUp(self):
+        """ Runs before each test """
+        DB.drop_all()    # clean up the last tests
+        DB.create_all()  # create new tables
+        PROFILES.clear()
+        PROFILER.token = 'secret'
+        PROFILER.sample_rate = 0
+        self.app = app.test_client()
+
+    def tearDown(self):
+        PROFILER.token = None
+        PROFILES.clear()
+        DB.session.remove()
+        DB.drop_all()
+
+    def test_off(self):
+        """ Profile nothing unless asked to """
+        resp = self.app.get('/api/wishlists')
+        self.assertNotIn('X-Profile-Id', resp.headers)
+        resp = self.app.get('/api/wishlists', headers={'X-Profile-Token': 'wrong'})
+        self.assertNotIn('X-Profile-Id', resp.headers)
+        self.assertEqual(PROFILES.summaries(), [])
+
+    def test_token(self):
+        """ Profile a request that sends the token """
+        Wishlist(name='wishlist', customer_id=1).save()
+        resp = self.app.get('/api/wishlists?name=wishlist', headers=TOKEN)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        profile_id = int(resp.headers['X-Profile-Id'])
+        resp = self.app.get('/api/admin/profiles', headers=TOKEN)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        summary, = resp.get_json()
+        self.assertEqual(summary['id'], profile_id)
+        self.assertEqual(summary['path'], '/api/wishlists')
+        self.assertEqual(summary['query'], 'name=wishlist')
+        self.assertEqual(summary['status'], status.HTTP_200_OK)
+        self.assertEqual(summary['trigger'], 'token')
+
+    def test_sample(self):
+        """ Profile a sample of the requests """
+        PROFILER.sample_rate = 1
+        resp = self.app.get('/api/wishlists')
+        self.assertIn('X-Profile-Id', resp.headers)
+        self.assertEqual(PROFILES.summaries()[0]['trigger'], 'sample')
+
+    def test_download(self):
+        """ Download the stats of a profile """
+        profile_id = self.app.get('/api/wishlists', headers=TOKEN).headers['X-Profile-Id']
+        resp = self.app.get('/api/admin/profiles/%s' % profile_id, headers=TOKEN)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('profile-%s.prof' % profile_id, resp.headers['Content-Disposition'])
+        with tempfile.NamedTemporaryFile(suffix='.prof') as stats_file:
+            stats_file.write(resp.data)
+            stats_file.flush()
+            stats = pstats.Stats(stats_file.name)
+        self.assertGreater(stats.total_calls, 0)
+
+        resp = self.app.get('/api/admin/profiles/%s?format=text' % profile_id, headers=TOKEN)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('function calls', resp.get_data(as_text=True))
+        self.assertEqual(len(PROFILES.summaries()), 1)
+
+    def test_download_not_found(self):
+        """ Download a profile that isn't there """
+        resp = self.app.get('/api/admin/profiles/0', headers=TOKEN)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/api/admin/profiles/0?format=text', headers=TOKEN)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_download_needs_token(self):
+        """ Download profiles only with the token """
+        resp = self.app.get('/api/admin/profiles')
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+        # not even without a token: the profiles show the queries and data of the requests
+        PROFILER.token = None
+        PROFILER.sample_rate = 1
+        self.app.get('/api/wishlists')
+        resp = self.app.get('/api/admin/profiles')
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+        resp = self.app.get('/api/admin/profiles/1')
+        self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_buffer_bounded(self):
+        """ Keep only the last profiles """
+        buffer = ProfileBuffer(2)
+        for _ in range(3):
+            buffer.add({'id': buffer.next_id()}, {})
+        self.assertEqual([summary['id'] for summary in buffer.summaries()], [3, 2])
+        self.assertIsNone(buffer.stats(1))
+        self.assertIsNotNone(buffer.stats(3))
@@ -0,0 +1,119 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for read replica routing
+
+The primary and the replicas are separate SQLite files holding different
+data, so the responses tell which database served them.
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+import logging
+from unittest.mock import patch
+
+from flask_api import status    # HTTP Status Codes
+from sqlalchemy import create_engine
+
+from service.models import Wishlist, DB, DatabaseConnection
+from service.replicas import REPLICAS, LAST_WRITE_COOKIE
+from service.service import app, init_db, initialize_logging, disconnect_db
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:////tmp/test.db')
+REPLICA_URIS = ['sqlite:////tmp/test_replica1.db', 'sqlite:////tmp/test_replica2.db']
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestReplicas(unittest.TestCase):
+    """ Read Replica Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        app.debug = False
+        initialize_logging(logging.INFO)
+        # Set up the test database
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        disconnect_db()
+
+    def setUp(self):
+        """ Runs before each test """
+        DB.drop_all()    # clean up the last tests
+        DB.create_all()  # create new tables
+        Wishlist(name='primary', customer_id=1).save()
+        for index, uri in enumerate(REPLICA_URIS):
+            engine = create_engine(uri)
+            DB.metadata.drop_all(engine)
+            DB.metadata.create_all(engine)
+            engine.execute(Wishlist.__table__.insert(), id=1, name='replica%s' % index,
+                           customer_id=1)
+            engine.dispose()
+        self.config = patch.dict(app.config, {'DATABASE_REPLICA_URIS': REPLICA_URIS})
+        self.config.start()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        self.config.stop()
+        REPLICAS.dispose()
+        DB.session.remove()
+        DB.drop_all()
+
+    def get_name(self, url):
+        """ Returns the name of the wishlist read from a url """
+        DB.session.remove()    # don't answer from the identity map of the last request
+        DatabaseConnection.clear_caches()    # nor from the rows it cached
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        return data[0]['name'] if isinstance(data, list) else data['name']
+
+    def test_reads_round_robin(self):
+        """ Reads are spread over the replicas """
+        names = [self.get_name('/api/wishlists/1') for _ in range(4)]
+        self.assertEqual(sorted(names), ['replica0', 'replica0', 'replica1', 'replica1'])
+        self.assertNotEqual(names[0], names[1])
+        self.assertIn(self.get_name('/api/wishlists'), ['replica0', 'replica1'])
+
+    def test_writes_go_to_primary(self):
+        """ Writes are made on the primary """
+        resp = self.app.put('/api/wishlists/1', json={'name': 'renamed'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        DB.session.remove()
+        self.assertEqual(Wishlist.find(1).name, 'renamed')
+
+    def test_read_your_writes(self):
+        """ A client that just wrote reads from the primary """
+        resp = self.app.put('/api/wishlists/1', json={'name': 'renamed'})
+        self.assertIn(LAST_WRITE_COOKIE, resp.headers['Set-Cookie'])
+        self.assertEqual(self.get_name('/api/wishlists/1'), 'renamed')
+
+        with patch.dict(app.config, {'READ_YOUR_WRITES_SECONDS': 0}):
+            self.assertIn(self.get_name('/api/wishlists/1'), ['replica0', 'replica1'])
+
+    def test_no_replicas(self):
+        """ Without replicas every read goes to the primary """
+        with patch.dict(app.config, {'DATABASE_REPLICA_URIS': [], 'FIND_CACHE_SIZE': 0}):
+            self.assertEqual(self.get_name('/api/wishlists/1'), 'primary')
+            resp = self.app.put('/api/wishlists/1', json={'name': 'renamed'})
+            self.assertNotIn('Set-Cookie', resp.headers)
@@ -24,13 +24,18 @@ Test cases can be run with the following:
 import unittest
 import os
 import logging
+import threading
+import time
 from unittest.mock import MagicMock, patch
 
 import requests
 from flask_api import status    # HTTP Status Codes
 
-from service.models import Wishlist, DB, WishlistProduct
+from service.models import Wishlist, DB, WishlistProduct, Product, ShopCart, \
+    DatabaseConnection
 from service.service import app, init_db, initialize_logging, disconnect_db
+from service.replicas import LAST_WRITE_COOKIE
+from tests.helpers import assert_max_queries, count_statements, find_caches
 
 DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:////tmp/test.db')
 
@@ -57,6 +62,9 @@ class TestWishlistServer(unittest.TestCase):
         """ Runs before each test """
         DB.drop_all()    # clean up the last tests
         DB.create_all()  # create new tables
+        Product.cache.clear()
+        Product.breaker.reset()
+        ShopCart.breaker.reset()
         self.app = app.test_client()
 
     def tearDown(self):
@@ -103,6 +111,50 @@ class TestWishlistServer(unittest.TestCase):
         }, headers={'content-type': 'text/plain'})
         self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
+    def test_create_wishlists_batch(self):
+        """ Test creating many wishlists in one request """
+        resp = self.app.post('/api/wishlists:batch', json=[
+            {'name': 'wishlist_name%s' % i, 'customer_id': 100 + i} for i in range(3)
+        ])
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual([w['id'] for w in data], [1, 2, 3])
+        self.assertEqual([w['name'] for w in data],
+                         ['wishlist_name0', 'wishlist_name1', 'wishlist_name2'])
+        self.assertEqual(len(Wishlist.all()), 3)
+        self.assertEqual(Wishlist.find(3).customer_id, 102)
+
+    def test_create_wishlists_batch_400(self):
+        """ Test a batch with an invalid entry creates nothing """
+        resp = self.app.post('/api/wishlists:batch', json=[
+            {'name': 'wishlist_name', 'customer_id': 100},
+            {'name': 'wishlist_name', 'customer_id': -1},
+        ])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('entry 1', resp.get_json()['message'])
+        self.assertEqual(len(Wishlist.all()), 0)
+
+        resp = self.app.post('/api/wishlists:batch', json=[])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/api/wishlists:batch', json={'name': 'wishlist_name'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/api/wishlists:batch', json=['wishlist_name'])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_wishlists_batch_too_large(self):
+        """ Test a batch larger than the maximum batch size """
+        with patch.dict(app.config, {'MAX_BATCH_SIZE': 2}):
+            resp = self.app.post('/api/wishlists:batch', json=[
+                {'name': 'wishlist_name', 'customer_id': 100} for _ in range(3)
+            ])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_wishlists_batch_415(self):
+        """ Test creating a batch of wishlists with unsupported content type """
+        resp = self.app.post('/api/wishlists:batch', data='[]',
+                             headers={'content-type': 'text/plain'})
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
     def test_list_empty_wishlists(self):
         """ Test listing wishlists if there is no data """
         resp = self.app.get('/api/wishlists')
@@ -135,6 +187,64 @@ class TestWishlistServer(unittest.TestCase):
         self.assertEqual(data[2]['id'], 3)
         self.assertEqual(data[2]['name'], "wishlist_name3")
 
+    def test_list_wishlists_paginated(self):
+        """ Test listing wishlists one page at a time """
+        for i in range(5):
+            Wishlist(name='wishlist_name%s' % i, customer_id=100).save()
+        resp = self.app.get('/api/wishlists?limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([w['id'] for w in resp.get_json()], [1, 2])
+        self.assertIn('after_id=2', resp.headers['Link'])
+        self.assertIn('rel="next"', resp.headers['Link'])
+
+        resp = self.app.get('/api/wishlists?limit=2&after_id=2')
+        self.assertEqual([w['id'] for w in resp.get_json()], [3, 4])
+
+        resp = self.app.get('/api/wishlists?limit=2&after_id=4')
+        self.assertEqual([w['id'] for w in resp.get_json()], [5])
+        self.assertNotIn('Link', resp.headers)
+
+    def test_list_wishlists_paginated_keeps_filters(self):
+        """ Test the next link of a filtered query keeps the filters """
+        for i in range(3):
+            Wishlist(name='wishlist_name', customer_id=100 + i % 2).save()
+        resp = self.app.get('/api/wishlists?customer_id=100&limit=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()[0]['id'], 1)
+        self.assertIn('customer_id=100', resp.headers['Link'])
+        resp = self.app.get('/api/wishlists?customer_id=100&limit=1&after_id=1')
+        self.assertEqual(resp.get_json()[0]['id'], 3)
+
+    def test_list_wishlists_invalid_limit(self):
+        """ Test listing wishlists with a limit out of range """
+        resp = self.app.get('/api/wishlists?limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/api/wishlists?limit=%s' % (app.config['MAX_PAGE_SIZE'] + 1))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/api/wishlists?limit=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_wishlists(self):
+        """ Test streaming every matching wishlist as a JSON array """
+        for i in range(5):
+            Wishlist(name='wishlist_name%s' % i, customer_id=100 + i % 2).save()
+        with patch.dict(app.config, {'STREAM_CHUNK_SIZE': 2}):
+            resp = self.app.get('/api/wishlists?stream=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual([w['id'] for w in resp.get_json()], [1, 2, 3, 4, 5])
+        self.assertEqual(resp.get_json(), self.app.get('/api/wishlists').get_json())
+
+        resp = self.app.get('/api/wishlists?stream=true&customer_id=100&after_id=1')
+        self.assertEqual([w['id'] for w in resp.get_json()], [3, 5])
+
+    def test_stream_empty_wishlists(self):
+        """ Test streaming wishlists if there is no data """
+        resp = self.app.get('/api/wishlists?stream=true')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/api/wishlists?stream=true&limit=10')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_wishlist(self):
         """ Test get Wishlist """
         resp = self.app.post('/api/wishlists', json={
@@ -144,6 +254,114 @@ class TestWishlistServer(unittest.TestCase):
         resp = self.app.get('/api/wishlists/%s' % 1)
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_get_wishlist_expand_items(self):
+        """ Test get Wishlist with its items """
+        wishlist = Wishlist(name='wishlist_name1', customer_id=100)
+        wishlist.save()
+        for product_id in [2, 1]:
+            WishlistProduct(wishlist_id=wishlist.id, product_id=product_id,
+                            product_name='product%s' % product_id).save()
+        resp = self.app.get('/api/wishlists/%s?expand=items' % wishlist.id)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data['name'], 'wishlist_name1')
+        self.assertEqual([item['product_id'] for item in data['items']], [1, 2])
+        self.assertEqual(data['items'][0]['product_name'], 'product1')
+
+        resp = self.app.get('/api/wishlists/%s' % wishlist.id)
+        self.assertNotIn('items', resp.get_json())
+        resp = self.app.get('/api/wishlists/%s?expand=other' % wishlist.id)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_wishlist_etag(self):
+        """ Test a Wishlist and its items answer If-None-Match with 304 """
+        wishlist = Wishlist(name='wishlist', customer_id=100)
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=1, product_name='product').save()
+        for url in ['/api/wishlists/1', '/api/wishlists/1?expand=items',
+                    '/api/wishlists/1/items', '/api/wishlists/1/items?stream=true',
+                    '/api/wishlists/1/items/1']:
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            etag = resp.headers['ETag']
+            DB.session.expire_all()
+            resp, statements = count_statements(self.app.get, url,
+                                                headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED, url)
+            self.assertEqual(resp.headers['ETag'], etag)
+            self.assertEqual(resp.data, b'')
+            self.assertEqual(len(statements), 1, url)
+
+    def test_wishlist_etag_changes(self):
+        """ Test the ETag of a Wishlist changes with every write to it or its items """
+        wishlist = Wishlist(name='wishlist', customer_id=100)
+        wishlist.save()
+        etags = [self.app.get('/api/wishlists/1/items').headers.get('ETag')]
+        writes = [
+            lambda: self.app.post('/api/wishlists/1/items',
+                                  json={'product_id': 1, 'product_name': 'product'}),
+            lambda: self.app.put('/api/wishlists/1/items/1',
+                                 json={'product_id': 1, 'product_name': 'renamed'}),
+            lambda: self.app.post('/api/wishlists/1/items:batch',
+                                  json=[{'product_id': 2, 'product_name': 'product'}]),
+            lambda: self.app.delete('/api/wishlists/1/items/2'),
+            lambda: self.app.put('/api/wishlists/1',
+                                 json={'name': 'renamed', 'customer_id': 100}),
+        ]
+        for write in writes:
+            self.assertLess(write().status_code, 300)
+            etag = self.app.get('/api/wishlists/1').headers['ETag']
+            self.assertNotIn(etag, etags)
+            etags.append(etag)
+            resp = self.app.get('/api/wishlists/1/items', headers={'If-None-Match': etags[-2]})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_wishlist_etag_recreated(self):
+        """ Test a Wishlist created after one was deleted gets neither its ETag nor its items """
+        wishlist = Wishlist(name='wishlist', customer_id=100)
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=1, product_name='product').save()
+        resp = self.app.get('/api/wishlists/%s/items' % wishlist.id)
+        self.assertEqual(len(resp.get_json()), 1)
+        etag = resp.headers['ETag']
+        self.assertEqual(self.app.delete('/api/wishlists/%s' % wishlist.id).status_code,
+                         status.HTTP_204_NO_CONTENT)
+
+        resp = self.app.post('/api/wishlists', json={'name': 'new', 'customer_id': 100})
+        new_id = resp.get_json()['id']
+        self.assertNotEqual(new_id, wishlist.id)
+        self.app.post('/api/wishlists/%s/items' % new_id,
+                      json={'product_id': 2, 'product_name': 'other'})
+        resp = self.app.get('/api/wishlists/%s/items' % new_id, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual([item['product_id'] for item in resp.get_json()], [2])
+
+    def test_wishlist_etag_not_found(self):
+        """ Test a Wishlist that doesn't exist is not modified for no ETag """
+        resp = self.app.get('/api/wishlists/1/items', headers={'If-None-Match': '*'})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/api/wishlists/1/items/1', headers={'If-None-Match': '*'})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_wishlists_expand_items(self):
+        """ Test listing wishlists with their items loads them in one query """
+        for i in range(1, 4):
+            Wishlist(name='wishlist_name%s' % i, customer_id=100).save()
+            WishlistProduct(wishlist_id=i, product_id=i, product_name='product%s' % i).save()
+        Wishlist(name='empty', customer_id=100).save()
+        DB.session.expire_all()
+
+        resp, statements = count_statements(self.app.get, '/api/wishlists?expand=items')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(statements), 2)
+        data = resp.get_json()
+        self.assertEqual([len(w['items']) for w in data], [1, 1, 1, 0])
+        self.assertEqual(data[1]['items'][0]['product_id'], 2)
+
+        resp = self.app.get('/api/wishlists?expand=items&stream=true')
+        self.assertEqual(resp.get_json(), data)
+
     def test_get_invalid_wishlist(self):
         """ Test get Invalid Wishlist """
         resp = self.app.post('/api/wishlists', json={
@@ -235,6 +453,48 @@ class TestWishlistServer(unittest.TestCase):
 
         self.assertEqual(resp2.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_add_products_to_wishlist_batch(self):
+        """ Test adding many products to a wishlist in one request """
+        wishlist = Wishlist(name='test', customer_id=1)
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=2, product_name='macbook').save()
+
+        resp = self.app.post('/api/wishlists/%s/items:batch' % wishlist.id, json=[
+            {'product_id': 1, 'product_name': 'ipad'},
+            {'product_id': 2, 'product_name': 'macbook'},
+            {'product_id': 3, 'product_name': 'iphone'},
+            {'product_id': 1, 'product_name': 'ipad'},
+        ])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([item['product_id'] for item in data], [1, 2, 3, 1])
+        self.assertEqual([item['status'] for item in data],
+                         ['created', 'already-present', 'created', 'already-present'])
+        self.assertEqual(data[0]['wishlist_id'], wishlist.id)
+        self.assertEqual(len(WishlistProduct.all()), 3)
+
+    def test_add_products_to_wishlist_batch_400(self):
+        """ Test a batch of products with an invalid entry adds nothing """
+        wishlist = Wishlist(name='test', customer_id=1)
+        wishlist.save()
+        resp = self.app.post('/api/wishlists/%s/items:batch' % wishlist.id, json=[
+            {'product_id': 1, 'product_name': 'ipad'},
+            {'product_id': 2},
+        ])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('entry 1', resp.get_json()['message'])
+        self.assertEqual(len(WishlistProduct.all()), 0)
+
+        resp = self.app.post('/api/wishlists/%s/items:batch' % wishlist.id, json=[])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_add_products_to_wishlist_batch_404(self):
+        """ Test adding a batch of products to a wishlist that doesn't exist """
+        resp = self.app.post('/api/wishlists/124/items:batch', json=[
+            {'product_id': 1, 'product_name': 'ipad'},
+        ])
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_get_product(self):
         """ Test getting to a product from a wishlist """
         test_wishlist = Wishlist(name='test', customer_id=1)
@@ -452,6 +712,23 @@ class TestWishlistServer(unittest.TestCase):
         self.assertEqual(data[0]['product_name'], first_product['product_name'])
         self.assertEqual(data[1]['product_name'], second_product['product_name'])
 
+    def test_stream_items_in_wishlist(self):
+        """ Test streaming the items of a wishlist """
+        wishlist = Wishlist(name='mywishlist', customer_id=100)
+        wishlist.save()
+        for product_id in range(1, 4):
+            WishlistProduct(wishlist_id=wishlist.id, product_id=product_id,
+                            product_name='product%s' % product_id).save()
+        resp = self.app.get('/api/wishlists/%s/items?stream=true' % wishlist.id)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.is_streamed)
+        data = resp.get_json()
+        self.assertEqual(sorted(item['product_id'] for item in data), [1, 2, 3])
+        self.assertEqual(data[0]['wishlist_id'], wishlist.id)
+
+        resp = self.app.get('/api/wishlists/%s/items?stream=true&product_id=9' % wishlist.id)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_get_items_in_nonexistent_wishlist(self):
         """ Test getting items from a non-existing wishlist """
         resp = self.app.get('/api/wishlists/123/items')
@@ -727,6 +1004,269 @@ class TestWishlistServer(unittest.TestCase):
         resp = self.app.get('/api/wishlists')
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_pool_stats(self):
+        """ Test the connection pool statistics """
+        resp = self.app.get('/api/admin/pool')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('pool', resp.get_json())
+
+    def test_cache_stats(self):
+        """ Test the cache statistics """
+        Wishlist(customer_id=1, name="name").save()
+        for _ in range(2):
+            # new clients, which didn't just write, so that they look in the cache
+            app.test_client().put('/api/wishlists/1', json={'name': 'renamed', 'customer_id': 1})
+        resp = self.app.get('/api/admin/caches')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['products']['hits'], 0)
+        self.assertEqual(resp.get_json()['wishlists']['misses'], 2)
+        self.assertIn('hit_ratio', resp.get_json()['wishlist_products'])
+        self.assertIn('hit_ratio', resp.get_json()['wishlist_items'])
+
+    def test_list_items_cached(self):
+        """ Test the items of a wishlist are listed from the cache until it changes """
+        wishlist = Wishlist(name='wishlist', customer_id=100)
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=1, product_name='one').save()
+        url = '/api/wishlists/%s/items' % wishlist.id
+        self.assertEqual(len(self.app.get(url).get_json()), 1)
+        DB.session.expire_all()
+        resp, statements = count_statements(self.app.get, url)
+        self.assertEqual(len(resp.get_json()), 1)
+        self.assertEqual(len(statements), 1)    # only the version
+        WishlistProduct(wishlist_id=wishlist.id, product_id=2, product_name='two').save()
+        resp = self.app.get(url)
+        self.assertEqual([item['product_id'] for item in resp.get_json()], [1, 2])
+
+    def test_read_your_writes_across_workers(self):
+        """ Test a client that wrote doesn't read the row another worker cached """
+        with find_caches():
+            resp = self.app.post('/api/wishlists', json={'name': 'before', 'customer_id': 1})
+            self.assertIn(LAST_WRITE_COOKIE, resp.headers['Set-Cookie'])
+            wishlist_id = resp.get_json()['id']
+            url = '/api/wishlists/%s' % wishlist_id
+            reader = app.test_client()
+            self.assertEqual(reader.get(url).get_json()['name'], 'before')
+            DB.session.remove()
+
+            # another worker renames it, this one keeps its cached row
+            DB.session.execute("UPDATE wishlist SET name = 'after', version = version + 1 "
+                               "WHERE id = %d" % wishlist_id)
+            DB.session.commit()
+            DB.session.remove()
+            self.assertEqual(reader.get(url).get_json()['name'], 'before')
+            DB.session.remove()
+
+            writer = app.test_client()
+            writer.set_cookie('localhost', LAST_WRITE_COOKIE, '%.3f' % time.time())
+            resp = writer.get(url)
+            self.assertEqual(resp.get_json()['name'], 'after')
+            self.assertEqual(resp.headers['ETag'], '"%s-2"' % wishlist_id)
+
+    def test_breaker_stats(self):
+        """ Test the circuit breaker states """
+        resp = self.app.get('/api/admin/breakers')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['products']['state'], 'closed')
+        self.assertEqual(resp.get_json()['shopcarts']['state'], 'closed')
+
+    @patch('service.models.ShopCart._add_to_cart')
+    @patch('service.models.Product._get_product_details')
+    def test_add_to_cart_shopcarts_down(self, product_request_mock, shopcart_request_mock):
+        """ Test Add to cart fails fast once the ShopCarts service keeps failing """
+        wishlist = Wishlist(customer_id=1, name="name")
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=2, product_name='macbook').save()
+        product_request_mock.return_value = MagicMock(status_code=status.HTTP_200_OK)
+        product_request_mock.return_value.json.return_value = {"id": 2, "name": "macbook",
+                                                               "price": 20.0}
+        shopcart_request_mock.side_effect = requests.exceptions.ConnectionError('down')
+        for _ in range(ShopCart.breaker.failure_threshold):
+            resp = self.app.put('/api/wishlists/1/items/2/add-to-cart')
+            self.assertEqual(resp.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        resp = self.app.put('/api/wishlists/1/items/2/add-to-cart')
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(shopcart_request_mock.call_count, ShopCart.breaker.failure_threshold)
+        self.assertEqual(len(WishlistProduct.all()), 1)
+
+    @patch('service.models.ShopCart._add_to_cart')
+    @patch('service.models.Product._get_product_details')
+    def test_add_to_cart_caches_product(self, product_request_mock, shopcart_request_mock):
+        """ Test Add to cart looks up a product once for two customers """
+        for customer_id in [1, 2]:
+            wishlist = Wishlist(customer_id=customer_id, name="name")
+            wishlist.save()
+            WishlistProduct(wishlist_id=wishlist.id, product_id=2, product_name='macbook').save()
+        product_request_mock.return_value = MagicMock(status_code=status.HTTP_200_OK)
+        product_request_mock.return_value.json.return_value = {"id": 2, "name": "macbook",
+                                                               "price": 20.0}
+        shopcart_request_mock.return_value = MagicMock(status_code=status.HTTP_201_CREATED)
+        for wishlist_id in [1, 2]:
+            resp = self.app.put('/api/wishlists/%s/items/2/add-to-cart' % wishlist_id)
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(product_request_mock.call_count, 1)
+        self.assertEqual(Product.cache.stats()['hits'], 1)
+
+    @patch('service.models.Product._get_product_details')
+    def test_add_to_cart_caches_product_404(self, product_request_mock):
+        """ Test Add to cart remembers products the Product service doesn't know """
+        wishlist = Wishlist(customer_id=1, name="name")
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=2, product_name='macbook').save()
+        product_request_mock.return_value = MagicMock(status_code=status.HTTP_404_NOT_FOUND)
+        for _ in range(2):
+            resp = self.app.put('/api/wishlists/1/items/2/add-to-cart')
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(product_request_mock.call_count, 1)
+
+    def test_wishlist_add_to_cart_not_exist(self):
+        """ Test moving a Wishlist that doesn't exist to the cart """
+        resp = self.app.put('/api/wishlists/1/add-to-cart')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_wishlist_add_to_cart_empty(self):
+        """ Test moving an empty Wishlist to the cart """
+        Wishlist(customer_id=1, name="name").save()
+        resp = self.app.put('/api/wishlists/1/add-to-cart')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+
+    @patch('service.models.ShopCart._add_to_cart')
+    @patch('service.models.Product._get_product_details')
+    def test_wishlist_add_to_cart(self, product_request_mock, shopcart_request_mock):
+        """ Test moving every item of a Wishlist to the cart """
+        wishlist = Wishlist(customer_id=7, name="name")
+        wishlist.save()
+        for product_id in range(1, 6):
+            WishlistProduct(wishlist_id=wishlist.id, product_id=product_id,
+                            product_name='product %s' % product_id).save()
+        other_wishlist = Wishlist(customer_id=8, name="other")
+        other_wishlist.save()
+        WishlistProduct(wishlist_id=other_wishlist.id, product_id=1, product_name='kept').save()
+
+        def product_details(product_id):
+            if product_id == 3:
+                return MagicMock(status_code=status.HTTP_404_NOT_FOUND)
+            return MagicMock(status_code=status.HTTP_200_OK,
+                             json=MagicMock(return_value={"id": product_id, "price": 2.0,
+                                                          "name": "product"}))
+        product_request_mock.side_effect = product_details
+        shopcart_request_mock.return_value = MagicMock(status_code=status.HTTP_201_CREATED)
+
+        resp = self.app.put('/api/wishlists/%s/add-to-cart' % wishlist.id)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = resp.get_json()
+        self.assertEqual([result['product_id'] for result in results], [1, 2, 3, 4, 5])
+        self.assertEqual([result['status'] for result in results],
+                         ['moved', 'moved', 'failed', 'moved', 'moved'])
+        self.assertEqual(results[2]['code'], status.HTTP_404_NOT_FOUND)
+        self.assertNotIn('message', results[0])
+        self.assertEqual(shopcart_request_mock.call_count, 4)
+        for call in shopcart_request_mock.call_args_list:
+            self.assertEqual(call[0][0], 7)
+
+        # only the failed item is left, and the other wishlist is untouched
+        remaining = sorted((item.wishlist_id, item.product_id) for item in WishlistProduct.all())
+        self.assertEqual(remaining, [(wishlist.id, 3), (other_wishlist.id, 1)])
+
+    @patch('service.models.ShopCart._add_to_cart')
+    @patch('service.models.Product._get_product_details')
+    def test_wishlist_add_to_cart_shopcarts_error(self, product_request_mock,
+                                                  shopcart_request_mock):
+        """ Test moving a Wishlist to the cart when ShopCarts fails """
+        wishlist = Wishlist(customer_id=1, name="name")
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=1, product_name='macbook').save()
+        product_request_mock.return_value = MagicMock(status_code=status.HTTP_200_OK)
+        product_request_mock.return_value.json.return_value = {"id": 1, "name": "macbook",
+                                                               "price": 20.0}
+        shopcart_request_mock.side_effect = requests.exceptions.ConnectionError('down')
+        resp = self.app.put('/api/wishlists/1/add-to-cart')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()[0]['status'], 'failed')
+        self.assertEqual(resp.get_json()[0]['code'], status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(len(WishlistProduct.all()), 1)
+
+    @patch('service.models.ShopCart._add_to_cart')
+    @patch('service.models.Product._get_product_details')
+    def test_wishlist_add_to_cart_unexpected_error(self, product_request_mock,
+                                                   shopcart_request_mock):
+        """ Test the moved items are deleted when another item fails with any error """
+        wishlist = Wishlist(customer_id=1, name="name")
+        wishlist.save()
+        for product_id in [1, 2]:
+            WishlistProduct(wishlist_id=wishlist.id, product_id=product_id,
+                            product_name='macbook').save()
+
+        def product_details(product_id):
+            if product_id == 2:
+                # a body that isn't JSON
+                return MagicMock(status_code=status.HTTP_200_OK,
+                                 json=MagicMock(side_effect=ValueError('not JSON')))
+            return MagicMock(status_code=status.HTTP_200_OK,
+                             json=MagicMock(return_value={"id": product_id, "price": 2.0,
+                                                          "name": "macbook"}))
+        product_request_mock.side_effect = product_details
+        shopcart_request_mock.return_value = MagicMock(status_code=status.HTTP_201_CREATED)
+        resp = self.app.put('/api/wishlists/1/add-to-cart')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = resp.get_json()
+        self.assertEqual([result['status'] for result in results], ['moved', 'failed'])
+        self.assertEqual(results[1]['code'], status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(results[1]['message'], 'not JSON')
+        self.assertEqual(shopcart_request_mock.call_count, 1)
+        self.assertEqual([item.product_id for item in WishlistProduct.all()], [2])
+
+    @patch('service.models.ShopCart._add_to_cart')
+    @patch('service.models.Product._get_product_details')
+    def test_wishlist_add_to_cart_concurrent(self, product_request_mock, shopcart_request_mock):
+        """ Test the items of a Wishlist are looked up at the same time """
+        wishlist = Wishlist(customer_id=1, name="name")
+        wishlist.save()
+        for product_id in [1, 2]:
+            WishlistProduct(wishlist_id=wishlist.id, product_id=product_id,
+                            product_name='macbook').save()
+        both_looking_up = threading.Barrier(2, timeout=5)
+
+        def product_details(product_id):
+            both_looking_up.wait()
+            return MagicMock(status_code=status.HTTP_200_OK,
+                             json=MagicMock(return_value={"id": product_id, "price": 2.0,
+                                                          "name": "macbook"}))
+        product_request_mock.side_effect = product_details
+        shopcart_request_mock.return_value = MagicMock(status_code=status.HTTP_201_CREATED)
+        with patch.dict(app.config, {'CART_WORKERS': 2}):
+            resp = self.app.put('/api/wishlists/1/add-to-cart')
+        self.assertEqual([result['status'] for result in resp.get_json()], ['moved', 'moved'])
+
+    def test_add_to_cart_async(self):
+        """ Test Add to cart queues the item and returns the job to poll """
+        wishlist = Wishlist(customer_id=7, name="name")
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=2, product_name='macbook').save()
+        resp = self.app.put('/api/wishlists/1/items/2/add-to-cart?async=true')
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        job = resp.get_json()
+        self.assertEqual(job['status'], 'pending')
+        self.assertEqual(job['customer_id'], 7)
+        # the item stays in the wishlist until the worker moved it
+        self.assertEqual(len(WishlistProduct.all()), 1)
+
+        resp = self.app.get(resp.headers.get('Location'))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['id'], job['id'])
+
+    def test_add_to_cart_async_not_exist(self):
+        """ Test Add to cart doesn't queue an item that isn't in the wishlist """
+        Wishlist(customer_id=7, name="name").save()
+        resp = self.app.put('/api/wishlists/1/items/2/add-to-cart?async=true')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_cart_job_not_found(self):
+        """ Test getting a Cart Job that doesn't exist """
+        resp = self.app.get('/api/cart-jobs/1')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_add_to_cart_wishlist_not_exist(self):
         """ Test Add to cart when wishlist doesn't exits """
         resp = self.app.put('/api/wishlists/1/items/1/add-to-cart')
@@ -1079,3 +1619,174 @@ class TestWishlistServer(unittest.TestCase):
         shopcart_request_mock.side_effect = Exception('Unknown Exception')
         resp = self.app.put('/api/wishlists/1/items/2/add-to-cart')
         self.assertEqual(resp.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    ######################################################################
+    # SQL STATEMENT BUDGETS
+    ######################################################################
+    def within(self, count):
+        """ Fails the block if it runs more than `count` SQL statements, with cold caches """
+        DB.session.remove()
+        DatabaseConnection.clear_caches()
+        return assert_max_queries(count)
+
+    def test_query_budget_wishlists(self):
+        """ Test the SQL statements of the Wishlist endpoints """
+        with self.within(2):
+            resp = self.app.post('/api/wishlists', json={'name': 'first', 'customer_id': 1})
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        # one INSERT for each wishlist on SQLite, which can't return the ids of a batch
+        with self.within(3):
+            resp = self.app.post('/api/wishlists:batch',
+                                 json=[{'name': 'batch', 'customer_id': 2}] * 3)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        WishlistProduct(wishlist_id=1, product_id=1, product_name='one').save()
+        with self.within(1):
+            self.assertEqual(len(self.app.get('/api/wishlists').get_json()), 4)
+        with self.within(1):
+            self.assertEqual(len(self.app.get('/api/wishlists?customer_id=2').get_json()), 3)
+        with self.within(2):
+            resp = self.app.get('/api/wishlists?expand=items')
+            self.assertEqual(len(resp.get_json()[0]['items']), 1)
+        with self.within(1):
+            resp = self.app.get('/api/wishlists?stream=true')
+            self.assertEqual(len(resp.get_json()), 4)
+        with self.within(1):
+            resp = self.app.get('/api/wishlists/1')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        with self.within(1):
+            resp = self.app.get('/api/wishlists/1', headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        with self.within(2):
+            resp = self.app.get('/api/wishlists/1?expand=items')
+            self.assertEqual(len(resp.get_json()['items']), 1)
+        with self.within(3):
+            resp = self.app.put('/api/wishlists/1', json={'name': 'renamed'})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        with self.within(2):
+            resp = self.app.delete('/api/wishlists/1')
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_query_budget_items(self):
+        """ Test the SQL statements of the Wishlist item endpoints """
+        Wishlist(name='wishlist', customer_id=1).save()
+        with self.within(3):
+            resp = self.app.post('/api/wishlists/1/items',
+                                 json={'product_id': 1, 'product_name': 'one'})
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        with self.within(4):
+            resp = self.app.post('/api/wishlists/1/items:batch',
+                                 json=[{'product_id': product_id, 'product_name': 'item'}
+                                       for product_id in range(2, 12)])
+            self.assertEqual(len(resp.get_json()), 10)
+        with self.within(2):
+            self.assertEqual(len(self.app.get('/api/wishlists/1/items').get_json()), 11)
+        with self.within(2):
+            resp = self.app.get('/api/wishlists/1/items?product_name=item')
+            self.assertEqual(len(resp.get_json()), 10)
+        with self.within(2):
+            resp = self.app.get('/api/wishlists/1/items?stream=true')
+            self.assertEqual(len(resp.get_json()), 11)
+        with self.within(2):
+            resp = self.app.get('/api/wishlists/1/items/1')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        with self.within(3):
+            resp = self.app.put('/api/wishlists/1/items/1', json={'product_name': 'renamed'})
+            self.assertEqual(resp.get_json()['product_name'], 'renamed')
+        with self.within(3):
+            resp = self.app.delete('/api/wishlists/1/items/1')
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
+    @patch('service.models.ShopCart._add_to_cart')
+    @patch('service.models.Product._get_product_details')
+    def test_query_budget_add_to_cart(self, product_request_mock, shopcart_request_mock):
+        """ Test the SQL statements of the add-to-cart endpoints """
+        Wishlist(name='wishlist', customer_id=1).save()
+        WishlistProduct.save_all(1, [WishlistProduct(wishlist_id=1, product_id=product_id,
+                                                     product_name='item')
+                                     for product_id in range(1, 13)])
+        product_request_mock.return_value = MagicMock(status_code=status.HTTP_200_OK)
+        product_request_mock.return_value.json.return_value = {"id": 1, "name": "item",
+                                                               "price": 1.0}
+        shopcart_request_mock.return_value = MagicMock(status_code=status.HTTP_201_CREATED)
+        with self.within(4):
+            resp = self.app.put('/api/wishlists/1/items/1/add-to-cart')
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        with self.within(4):
+            resp = self.app.put('/api/wishlists/1/items/2/add-to-cart?async=true')
+            self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        with self.within(1):
+            resp = self.app.get(resp.headers['Location'])
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # not one statement per item
+        with self.within(4):
+            resp = self.app.put('/api/wishlists/1/add-to-cart')
+            self.assertEqual(len(resp.get_json()), 11)
+
+    def test_query_budget_batches(self):
+        """ Test the SQL statements of the batch endpoints don't grow with the batch """
+        dialect = DB.engine.dialect
+        returning = dialect.implicit_returning and dialect.supports_multivalues_insert
+        with self.within(1 if returning else 30):
+            resp = self.app.post('/api/wishlists:batch',
+                                 json=[{'name': 'batch', 'customer_id': 1}] * 30)
+            self.assertEqual(len(resp.get_json()), 30)
+        items = [{'product_id': product_id, 'product_name': 'item'}
+                 for product_id in range(1, 51)]
+        with self.within(4):
+            resp = self.app.post('/api/wishlists/1/items:batch', json=items)
+            self.assertEqual(resp.get_json()[-1]['status'], 'created')
+        # nothing is written when every item is there already
+        with self.within(2):
+            resp = self.app.post('/api/wishlists/1/items:batch', json=items)
+            self.assertEqual(resp.get_json()[-1]['status'], 'already-present')
+        with self.within(1):
+            resp = self.app.post('/api/wishlists/99/items:batch', json=items)
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_query_budget_cart_jobs(self):
+        """ Test the SQL statements of the asynchronous add-to-cart endpoints """
+        Wishlist(name='wishlist', customer_id=1).save()
+        WishlistProduct(wishlist_id=1, product_id=1, product_name='item').save()
+        with self.within(2):
+            resp = self.app.put('/api/wishlists/1/items/2/add-to-cart?async=true')
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        with self.within(4):
+            resp = self.app.put('/api/wishlists/1/items/1/add-to-cart?async=true')
+            self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        with self.within(1):
+            resp = self.app.get(resp.headers['Location'])
+            self.assertEqual(resp.get_json()['status'], 'pending')
+        with self.within(1):
+            resp = self.app.get('/api/cart-jobs/99')
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_query_budget_reset(self):
+        """ Test the reset endpoint runs the same DDL however many rows there are """
+        Wishlist(name='wishlist', customer_id=1).save()
+        WishlistProduct.save_all(1, [WishlistProduct(wishlist_id=1, product_id=product_id,
+                                                     product_name='item')
+                                     for product_id in range(1, 21)])
+        # DROP and CREATE of each table and index, after checking it exists
+        with self.within(20):
+            resp = self.app.delete('/api/wishlists/reset')
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Wishlist.all(), [])
+
+    def test_query_budget_admin(self):
+        """ Test the admin endpoints run no SQL statements """
+        for url in ['/', '/api/admin/pool', '/api/admin/caches', '/api/admin/breakers',
+                    '/metrics']:
+            with self.within(0):
+                self.assertEqual(self.app.get(url).status_code, status.HTTP_200_OK)
+
+    def test_query_count_header(self):
+        """ Test the SQL statements of a request are sent in a header when asked """
+        Wishlist(name='wishlist', customer_id=1).save()
+        resp = self.app.get('/api/wishlists/1')
+        self.assertNotIn('X-Query-Count', resp.headers)
+        DatabaseConnection.clear_caches()
+        DB.session.remove()
+        with patch.dict(app.config, {'QUERY_COUNT_HEADER': True}):
+            resp = self.app.get('/api/wishlists/1')
+        self.assertEqual(resp.headers['X-Query-Count'], '1')
+        self.assertGreater(float(resp.headers['X-Query-Time-Ms']), 0)
@@ -21,10 +21,16 @@ Test cases can be run with:
 
 import unittest
 import os
+from unittest.mock import patch
 
-from service.models import Wishlist, DataValidationError, DB
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql
+
+from service.models import Wishlist, WishlistProduct, DataValidationError, DB, DatabaseConnection
 from service import app
 from service.service import init_db, disconnect_db
+from service import migrate
+from tests.helpers import count_statements, find_caches, query_plan
 
 DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:////tmp/test.db')
 
@@ -62,6 +68,47 @@ class TestWishlist(unittest.TestCase):
         wishlist.delete()
         self.assertEqual(len(Wishlist.all()), 0)
 
+    def test_delete_wishlist_unloaded_items(self):
+        """ Delete the items of a Wishlist that were never loaded with it """
+        Wishlist(name="wishlist_name", customer_id=1234).save()
+        WishlistProduct(wishlist_id=1, product_id=1, product_name='product').save()
+        DB.session.expunge_all()
+        Wishlist.query.get(1).delete()
+        self.assertEqual(DB.session.query(WishlistProduct).count(), 0)
+
+    def test_delete_wishlist_new_id(self):
+        """ Never give the id of a deleted Wishlist again, and forget its cached items """
+        wishlist = Wishlist(name="wishlist_name", customer_id=1234)
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=1, product_name='product').save()
+        self.assertEqual(len(WishlistProduct.items_of(wishlist.id, 2)), 1)
+        self.assertEqual(len(WishlistProduct.list_cache), 1)
+        wishlist.delete()
+        self.assertEqual(len(WishlistProduct.list_cache), 0)
+        new_wishlist = Wishlist(name="wishlist_name", customer_id=1234)
+        new_wishlist.save()
+        self.assertEqual(new_wishlist.id, wishlist.id + 1)
+
+    def test_save_all_wishlists(self):
+        """ Save a batch of Wishlists """
+        wishlists = [Wishlist(name="wishlist_name%s" % i, customer_id=1234) for i in range(3)]
+        Wishlist.save_all(wishlists)
+        self.assertEqual([wishlist.id for wishlist in wishlists], [1, 2, 3])
+        self.assertEqual(Wishlist.find(2).name, "wishlist_name1")
+
+    def test_save_all_wishlists_returning(self):
+        """ Save a batch of Wishlists with a single INSERT where it returns the ids """
+        wishlists = [Wishlist(name="wishlist_name%s" % i, customer_id=1234) for i in range(3)]
+        with patch.object(DB.engine.dialect, 'implicit_returning', True), \
+                patch.object(DB.session, 'execute', return_value=[(12,), (10,), (11,)]) as execute:
+            Wishlist.save_all(wishlists)
+        statement, = execute.call_args[0]
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        self.assertIn('RETURNING wishlist.id', sql)
+        self.assertEqual(sql.count('(%(customer_id_m'), 3)
+        self.assertEqual([wishlist.id for wishlist in wishlists], [10, 11, 12])
+        self.assertEqual(wishlists[0].version, 1)
+
     def test_serialize_a_wishlist(self):
         """ Test serialization of a Wishlist """
         wishlist = Wishlist(name="wishlist_name", customer_id=1234)
@@ -74,6 +121,15 @@ class TestWishlist(unittest.TestCase):
         self.assertIn('customer_id', data)
         self.assertEqual(data['customer_id'], 1234)
 
+    def test_serialize_a_wishlist_with_items(self):
+        """ Test serialization of a Wishlist with its items """
+        wishlist = Wishlist(name="wishlist_name", customer_id=1234)
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=2, product_name="iPad").save()
+        data = Wishlist.find(wishlist.id, with_items=True).serialize(with_items=True)
+        self.assertEqual(data['items'], [{"wishlist_id": wishlist.id, "product_id": 2,
+                                          "product_name": "iPad"}])
+
     def test_deserialize_a_wishlist(self):
         """ Test deserialization of a Wishlist """
         data = {"id": 1, "name": "wishlist_name", "customer_id": 1234}
@@ -102,3 +158,155 @@ class TestWishlist(unittest.TestCase):
         self.assertTrue(wishlist is not None)
         self.assertEqual(repr(wishlist), "<Wishlist 'ShoppingList'>")
         self.assertEqual(wishlist.customer_id, 1234)
+
+    def test_find_page(self):
+        """ Find wishlists one page at a time """
+        for i in range(5):
+            Wishlist(name="wishlist_name", customer_id=1234 + i % 2).save()
+        wishlists, next_after_id = Wishlist.find_page(2)
+        self.assertEqual([w.id for w in wishlists], [1, 2])
+        self.assertEqual(next_after_id, 2)
+        wishlists, next_after_id = Wishlist.find_page(2, after_id=2, customer_id=1234)
+        self.assertEqual([w.id for w in wishlists], [3, 5])
+        self.assertEqual(next_after_id, None)
+
+    def test_find_by_all_uses_indexes(self):
+        """ Query plans of find_by_all use the secondary indexes """
+        if DB.engine.dialect.name != 'sqlite':
+            self.skipTest('query plans are only checked on SQLite')
+        plan = query_plan(Wishlist.find_by_all(customer_id=1234))
+        self.assertIn('ix_wishlist_customer_id_name', plan)
+        plan = query_plan(Wishlist.find_by_all(customer_id=1234, name="wishlist_name"))
+        self.assertIn('ix_wishlist_customer_id_name', plan)
+        plan = query_plan(Wishlist.find_by_all(name="wishlist_name"))
+        self.assertIn('ix_wishlist_name', plan)
+        plan = query_plan(Wishlist.find_by_all(wishlist_id=1))
+        self.assertNotIn('SCAN', plan)
+
+    def test_find_cache(self):
+        """ Find a Wishlist from the cache without a query """
+        with find_caches():
+            Wishlist(name="wishlist", customer_id=100).save()
+            DB.session.remove()
+            self.assertEqual(Wishlist.find(1).name, 'wishlist')
+            DB.session.remove()
+            wishlist, statements = count_statements(Wishlist.find, 1)
+            self.assertEqual(statements, [])
+            self.assertEqual((wishlist.name, wishlist.customer_id, wishlist.version),
+                             ('wishlist', 100, 1))
+            self.assertEqual(Wishlist.find_cache.stats()['hits'], 1)
+            # the cached instance works like a loaded one
+            self.assertEqual(wishlist.items, [])
+            wishlist.name = 'renamed'
+            wishlist.save()
+            DB.session.remove()
+            self.assertEqual(Wishlist.find(1).name, 'renamed')
+            self.assertIsNone(Wishlist.find(2))
+
+    def test_find_cache_invalidation(self):
+        """ Writes to a Wishlist and its products drop its cached row once committed """
+        with find_caches():
+            Wishlist(name="wishlist", customer_id=100).save()
+            Wishlist.find(1)
+            self.assertEqual(len(Wishlist.find_cache), 1)
+            WishlistProduct(wishlist_id=1, product_id=1, product_name='product').save()
+            self.assertEqual(len(Wishlist.find_cache), 0)
+            DB.session.remove()
+            self.assertEqual(Wishlist.find(1).version, 2)
+
+            Wishlist.touch(1)
+            DB.session.rollback()
+            self.assertEqual(len(Wishlist.find_cache), 1)
+
+            WishlistProduct.find(1, 1)
+            self.assertEqual(len(WishlistProduct.find_cache), 1)
+            Wishlist.find(1).delete()
+            self.assertEqual(len(Wishlist.find_cache), 0)
+            self.assertEqual(len(WishlistProduct.find_cache), 0)
+            self.assertIsNone(Wishlist.find(1))
+
+    def test_find_cache_cleared_on_reset(self):
+        """ Resetting the database empties the caches """
+        with find_caches():
+            Wishlist(name="wishlist", customer_id=100).save()
+            Wishlist.find(1)
+            DatabaseConnection.reset_db()
+            self.assertEqual(len(Wishlist.find_cache), 0)
+            self.assertIsNone(Wishlist.find(1))
+
+    def test_create_missing_columns(self):
+        """ Columns missing from existing tables are added on init """
+        DB.drop_all()
+        DB.session.execute('CREATE TABLE wishlist (id INTEGER PRIMARY KEY, customer_id INTEGER, '
+                           'name VARCHAR(50))')
+        DB.session.execute("INSERT INTO wishlist VALUES (1, 100, 'old')")
+        DB.session.commit()
+        DB.create_all()
+        DatabaseConnection.create_columns()
+        self.assertEqual(Wishlist.version_of(1), 1)
+        self.assertIsNone(Wishlist.version_of(2))
+
+    def test_reused_ids_warning(self):
+        """ Warn about an old SQLite wishlist table that reuses ids """
+        if DB.engine.dialect.name != 'sqlite':
+            self.skipTest('SQLite only')
+        with patch('service.models.logger') as logger:
+            DatabaseConnection.check_autoincrement()
+        logger.warning.assert_not_called()
+        DB.session.execute('DROP TABLE wishlist_product')
+        DB.session.execute('DROP TABLE wishlist')
+        DB.session.execute('CREATE TABLE wishlist (id INTEGER PRIMARY KEY, customer_id INTEGER, '
+                           'name VARCHAR(50))')
+        DB.session.commit()
+        with self.assertLogs('flask.app', 'WARNING') as logs:
+            DatabaseConnection.create_schema()
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Table wishlist was created without AUTOINCREMENT', logs.output[0])
+
+    def test_version(self):
+        """ The version of a Wishlist is bumped when it or its products change """
+        wishlist = Wishlist(name="wishlist", customer_id=100)
+        wishlist.save()
+        self.assertEqual(wishlist.version, 1)
+        wishlist.name = 'renamed'
+        wishlist.save()
+        self.assertEqual(wishlist.version, 2)
+        WishlistProduct(wishlist_id=wishlist.id, product_id=1, product_name='product').save()
+        WishlistProduct.save_all(wishlist.id, [WishlistProduct(wishlist_id=wishlist.id,
+                                                               product_id=2, product_name='x')])
+        WishlistProduct.find(wishlist.id, 1).delete()
+        WishlistProduct.delete_all(wishlist.id, [2])
+        self.assertEqual(Wishlist.version_of(wishlist.id), 6)
+
+    def test_create_missing_indexes(self):
+        """ Indexes missing from existing tables are created on init """
+        DB.session.execute('DROP INDEX ix_wishlist_name')
+        DB.session.commit()
+        DatabaseConnection.create_indexes()
+        indexes = [index['name'] for index in inspect(DB.engine).get_indexes('wishlist')]
+        self.assertIn('ix_wishlist_name', indexes)
+
+    def test_init_without_schema(self):
+        """ Init leaves the schema alone without create_schema """
+        DB.drop_all()
+        with patch.object(DB, 'create_all') as create_all:
+            DatabaseConnection.init(create_schema=False)
+        create_all.assert_not_called()
+
+    def test_migrate(self):
+        """ The migrate command creates the missing tables """
+        DB.drop_all()
+        migrate.main()
+        # without the tables SQLite keeps for itself
+        tables = [name for name in inspect(DB.engine).get_table_names()
+                  if not name.startswith('sqlite_')]
+        self.assertEqual(sorted(tables), ['cart_job', 'wishlist', 'wishlist_product'])
+        Wishlist(name="wishlist", customer_id=100).save()
+        self.assertEqual(Wishlist.version_of(1), 1)
+
+    def test_migrate_fails(self):
+        """ The migrate command exits with 4 when the database can't be migrated """
+        with patch.object(DatabaseConnection, 'create_schema', side_effect=OSError('down')):
+            with self.assertRaises(SystemExit) as exit_status:
+                migrate.main()
+        self.assertEqual(exit_status.exception.code, 4)
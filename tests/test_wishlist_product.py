@@ -21,10 +21,16 @@ Test cases can be run with:
 
 import unittest
 import os
+import sqlite3
+import threading
+from unittest.mock import patch
+
+from sqlalchemy import event
 
 from service.models import Wishlist, WishlistProduct, DataValidationError, DB
 from service import app
 from service.service import init_db, disconnect_db
+from tests.helpers import find_caches, query_plan
 
 DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:////tmp/test.db')
 
@@ -75,6 +81,95 @@ class TestWishlistProduct(unittest.TestCase):
         wishlist_product.delete()
         self.assertEqual(len(WishlistProduct.all()), 0)
 
+    def test_save_existing_wishlist_product(self):
+        """ Saving a Wishlist Product that is already there keeps a single row """
+        wishlist = Wishlist(name="wishlist_name", customer_id=1234)
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=1, product_name="iPad").save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=1, product_name="iPad").save()
+        self.assertEqual(len(WishlistProduct.all()), 1)
+
+    def test_update_wishlist_product(self):
+        """ Saving a Wishlist Product found in the data store updates it """
+        wishlist = Wishlist(name="wishlist_name", customer_id=1234)
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=1, product_name="iPad").save()
+        wishlist_product = WishlistProduct.find(wishlist.id, 1)
+        wishlist_product.product_name = "iPad Pro"
+        wishlist_product.save()
+        DB.session.expire_all()
+        self.assertEqual(WishlistProduct.find(wishlist.id, 1).product_name, "iPad Pro")
+
+    def test_save_wishlist_product_concurrently(self):
+        """ Threads adding the same Wishlist Product at once don't conflict """
+        wishlist = Wishlist(name="wishlist_name", customer_id=1234)
+        wishlist.save()
+        wishlist_id = wishlist.id
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def add_product():
+            with app.app_context():
+                try:
+                    barrier.wait()
+                    WishlistProduct(wishlist_id=wishlist_id, product_id=1,
+                                    product_name="iPad").save()
+                except Exception as error:
+                    errors.append(error)
+                finally:
+                    DB.session.remove()
+
+        threads = [threading.Thread(target=add_product) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(WishlistProduct.all()), 1)
+
+    def test_save_all_wishlist_products(self):
+        """ Save a batch of Wishlist Products skipping the ones already there """
+        wishlist = Wishlist(name="wishlist_name", customer_id=1234)
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=1, product_name="iPad").save()
+        batch = [WishlistProduct(wishlist_id=wishlist.id, product_id=product_id,
+                                 product_name="product %s" % product_id)
+                 for product_id in [1, 2, 3, 2]]
+        created = WishlistProduct.save_all(wishlist.id, batch)
+        self.assertEqual(created, [batch[1], batch[2]])
+        self.assertEqual(len(WishlistProduct.all()), 3)
+        self.assertEqual(WishlistProduct.find(wishlist.id, 1).product_name, "iPad")
+
+    def save_all_racing(self, batch):
+        """ Saves a batch while another connection adds product 1 after the lookup """
+        inserted = []
+        def insert_first(_conn, _cursor, statement, *_args):
+            if statement.startswith('INSERT INTO wishlist_product') and not inserted:
+                inserted.append(True)
+                DB.engine.execute("INSERT INTO wishlist_product VALUES (1, 1, 'other')")
+        event.listen(DB.engine, 'before_cursor_execute', insert_first)
+        try:
+            return WishlistProduct.save_all(1, batch)
+        finally:
+            event.remove(DB.engine, 'before_cursor_execute', insert_first)
+
+    def test_save_all_concurrent_insert(self):
+        """ Don't report a Wishlist Product another request inserted meanwhile as created """
+        # with RETURNING, then with a statement for each row
+        for version in [sqlite3.sqlite_version_info, (3, 34, 0)]:
+            DB.session.remove()
+            DB.drop_all()
+            DB.create_all()
+            Wishlist(name="wishlist_name", customer_id=1234).save()
+            batch = [WishlistProduct(wishlist_id=1, product_id=product_id,
+                                     product_name="product %s" % product_id)
+                     for product_id in [1, 2]]
+            with patch('service.models.sqlite3.sqlite_version_info', version):
+                created = self.save_all_racing(batch)
+            self.assertEqual(created, [batch[1]], version)
+            self.assertEqual(WishlistProduct.find(1, 1).product_name, 'other')
+            self.assertEqual(len(WishlistProduct.all()), 2)
+
     def test_deserialize_a_wishlist_product(self):
         """ Test deserialization of a Wishlist product """
         data = {"product_name": "product_name", "wishlist_id": 1234, "product_id": 1}
@@ -97,3 +192,36 @@ class TestWishlistProduct(unittest.TestCase):
         data = {"product_name": "product_name"}
         product = WishlistProduct()
         self.assertRaises(DataValidationError, product.deserialize, data)
+
+    def test_find_by_all_uses_indexes(self):
+        """ Query plans of find_by_all use the secondary indexes """
+        if DB.engine.dialect.name != 'sqlite':
+            self.skipTest('query plans are only checked on SQLite')
+        plan = query_plan(WishlistProduct.find_by_all(product_id=2))
+        self.assertIn('ix_wishlist_product_product_id', plan)
+        plan = query_plan(WishlistProduct.find_by_all(product_name="Macbook Pro"))
+        self.assertIn('ix_wishlist_product_product_name', plan)
+        plan = query_plan(WishlistProduct.find_by_all(wishlist_id=1, product_id=2))
+        self.assertNotIn('SCAN', plan)
+
+    def test_find_cache(self):
+        """ Find a Wishlist Product from the cache and drop it when it changes """
+        with find_caches():
+            Wishlist(name="wishlist", customer_id=100).save()
+            WishlistProduct(wishlist_id=1, product_id=1, product_name='macbook').save()
+            DB.session.remove()
+            WishlistProduct.find(1, 1)
+            DB.session.remove()
+            wishlist_product = WishlistProduct.find(1, 1)
+            self.assertEqual(WishlistProduct.find_cache.stats()['hits'], 1)
+            self.assertEqual(wishlist_product.product_name, 'macbook')
+
+            wishlist_product.product_name = 'iphone'
+            wishlist_product.save()
+            self.assertEqual(len(WishlistProduct.find_cache), 0)
+            DB.session.remove()
+            self.assertEqual(WishlistProduct.find(1, 1).product_name, 'iphone')
+
+            WishlistProduct.find(1, 1).delete()
+            self.assertEqual(len(WishlistProduct.find_cache), 0)
+            self.assertIsNone(WishlistProduct.find(1, 1))
@@ -0,0 +1,220 @@
+# Copyright 2016, 2019 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Cart Job outbox and the add-to-cart worker
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import unittest
+import os
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import requests
+from sqlalchemy.exc import OperationalError
+
+from service.models import Wishlist, WishlistProduct, CartJob, Product, ShopCart, DB
+from service import app
+from service.service import init_db, disconnect_db
+from service.worker import CartWorker
+from tests.helpers import find_caches
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:////tmp/test.db')
+
+PRODUCT = {"id": 2, "name": "macbook", "price": 20.0}
+
+#######################################################################
+#  T E S T   C A S E S
+#######################################################################
+@patch('service.models.ShopCart._add_to_cart')
+@patch('service.models.Product._get_product_details')
+class TestCartWorker(unittest.TestCase):
+    """ Test Cases for CartJob and CartWorker """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.debug = False
+        # Set up the test database
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        disconnect_db()
+
+    def setUp(self):
+        DB.drop_all()    # clean up the last tests
+        DB.create_all()  # make our sqlalchemy tables
+        Product.cache.clear()
+        Product.breaker.reset()
+        ShopCart.breaker.reset()
+        self.worker = CartWorker()
+        self.worker.retry_seconds = 10
+        self.worker.max_attempts = 2
+        wishlist = Wishlist(customer_id=7, name="name")
+        wishlist.save()
+        WishlistProduct(wishlist_id=wishlist.id, product_id=2, product_name='macbook').save()
+        self.job = CartJob.enqueue(7, wishlist.id, 2)
+
+    def tearDown(self):
+        DB.session.remove()
+
+    def test_enqueue(self, product_request_mock, shopcart_request_mock):
+        """ Queue a job without calling any service """
+        self.assertEqual(self.job.status, CartJob.PENDING)
+        self.assertEqual(self.job.attempts, 0)
+        self.assertEqual(CartJob.find(self.job.id).serialize()['customer_id'], 7)
+        product_request_mock.assert_not_called()
+        shopcart_request_mock.assert_not_called()
+
+    def test_move_to_cart(self, product_request_mock, shopcart_request_mock):
+        """ Move the product of a job to the cart and remove it from the wishlist """
+        product_request_mock.return_value = MagicMock(status_code=200,
+                                                      json=MagicMock(return_value=PRODUCT))
+        shopcart_request_mock.return_value = MagicMock(status_code=201)
+        self.assertEqual(self.worker.drain(), 1)
+        self.assertEqual(CartJob.find(self.job.id).status, CartJob.DONE)
+        self.assertEqual(CartJob.find(self.job.id).attempts, 1)
+        self.assertEqual(shopcart_request_mock.call_args[0][:2], (7, 2))
+        self.assertEqual(WishlistProduct.all(), [])
+        self.assertEqual(self.worker.drain(), 0)
+
+    def test_batches(self, product_request_mock, shopcart_request_mock):
+        """ Claim the due jobs a batch at a time, oldest first """
+        product_request_mock.return_value = MagicMock(status_code=200,
+                                                      json=MagicMock(return_value=PRODUCT))
+        shopcart_request_mock.return_value = MagicMock(status_code=201)
+        for product_id in [3, 4]:
+            WishlistProduct(wishlist_id=1, product_id=product_id, product_name='x').save()
+            CartJob.enqueue(7, 1, product_id)
+        self.worker.batch_size = 2
+        self.assertEqual(self.worker.drain(), 2)
+        self.assertEqual([item.product_id for item in WishlistProduct.all()], [4])
+        self.assertEqual(self.worker.drain(), 1)
+        self.assertEqual(self.worker.drain(), 0)
+
+    def test_retry(self, product_request_mock, shopcart_request_mock):
+        """ Retry a job later when a service fails, and give up after the last attempt """
+        product_request_mock.return_value = MagicMock(status_code=200,
+                                                      json=MagicMock(return_value=PRODUCT))
+        shopcart_request_mock.side_effect = requests.exceptions.ConnectionError('down')
+        self.worker.drain()
+        job = CartJob.find(self.job.id)
+        self.assertEqual(job.status, CartJob.PENDING)
+        self.assertIn('Shopcarts', job.last_error)
+        self.assertGreater(job.available_at, datetime.utcnow() + timedelta(seconds=5))
+
+        # not due yet
+        self.assertEqual(self.worker.drain(), 0)
+        job.available_at = datetime.utcnow()
+        DB.session.commit()
+        self.assertEqual(self.worker.drain(), 1)
+        job = CartJob.find(self.job.id)
+        self.assertEqual(job.status, CartJob.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(len(WishlistProduct.all()), 1)
+
+    def test_unknown_product(self, product_request_mock, shopcart_request_mock):
+        """ Give up at once on a product the Product service doesn't know """
+        product_request_mock.return_value = MagicMock(status_code=404)
+        self.worker.drain()
+        self.assertEqual(CartJob.find(self.job.id).status, CartJob.FAILED)
+        shopcart_request_mock.assert_not_called()
+
+    def test_removed_from_wishlist(self, product_request_mock, shopcart_request_mock):
+        """ Give up on a product that was removed from the wishlist meanwhile """
+        WishlistProduct.find(1, 2).delete()
+        self.worker.drain()
+        job = CartJob.find(self.job.id)
+        self.assertEqual(job.status, CartJob.FAILED)
+        self.assertIn('no longer', job.last_error)
+        product_request_mock.assert_not_called()
+        shopcart_request_mock.assert_not_called()
+
+    def test_removed_by_another_worker(self, product_request_mock, shopcart_request_mock):
+        """ Check the wishlist in the database, not in the cache of the lookups """
+        with find_caches():
+            self.assertIsNotNone(WishlistProduct.find(1, 2))
+            # another process deletes it, which doesn't clear the cache of this one
+            WishlistProduct.query.filter_by(wishlist_id=1, product_id=2) \
+                .delete(synchronize_session=False)
+            DB.session.commit()
+            self.worker.drain()
+        self.assertEqual(CartJob.find(self.job.id).status, CartJob.FAILED)
+        product_request_mock.assert_not_called()
+        shopcart_request_mock.assert_not_called()
+
+    def test_unexpected_error(self, product_request_mock, shopcart_request_mock):
+        """ Roll back and retry a job that fails with an unexpected error """
+        # a body that isn't JSON
+        product_request_mock.return_value = MagicMock(
+            status_code=200, json=MagicMock(side_effect=ValueError('bad product')))
+        self.assertEqual(self.worker.drain(), 1)
+        job = CartJob.find(self.job.id)
+        self.assertEqual(job.status, CartJob.PENDING)
+        self.assertEqual(job.last_error, 'bad product')
+        job.available_at = datetime.utcnow()
+        DB.session.commit()
+        self.worker.drain()
+        job = CartJob.find(self.job.id)
+        self.assertEqual(job.status, CartJob.FAILED)
+        self.assertEqual(len(WishlistProduct.all()), 1)
+        shopcart_request_mock.assert_not_called()
+
+    def test_expired_lease(self, product_request_mock, shopcart_request_mock):
+        """ Claim a job again when the worker running it died """
+        self.assertEqual(len(CartJob.claim(10, lease_seconds=60)), 1)
+        self.assertEqual(CartJob.claim(10, lease_seconds=60), [])
+        job = CartJob.find(self.job.id)
+        job.available_at = datetime.utcnow() - timedelta(seconds=1)
+        DB.session.commit()
+        claimed = CartJob.claim(10, lease_seconds=60)
+        self.assertEqual([job.id for job in claimed], [self.job.id])
+        self.assertEqual(claimed[0].attempts, 2)
+        product_request_mock.assert_not_called()
+        shopcart_request_mock.assert_not_called()
+
+    def test_run_and_stop(self, product_request_mock, shopcart_request_mock):
+        """ Stop the worker loop """
+        def drain():
+            self.worker.stop()
+            return 0
+        with patch.object(self.worker, 'drain', side_effect=drain) as drain_mock:
+            self.worker.run()
+        drain_mock.assert_called_once_with()
+        product_request_mock.assert_not_called()
+        shopcart_request_mock.assert_not_called()
+
+    def test_run_after_claim_fails(self, product_request_mock, shopcart_request_mock):
+        """ Keep the worker loop going when the jobs can't be claimed """
+        product_request_mock.return_value = MagicMock(status_code=200,
+                                                      json=MagicMock(return_value=PRODUCT))
+        shopcart_request_mock.return_value = MagicMock(status_code=201)
+        claim = CartJob.claim
+        def flaky_claim(*args):
+            if flaky_claim.calls == 0:
+                flaky_claim.calls += 1
+                raise OperationalError('SELECT', {}, Exception('database is locked'))
+            self.worker.stop()
+            return claim(*args)
+        flaky_claim.calls = 0
+        self.worker.poll_seconds = 0
+        with patch.object(CartJob, 'claim', side_effect=flaky_claim):
+            self.worker.run()
+        self.assertEqual(CartJob.find(self.job.id).status, CartJob.DONE)
+        shopcart_request_mock.assert_called_once()